@@ -0,0 +1,67 @@
+import argparse
+import time
+from sqlalchemy import text
+from utils import get_db_connection, load_table_to_df
+from typed_schema import ANALYTICS_SCHEMA, TYPED_TABLES
+
+def get_table_bytes(table_name, engine):
+    """On-disk heap size of a table, used as the common MB/sec basis for both paths"""
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT pg_table_size(to_regclass(:t))"), {"t": table_name}).scalar() or 0
+
+def time_load(table_name, engine, use_copy, repeat):
+    """Best-of-N wall time for one load path, plus the row count"""
+    best = None
+    rows = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = load_table_to_df(table_name, engine, use_copy=use_copy)
+        elapsed = time.perf_counter() - start
+        if df is None:
+            raise Exception(f"Failed to load {table_name}")
+        rows = len(df)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+def run_benchmark(schema=ANALYTICS_SCHEMA, repeat=3, engine=None):
+    """Compare read_sql_query and COPY throughput on each of the five tables"""
+    if engine is None:
+        engine = get_db_connection()
+
+    results = []
+    for table in TYPED_TABLES:
+        table_name = f"{schema}.{table}"
+        table_bytes = get_table_bytes(table_name, engine)
+        for path, use_copy in (('read_sql', False), ('copy', True)):
+            seconds, rows = time_load(table_name, engine, use_copy, repeat)
+            results.append({
+                'table': table_name,
+                'path': path,
+                'rows': rows,
+                'seconds': seconds,
+                'rows_per_sec': rows / seconds if seconds else 0,
+                'mb_per_sec': table_bytes / (1024 * 1024) / seconds if seconds else 0,
+            })
+    return results
+
+def print_results(results):
+    print(f"\n{'Table':<28}{'Path':<10}{'Rows':>10}{'Seconds':>10}{'Rows/sec':>14}{'MB/sec':>10}")
+    print("-" * 82)
+    by_table = {}
+    for r in results:
+        by_table.setdefault(r['table'], {})[r['path']] = r
+        print(f"{r['table']:<28}{r['path']:<10}{r['rows']:>10,}{r['seconds']:>10.3f}"
+              f"{r['rows_per_sec']:>14,.0f}{r['mb_per_sec']:>10.1f}")
+    print("\nSpeedup of COPY over read_sql:")
+    for table, paths in by_table.items():
+        if paths['copy']['seconds']:
+            print(f"  {table:<28}{paths['read_sql']['seconds'] / paths['copy']['seconds']:>6.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the COPY export path against read_sql_query")
+    parser.add_argument("--schema", default=ANALYTICS_SCHEMA,
+                        help=f"Schema holding the five tables (default {ANALYTICS_SCHEMA}; 'public' for raw)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per path; the best time is reported")
+    args = parser.parse_args()
+
+    print_results(run_benchmark(args.schema, args.repeat))
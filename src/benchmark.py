@@ -0,0 +1,274 @@
+import argparse
+import importlib
+import inspect
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from sqlalchemy import text
+from utils import get_db_connection
+from query_metrics import explain_analyze
+from render_all import CHARTS
+
+logger = logging.getLogger(__name__)
+
+# End-to-end benchmark of the analyses at several data sizes. For each scale
+# the synthetic data is generated (cached on disk), loaded into a disposable
+# database and built, then every step is timed: the RFM and purchase-interval
+# refreshes, each analysis query, the state-segment pivot and each chart
+# render. Steps record best-of-N wall time, peak Python memory (tracemalloc)
+# and, for queries, the shared buffer hits/reads from EXPLAIN (ANALYZE,
+# BUFFERS). Results are compared with a stored baseline per scale.
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+DEFAULT_SCALES = [0.1, 1]
+DEFAULT_TOLERANCE = 0.25
+# Timing differences below this are noise, whatever the relative change
+MIN_DELTA_SECONDS = 0.05
+
+def prepare_database(engine, scale, seed, data_dir):
+    """Generate (once) and load the data for one scale and build the typed schema.
+
+    Returns the setup timings as benchmark results.
+    """
+    from generate_data import write_csvs
+    from load_data import load_olist_csvs
+    from typed_schema import build_typed_schema
+
+    csv_dir = os.path.join(data_dir, f"scale-{scale:g}-seed-{seed}")
+    if not os.path.exists(os.path.join(csv_dir, '.complete')):
+        write_csvs(csv_dir, scale, seed)
+        open(os.path.join(csv_dir, '.complete'), 'w').close()
+
+    results = []
+    start = time.perf_counter()
+    load_olist_csvs(csv_dir, engine=engine)
+    results.append({'step': 'setup:load', 'seconds': time.perf_counter() - start})
+
+    start = time.perf_counter()
+    if build_typed_schema(engine) is None:
+        raise Exception("Typed schema build failed")
+    results.append({'step': 'setup:typed_build', 'seconds': time.perf_counter() - start})
+    return results
+
+def measure(function, repeat):
+    """Best-of-N wall time, then one more run under tracemalloc for peak memory.
+
+    Returns (result of the last run, seconds, peak MB).
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, best, peak / (1024 * 1024)
+
+def buffer_usage(query, engine):
+    """Shared buffer hits and reads of one execution of a query"""
+    plan = explain_analyze(query, engine)['Plan']
+    return plan.get('Shared Hit Blocks', 0), plan.get('Shared Read Blocks', 0)
+
+def statement_buffer_usage(engine, statements, setup=()):
+    """Shared buffer hits and reads of a sequence of statements, summed.
+
+    Each (sql, params) statement runs under EXPLAIN (ANALYZE, BUFFERS)
+    after the `setup` statements, all in one transaction that is rolled
+    back, so writes are measured without being kept.
+    """
+    hit = read = 0
+    with engine.connect() as conn:
+        for sql in setup:
+            conn.execute(text(sql))
+        for sql, params in statements:
+            plan = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}"), params).scalar()
+            plan = (plan if isinstance(plan, list) else json.loads(plan))[0]['Plan']
+            hit += plan.get('Shared Hit Blocks', 0)
+            read += plan.get('Shared Read Blocks', 0)
+        conn.rollback()
+    return hit, read
+
+def rfm_refresh_statements(engine):
+    """(sql, params) statements of a full RFM refresh and their setup, for statement_buffer_usage"""
+    from rfm import AGGREGATES_TABLE, FOLDED_TABLE, RFM_SEGMENTS_TABLE, fold_delta_query, rfm_aggregates_query
+
+    with engine.connect() as conn:
+        max_date = conn.execute(text("SELECT MAX(order_purchase_timestamp) FROM analytics.orders")).scalar()
+    setup = [f"TRUNCATE {AGGREGATES_TABLE}, {FOLDED_TABLE}", f"DROP TABLE IF EXISTS {RFM_SEGMENTS_TABLE}_build"]
+    statements = [
+        (fold_delta_query, {"watermark": '-infinity'}),
+        (f"CREATE TABLE {RFM_SEGMENTS_TABLE}_build AS {rfm_aggregates_query}", {"max_date": max_date}),
+    ]
+    return statements, setup
+
+def benchmark_steps(engine, repeat):
+    """Time the RFM refresh, the analysis queries, the pivot and the renders"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from rfm import refresh_rfm_segments
+    from purchase_intervals import refresh_purchase_intervals
+    from segments_by_state import prepare_state_segments
+
+    results = []
+
+    def record(step, function, query=None, buffers=None):
+        result, seconds, peak_mb = measure(function, repeat)
+        entry = {'step': step, 'seconds': seconds, 'peak_mb': peak_mb}
+        if query is not None:
+            entry['shared_hit'], entry['shared_read'] = buffer_usage(query, engine)
+        elif buffers is not None:
+            entry['shared_hit'], entry['shared_read'] = buffers()
+        results.append(entry)
+        return result
+
+    def refresh():
+        if not refresh_rfm_segments(engine):
+            raise Exception("RFM refresh failed")
+    record('rfm_refresh', refresh,
+           buffers=lambda: statement_buffer_usage(engine, *rfm_refresh_statements(engine)))
+
+    def refresh_intervals():
+        if not refresh_purchase_intervals(engine):
+            raise Exception("Purchase interval refresh failed")
+    record('purchase_intervals_refresh', refresh_intervals)
+
+    data = {}
+    for name, (module_name, data_function, _) in CHARTS.items():
+        module = importlib.import_module(module_name)
+        fetch = getattr(module, data_function)
+        # Time the query, not an in-process cache in front of it
+        kwargs = {'cache': False} if 'cache' in inspect.signature(fetch).parameters else {}
+        data[name] = record(f"query:{name}", lambda: fetch(engine, **kwargs), module.query)
+        if data[name] is None:
+            raise Exception(f"{module_name}.{data_function} returned no data")
+
+    record('transform:prepare_state_segments',
+           lambda: prepare_state_segments(data['customer_segments_by_state']))
+
+    for name, (module_name, _, plot_function) in CHARTS.items():
+        plot = getattr(importlib.import_module(module_name), plot_function)
+
+        def render():
+            fig = plot(data[name])
+            fig.savefig(io.BytesIO(), format='png', dpi=100, bbox_inches='tight')
+            plt.close(fig)
+        record(f"render:{name}", render)
+
+    return results
+
+def run_benchmark(engine, scales=DEFAULT_SCALES, seed=0, repeat=3, data_dir=None):
+    """Benchmark every step at each scale. Returns {scale: [result dicts]}."""
+    data_dir = data_dir or os.path.join(tempfile.gettempdir(), 'olist-bench')
+    runs = {}
+    for scale in scales:
+        logger.info(f"Benchmarking scale {scale:g}")
+        results = prepare_database(engine, scale, seed, data_dir)
+        results.extend(benchmark_steps(engine, repeat))
+        runs[f"{scale:g}"] = results
+    return runs
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_baseline(baseline, path=BASELINE_PATH):
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def find_regressions(runs, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Messages for every metric that grew past the tolerance over the baseline"""
+    regressions = []
+    for scale, results in runs.items():
+        for result in results:
+            base = baseline.get(scale, {}).get(result['step'])
+            if base is None:
+                continue
+            label = f"scale {scale} {result['step']}"
+            if (result['seconds'] > base['seconds'] * (1 + tolerance)
+                    and result['seconds'] - base['seconds'] > MIN_DELTA_SECONDS):
+                regressions.append(f"{label}: {result['seconds']:.3f}s vs {base['seconds']:.3f}s baseline")
+            if 'peak_mb' in base and result['peak_mb'] > max(base['peak_mb'], 1) * (1 + tolerance):
+                regressions.append(f"{label}: peak {result['peak_mb']:.1f} MB vs {base['peak_mb']:.1f} MB baseline")
+            if 'shared_hit' in base:
+                blocks = result['shared_hit'] + result['shared_read']
+                base_blocks = base['shared_hit'] + base['shared_read']
+                if blocks > base_blocks * (1 + tolerance):
+                    regressions.append(f"{label}: {blocks:,} buffers vs {base_blocks:,} baseline")
+    return regressions
+
+def to_baseline(runs):
+    return {scale: {r['step']: {k: v for k, v in r.items() if k != 'step'} for r in results}
+            for scale, results in runs.items()}
+
+def print_results(runs, baseline):
+    for scale, results in runs.items():
+        print(f"\nScale {scale}")
+        print(f"{'Step':<44}{'Seconds':>10}{'Baseline':>10}{'Peak MB':>10}{'Buf hit':>10}{'Buf read':>10}")
+        print("-" * 94)
+        for r in results:
+            base = baseline.get(scale, {}).get(r['step'], {})
+            base_seconds = f"{base['seconds']:.3f}" if 'seconds' in base else '-'
+            peak = f"{r['peak_mb']:.2f}" if 'peak_mb' in r else '-'
+            hit = f"{r['shared_hit']:,}" if 'shared_hit' in r else '-'
+            read = f"{r['shared_read']:,}" if 'shared_read' in r else '-'
+            print(f"{r['step']:<44}{r['seconds']:>10.3f}{base_seconds:>10}{peak:>10}{hit:>10}{read:>10}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every analysis step across data sizes")
+    parser.add_argument("--url", required=True,
+                        help="Database URL of a disposable Postgres; its Olist tables are replaced")
+    parser.add_argument("--scales", type=float, nargs="+", default=DEFAULT_SCALES,
+                        help="Data sizes relative to the public Olist data (default: 0.1 1)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per step; the best time is kept")
+    parser.add_argument("--data-dir", help="Where generated CSV files are cached (default: temp dir)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Allowed relative growth over the baseline (default {DEFAULT_TOLERANCE})")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Store this run as the baseline for the scales it covers")
+    args = parser.parse_args()
+
+    # Measure the database, not the result cache
+    os.environ['QUERY_CACHE'] = '0'
+
+    engine = get_db_connection(args.url)
+    if engine is None:
+        sys.exit(2)
+
+    try:
+        runs = run_benchmark(engine, args.scales, args.seed, args.repeat, args.data_dir)
+    except Exception as e:
+        logger.error(f"Benchmark failed: {str(e)}")
+        sys.exit(2)
+
+    baseline = load_baseline()
+    print_results(runs, baseline)
+
+    if args.update_baseline:
+        baseline.update(to_baseline(runs))
+        save_baseline(baseline)
+        print(f"\nBaseline updated: {BASELINE_PATH}")
+        sys.exit(0)
+
+    regressions = find_regressions(runs, baseline, args.tolerance)
+    if regressions:
+        print("\nRegressions:")
+        for message in regressions:
+            print(f"  {message}")
+        sys.exit(1)
+    print("\nNo regressions" if baseline else "\nNo baseline yet; run with --update-baseline to store one")
@@ -0,0 +1,102 @@
+from sqlalchemy import text
+from typed_schema import ANALYTICS_SCHEMA
+
+# Display names for every Olist product category, most purchased first.
+# Seeded into analytics.category_translation by the typed build so queries
+# can translate names with a join instead of a Python lookup.
+CATEGORY_TRANSLATIONS = {
+    'cama_mesa_banho': 'Bed, Bath & Table',
+    'beleza_saude': 'Health & Beauty',
+    'esporte_lazer': 'Sports & Leisure',
+    'moveis_decoracao': 'Furniture & Decor',
+    'informatica_acessorios': 'Computer Accessories',
+    'utilidades_domesticas': 'Household Items',
+    'relogios_presentes': 'Watches & Gifts',
+    'telefonia': 'Mobile Phones & Accessories',
+    'ferramentas_jardim': 'Garden Tools',
+    'automotivo': 'Automotive',
+    'brinquedos': 'Toys',
+    'cool_stuff': 'Cool Stuff',
+    'perfumaria': 'Perfumery',
+    'bebes': 'Baby',
+    'eletronicos': 'Electronics',
+    'papelaria': 'Stationery',
+    'fashion_bolsas_e_acessorios': 'Fashion Bags & Accessories',
+    'pet_shop': 'Pet Shop',
+    'moveis_escritorio': 'Office Furniture',
+    'consoles_games': 'Consoles & Games',
+    'malas_acessorios': 'Luggage & Accessories',
+    'construcao_ferramentas_construcao': 'Construction Tools',
+    'eletrodomesticos': 'Home Appliances',
+    'instrumentos_musicais': 'Musical Instruments',
+    'eletroportateis': 'Small Appliances',
+    'casa_construcao': 'Home Construction',
+    'livros_interesse_geral': 'Books (General Interest)',
+    'alimentos': 'Food',
+    'moveis_sala': 'Living Room Furniture',
+    'casa_conforto': 'Home Comfort',
+    'bebidas': 'Drinks',
+    'audio': 'Audio',
+    'market_place': 'Marketplace',
+    'construcao_ferramentas_iluminacao': 'Construction Tools & Lighting',
+    'climatizacao': 'Air Conditioning',
+    'moveis_cozinha_area_de_servico_jantar_e_jardim': 'Kitchen, Dining & Garden Furniture',
+    'alimentos_bebidas': 'Food & Drinks',
+    'industria_comercio_e_negocios': 'Industry, Commerce & Business',
+    'livros_tecnicos': 'Technical Books',
+    'telefonia_fixa': 'Fixed Telephony',
+    'fashion_calcados': 'Fashion Shoes',
+    'eletrodomesticos_2': 'Home Appliances 2',
+    'construcao_ferramentas_jardim': 'Construction & Garden Tools',
+    'agro_industria_e_comercio': 'Agro Industry & Commerce',
+    'artes': 'Art',
+    'pcs': 'Computers',
+    'sinalizacao_e_seguranca': 'Signaling & Security',
+    'construcao_ferramentas_seguranca': 'Construction & Safety Tools',
+    'artigos_de_natal': 'Christmas Supplies',
+    'fashion_roupa_masculina': "Men's Clothing",
+    'moveis_colchao_e_estofado': 'Mattresses & Upholstery',
+    'fashion_underwear_e_moda_praia': 'Underwear & Beachwear',
+    'fashion_esporte': 'Sportswear',
+    'musica': 'Music',
+    'livros_importados': 'Imported Books',
+    'artes_e_artesanato': 'Arts & Crafts',
+    'fraldas_higiene': 'Diapers & Hygiene',
+    'dvds_blu_ray': 'DVDs & Blu-ray',
+    'construcao_ferramentas_ferramentas': 'Construction Tools (Hand Tools)',
+    'la_cuisine': 'La Cuisine',
+    'flores': 'Flowers',
+    'cine_foto': 'Cinema & Photo',
+    'tablets_impressao_imagem': 'Tablets, Printing & Imaging',
+    'artigos_de_festas': 'Party Supplies',
+    'fashion_roupa_feminina': "Women's Clothing",
+    'moveis_quarto': 'Bedroom Furniture',
+    'portateis_casa_forno_e_cafe': 'Ovens & Coffee Makers',
+    'portateis_cozinha_e_preparadores_de_alimentos': 'Kitchen Appliances & Food Processors',
+    'cds_dvds_musicais': 'Music CDs & DVDs',
+    'pc_gamer': 'Gaming PCs',
+    'casa_conforto_2': 'Home Comfort 2',
+    'fashion_roupa_infanto_juvenil': "Children's Clothing",
+    'seguros_e_servicos': 'Insurance & Services',
+}
+
+TRANSLATION_TABLE = f"{ANALYTICS_SCHEMA}.category_translation"
+
+translation_ddl = f"""
+CREATE TABLE IF NOT EXISTS {TRANSLATION_TABLE} (
+    product_category_name text PRIMARY KEY,
+    category_english text NOT NULL
+);
+"""
+
+def seed_category_translations(conn):
+    """Create the translation table and upsert every known category"""
+    conn.execute(text(translation_ddl))
+    conn.execute(
+        text(f"""
+            INSERT INTO {TRANSLATION_TABLE} (product_category_name, category_english)
+            VALUES (:name, :english)
+            ON CONFLICT (product_category_name) DO UPDATE SET category_english = EXCLUDED.category_english
+        """),
+        [{"name": name, "english": english} for name, english in CATEGORY_TRANSLATIONS.items()]
+    )
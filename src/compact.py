@@ -0,0 +1,121 @@
+import argparse
+import os
+import re
+import numpy as np
+import pandas as pd
+
+# Memory-compact DataFrames for holding the Olist tables in memory:
+# - low-cardinality text (states, statuses, payment types, cities,
+#   categories) becomes categorical
+# - other text, such as the 32-character hex IDs, becomes Arrow-backed
+#   strings (one contiguous buffer instead of a Python object per value)
+# - numbers stored as text are parsed, and every numeric column is downcast
+#   to the smallest type that holds its values exactly
+# Used by load_table_to_df(..., compact=True) and execute_query(..., compact=True),
+# or for every call with COMPACT_FRAMES=1.
+
+# Text columns with at most this share of distinct values become categorical
+CATEGORY_RATIO = 0.5
+# Plain decimal numbers; a leading zero (zip code prefixes) keeps a column text
+NUMBER_PATTERN = re.compile(r'-?(0|[1-9]\d*)(\.\d+)?')
+
+def enabled():
+    return os.getenv('COMPACT_FRAMES', '').lower() in ('1', 'true', 'yes')
+
+def _is_text(series):
+    if pd.api.types.is_string_dtype(series.dtype) and series.dtype != object:
+        return True
+    if series.dtype != object:
+        return False
+    values = series.dropna()
+    return bool(len(values)) and values.map(type).eq(str).all()
+
+def downcast_numeric(series):
+    """Smallest numeric dtype that represents every value exactly.
+
+    Integral floats (integer columns with NULLs) become nullable integers;
+    other floats become float32 only if no value changes.
+    """
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return series
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return pd.to_numeric(series, downcast='integer')
+    if pd.api.types.is_float_dtype(series.dtype):
+        values = series.dropna()
+        if len(values) and np.isfinite(values).all() and (values == np.floor(values)).all() \
+                and values.abs().max() < 2 ** 53:
+            return pd.to_numeric(series.astype('Int64'), downcast='integer')
+        as_float32 = series.astype('float32')
+        if (as_float32.astype('float64') == series)[series.notna()].all():
+            return as_float32
+    return series
+
+def compact_series(series, category_ratio=CATEGORY_RATIO):
+    """Compact representation of one column (unchanged if nothing applies)"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return downcast_numeric(series)
+    if not _is_text(series):
+        return series
+
+    values = series.dropna()
+    if len(values) and values.str.fullmatch(NUMBER_PATTERN).all():
+        return downcast_numeric(pd.to_numeric(series))
+    if len(series) and series.nunique() <= category_ratio * len(series):
+        return series.astype('category')
+    if getattr(series.dtype, 'storage', None) == 'pyarrow':
+        return series
+    try:
+        return series.astype(pd.StringDtype('pyarrow'))
+    except ImportError:
+        return series
+
+def compact_frame(df, category_ratio=CATEGORY_RATIO):
+    """Copy of a DataFrame with every column in its compact representation"""
+    return pd.DataFrame({col: compact_series(df[col], category_ratio) for col in df.columns}, index=df.index)
+
+def memory_report(before, after):
+    """Per-column dtype and deep memory use before and after compaction, with a total row"""
+    mb = 1024 * 1024
+    before_bytes = before.memory_usage(deep=True, index=False)
+    after_bytes = after.memory_usage(deep=True, index=False)
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'dtype_after': after.dtypes.astype(str),
+        'mb_before': before_bytes / mb,
+        'mb_after': after_bytes / mb,
+    })
+    report.loc['total'] = ['', '', before_bytes.sum() / mb, after_bytes.sum() / mb]
+    report['ratio'] = report['mb_after'] / report['mb_before']
+    return report
+
+if __name__ == "__main__":
+    from utils import load_table_to_df
+    from typed_schema import ANALYTICS_SCHEMA, TYPED_TABLES
+
+    parser = argparse.ArgumentParser(description="Report the memory saved by compact DataFrames")
+    parser.add_argument("tables", nargs="*", default=list(TYPED_TABLES),
+                        help="Tables to load (default: the five analytics tables)")
+    parser.add_argument("--raw", action="store_true", help="Load the raw text tables instead of analytics.*")
+    parser.add_argument("--columns", action="store_true", help="Show the per-column breakdown")
+    args = parser.parse_args()
+
+    totals = []
+    for table in args.tables:
+        table_name = table if args.raw else f"{ANALYTICS_SCHEMA}.{table}"
+        df = load_table_to_df(table_name, use_copy=True, compact=False)
+        if df is None:
+            raise SystemExit(1)
+        report = memory_report(df, compact_frame(df))
+        if args.columns:
+            print(f"\n{table_name}\n{report.round(2).to_string()}")
+        totals.append((table_name, len(df), report.loc['total', 'mb_before'], report.loc['total', 'mb_after']))
+
+    print(f"\n{'Table':<28}{'Rows':>12}{'MB before':>12}{'MB after':>12}{'Ratio':>8}")
+    print("-" * 72)
+    for table_name, rows, mb_before, mb_after in totals:
+        print(f"{table_name:<28}{rows:>12,}{mb_before:>12.1f}{mb_after:>12.1f}{mb_after / mb_before:>8.2f}")
+    total_before = sum(t[2] for t in totals)
+    total_after = sum(t[3] for t in totals)
+    print(f"{'total':<28}{'':>12}{total_before:>12.1f}{total_after:>12.1f}{total_after / total_before:>8.2f}")
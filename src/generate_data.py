@@ -0,0 +1,319 @@
+import argparse
+import logging
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from typed_schema import TYPED_TABLES
+from load_data import OLIST_FILES
+from categories import CATEGORY_TRANSLATIONS
+
+logger = logging.getLogger(__name__)
+
+# Synthetic Olist data at any scale. Scale 1 matches the size of the public
+# snapshot (~99k orders); 10 and 100 give ~1M and ~10M orders. Output has
+# the columns, text formats and key relationships of schema.sql and is skewed
+# like the real data: SP-heavy customer states, a long tail of categories,
+# ~3% repeat customers and the real credit card installment mix.
+#
+# Everything is generated with numpy in chunks of customers, each chunk from
+# its own child of one SeedSequence, so a (scale, seed) pair always produces
+# byte-identical files and memory stays flat as the scale grows.
+
+BASE_ORDERS = 99441
+BASE_PRODUCTS = 32951
+BASE_SELLERS = 3095
+CHUNK_CUSTOMERS = 250000
+
+START_DATE = np.datetime64('2016-09-04T00:00:00')
+END_DATE = np.datetime64('2018-10-17T00:00:00')
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Share of customers by state
+STATE_WEIGHTS = {
+    'SP': 41.9, 'RJ': 12.9, 'MG': 11.7, 'RS': 5.5, 'PR': 5.1, 'SC': 3.7, 'BA': 3.4, 'DF': 2.2,
+    'ES': 2.0, 'GO': 2.0, 'PE': 1.7, 'CE': 1.3, 'PA': 1.0, 'MT': 0.9, 'MA': 0.7, 'MS': 0.7,
+    'PB': 0.5, 'PI': 0.5, 'RN': 0.5, 'AL': 0.4, 'SE': 0.3, 'TO': 0.3, 'RO': 0.3, 'AM': 0.15,
+    'AC': 0.08, 'AP': 0.07, 'RR': 0.05,
+}
+
+# Zip code prefix range and main city per state
+STATE_LOCATIONS = {
+    'SP': (1000, 19999, 'sao paulo'), 'RJ': (20000, 28999, 'rio de janeiro'),
+    'ES': (29000, 29999, 'vitoria'), 'MG': (30000, 39999, 'belo horizonte'),
+    'BA': (40000, 48999, 'salvador'), 'SE': (49000, 49999, 'aracaju'),
+    'PE': (50000, 56999, 'recife'), 'AL': (57000, 57999, 'maceio'),
+    'PB': (58000, 58999, 'joao pessoa'), 'RN': (59000, 59999, 'natal'),
+    'CE': (60000, 63999, 'fortaleza'), 'PI': (64000, 64999, 'teresina'),
+    'MA': (65000, 65999, 'sao luis'), 'PA': (66000, 68899, 'belem'),
+    'AP': (68900, 68999, 'macapa'), 'AM': (69000, 69299, 'manaus'),
+    'RR': (69300, 69399, 'boa vista'), 'AC': (69900, 69999, 'rio branco'),
+    'DF': (70000, 72799, 'brasilia'), 'GO': (72800, 76799, 'goiania'),
+    'RO': (76800, 76999, 'porto velho'), 'TO': (77000, 77999, 'palmas'),
+    'MT': (78000, 78899, 'cuiaba'), 'MS': (79000, 79999, 'campo grande'),
+    'PR': (80000, 87999, 'curitiba'), 'SC': (88000, 89999, 'florianopolis'),
+    'RS': (90000, 99999, 'porto alegre'),
+}
+
+# Categories in order of popularity; weights fall off as a power law so a
+# few categories dominate and most form a long tail
+CATEGORIES = list(CATEGORY_TRANSLATIONS)
+CATEGORY_EXPONENT = 0.85
+MISSING_CATEGORY_RATE = 0.0185
+
+ORDER_STATUSES = {
+    'delivered': 0.970, 'shipped': 0.011, 'canceled': 0.006, 'unavailable': 0.006,
+    'invoiced': 0.003, 'processing': 0.003, 'created': 0.0005, 'approved': 0.0005,
+}
+
+# Share of customers with more than one order, and the chance each further
+# order is their last
+REPEAT_RATE = 0.031
+REPEAT_STOP_PROBABILITY = 0.7
+
+# Probability of 1, 2, 3, ... items in an order
+ITEMS_PER_ORDER = [0.900, 0.075, 0.012, 0.008, 0.005]
+
+PAYMENT_TYPES = {'credit_card': 0.755, 'boleto': 0.197, 'voucher': 0.033, 'debit_card': 0.015}
+EXTRA_PAYMENT_RATE = 0.025
+# Credit card payments by number of installments (1..24)
+INSTALLMENT_WEIGHTS = [
+    25455, 12413, 10461, 7098, 5239, 3920, 1626, 4268, 644, 5328, 23, 133,
+    16, 15, 74, 5, 8, 27, 0, 17, 3, 0, 0, 18,
+]
+
+def _weights(values):
+    values = np.asarray(values, dtype=float)
+    return values / values.sum()
+
+def _mix(x):
+    """splitmix64 finalizer: a bijection on uint64, so distinct inputs stay distinct"""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def hex_ids(start, count, salt):
+    """32-character hex ids for entity numbers start..start+count, like Olist's"""
+    offset = _mix(np.array([salt], dtype=np.uint64))
+    low = _mix(np.arange(start, start + count, dtype=np.uint64) + offset)
+    pairs = np.stack([_mix(low ^ offset), low], axis=1)
+    hex_text = pairs.astype('>u8').tobytes().hex()
+    return np.frombuffer(hex_text.encode('ascii'), dtype='S32').astype('U32')
+
+def _random_timestamps(rng, count):
+    # Density grows linearly over the period, like Olist's order volume
+    span = (END_DATE - START_DATE).astype('timedelta64[s]').astype(np.int64)
+    offsets = (np.sqrt(rng.random(count)) * span).astype(np.int64)
+    return START_DATE + offsets.astype('timedelta64[s]')
+
+def _hours(rng, mean_hours, count):
+    return (rng.exponential(mean_hours * 3600, count)).astype(np.int64).astype('timedelta64[s]')
+
+def generate_products(scale=1.0, seed=0):
+    """Products and the seller of each product"""
+    rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(1)[0])
+    count = max(int(BASE_PRODUCTS * scale), len(CATEGORIES))
+    sellers = hex_ids(0, max(int(BASE_SELLERS * scale), 1), salt=seed * 16 + 5)
+
+    category_weights = _weights(1 / np.arange(1, len(CATEGORIES) + 1) ** CATEGORY_EXPONENT)
+    categories = np.array(CATEGORIES, dtype=object)[rng.choice(len(CATEGORIES), count, p=category_weights)]
+    missing = rng.random(count) < MISSING_CATEGORY_RATE
+    categories[missing] = None
+
+    def measure(low, high, mean, sigma):
+        return pd.array(np.clip(rng.lognormal(mean, sigma, count), low, high).astype(int), dtype='Int64')
+
+    products = pd.DataFrame({
+        'product_id': hex_ids(0, count, salt=seed * 16 + 4),
+        'product_category_name': categories,
+        'product_name_length': measure(5, 76, 3.9, 0.2),
+        'product_description_length': measure(4, 3992, 6.4, 0.7),
+        'product_photos_qty': pd.array(np.minimum(rng.geometric(0.55, count), 20), dtype='Int64'),
+        'product_weight_g': measure(1, 40425, 6.5, 1.2),
+        'product_length_cm': measure(7, 105, 3.3, 0.45),
+        'product_height_cm': measure(2, 105, 2.6, 0.65),
+        'product_width_cm': measure(6, 118, 3.0, 0.45),
+    })
+    # Products without a category also lack the listing attributes, as in Olist
+    for column in ('product_name_length', 'product_description_length', 'product_photos_qty'):
+        products.loc[missing, column] = pd.NA
+
+    # Popularity is skewed too: a few best sellers, many products bought once
+    popularity = _weights(1 / rng.permutation(np.arange(1, count + 1)) ** 0.6)
+    seller_of_product = sellers[rng.choice(len(sellers), count, p=_weights(1 / np.arange(1, len(sellers) + 1)))]
+    return products, popularity, seller_of_product
+
+def generate_chunk(rng, first_customer, customers, first_order, products, popularity, seller_of_product, seed):
+    """Customers, orders, items and payments for one block of unique customers"""
+    states = np.array(list(STATE_WEIGHTS))
+    state_index = rng.choice(len(states), customers, p=_weights(list(STATE_WEIGHTS.values())))
+    low = np.array([STATE_LOCATIONS[s][0] for s in states])[state_index]
+    high = np.array([STATE_LOCATIONS[s][1] for s in states])[state_index]
+    zip_prefix = np.char.zfill((low + (rng.random(customers) * (high - low + 1)).astype(int)).astype(str), 5)
+    unique_ids = hex_ids(first_customer, customers, salt=seed * 16 + 1)
+
+    # Orders per unique customer: one, or a geometric number of repeats
+    repeats = np.where(rng.random(customers) < REPEAT_RATE, rng.geometric(REPEAT_STOP_PROBABILITY, customers), 0)
+    owner = np.repeat(np.arange(customers), 1 + repeats)
+    order_count = len(owner)
+
+    # Olist issues a new customer_id for every order
+    customer_ids = hex_ids(first_order, order_count, salt=seed * 16 + 2)
+    customers_df = pd.DataFrame({
+        'customer_id': customer_ids,
+        'customer_unique_id': unique_ids[owner],
+        'customer_zip_code_prefix': zip_prefix[owner],
+        'customer_city': np.array([STATE_LOCATIONS[s][2] for s in states])[state_index][owner],
+        'customer_state': states[state_index][owner],
+    })
+
+    order_ids = hex_ids(first_order, order_count, salt=seed * 16 + 3)
+    status = np.array(list(ORDER_STATUSES))[rng.choice(len(ORDER_STATUSES), order_count,
+                                                       p=_weights(list(ORDER_STATUSES.values())))]
+    purchased = _random_timestamps(rng, order_count)
+    approved = purchased + _hours(rng, 10, order_count)
+    carrier = approved + _hours(rng, 70, order_count)
+    delivered = carrier + _hours(rng, 220, order_count)
+    estimated = (purchased + np.timedelta64(10, 'D') + rng.integers(5, 40, order_count).astype('timedelta64[D]'))
+    estimated = estimated.astype('datetime64[D]').astype('datetime64[s]')
+    orders_df = pd.DataFrame({
+        'order_id': order_ids,
+        'customer_id': customer_ids,
+        'order_status': status,
+        'order_purchase_timestamp': purchased,
+        'order_approved_at': approved,
+        'order_delivered_carrier_date': carrier,
+        'order_delivered_customer_date': delivered,
+        'order_estimated_delivery_date': estimated,
+    })
+    not_delivered = status != 'delivered'
+    orders_df.loc[not_delivered, 'order_delivered_customer_date'] = pd.NaT
+    orders_df.loc[np.isin(status, ['canceled', 'unavailable', 'invoiced', 'processing', 'created', 'approved']),
+                  'order_delivered_carrier_date'] = pd.NaT
+    orders_df.loc[np.isin(status, ['created']), 'order_approved_at'] = pd.NaT
+
+    # Items: mostly one per order; Olist lists orders without items as unavailable
+    item_counts = rng.choice(np.arange(1, len(ITEMS_PER_ORDER) + 1), order_count, p=_weights(ITEMS_PER_ORDER))
+    item_counts[status == 'unavailable'] = 0
+    item_order = np.repeat(np.arange(order_count), item_counts)
+    item_number = np.arange(len(item_order)) - np.repeat(np.cumsum(item_counts) - item_counts, item_counts) + 1
+    product_index = rng.choice(len(products), len(item_order), p=popularity)
+    price = np.round(np.clip(rng.lognormal(4.4, 0.85, len(item_order)), 0.85, 6735.0), 2)
+    freight = np.round(np.clip(rng.lognormal(2.8, 0.5, len(item_order)), 0.0, 409.68), 2)
+    items_df = pd.DataFrame({
+        'order_id': order_ids[item_order],
+        'order_item_id': item_number,
+        'product_id': products['product_id'].to_numpy()[product_index],
+        'seller_id': seller_of_product[product_index],
+        'shipping_limit_date': purchased[item_order] + np.timedelta64(6, 'D'),
+        'price': price,
+        'freight_value': freight,
+    })
+
+    # Payments add up to the order total; a few orders add voucher payments
+    totals = np.bincount(item_order, weights=price + freight, minlength=order_count)
+    totals = np.where(totals > 0, totals, np.round(rng.lognormal(4.7, 0.8, order_count), 2))
+    extra = np.where(rng.random(order_count) < EXTRA_PAYMENT_RATE, rng.geometric(0.5, order_count), 0)
+    payment_order = np.repeat(np.arange(order_count), 1 + extra)
+    sequential = np.arange(len(payment_order)) - np.repeat(np.cumsum(1 + extra) - (1 + extra), 1 + extra) + 1
+    main_type = np.array(list(PAYMENT_TYPES))[rng.choice(len(PAYMENT_TYPES), order_count,
+                                                         p=_weights(list(PAYMENT_TYPES.values())))]
+    payment_type = np.where(sequential == 1, main_type[payment_order], 'voucher')
+
+    share = rng.random(len(payment_order)) + 0.1
+    share = share / np.bincount(payment_order, weights=share)[payment_order]
+    value = np.round(totals[payment_order] * share, 2)
+    # Put the rounding remainder on the first payment so the total is exact
+    remainder = np.round(totals - np.bincount(payment_order, weights=value, minlength=order_count), 2)
+    value[sequential == 1] += remainder
+    value = np.round(value, 2)
+
+    installments = np.ones(len(payment_order), dtype=int)
+    is_card = payment_type == 'credit_card'
+    installments[is_card] = rng.choice(np.arange(1, len(INSTALLMENT_WEIGHTS) + 1), is_card.sum(),
+                                       p=_weights(INSTALLMENT_WEIGHTS))
+    # Stores set a minimum installment amount, so small baskets pay in fewer
+    installments = np.maximum(np.minimum(installments, (value // 20).astype(int)), 1)
+    payments_df = pd.DataFrame({
+        'order_id': order_ids[payment_order],
+        'payment_sequential': sequential,
+        'payment_type': payment_type,
+        'payment_installments': installments,
+        'payment_value': value,
+    })
+
+    return {
+        'customers': customers_df,
+        'orders': orders_df,
+        'order_items': items_df,
+        'order_payments': payments_df,
+    }
+
+def iter_chunks(scale=1.0, seed=0, chunk_customers=CHUNK_CUSTOMERS):
+    """Yield dicts of table -> DataFrame; products come with the first chunk"""
+    expected_orders = 1 + REPEAT_RATE / REPEAT_STOP_PROBABILITY
+    total_customers = max(int(BASE_ORDERS * scale / expected_orders), 1)
+    products, popularity, seller_of_product = generate_products(scale, seed)
+
+    chunk_seeds = np.random.SeedSequence(seed).spawn(2 + total_customers // chunk_customers)[1:]
+    first_order = 0
+    for chunk, first_customer in enumerate(range(0, total_customers, chunk_customers)):
+        customers = min(chunk_customers, total_customers - first_customer)
+        tables = generate_chunk(np.random.default_rng(chunk_seeds[chunk]), first_customer, customers,
+                                first_order, products, popularity, seller_of_product, seed)
+        first_order += len(tables['orders'])
+        if chunk == 0:
+            tables['products'] = products
+        yield tables
+
+def generate_tables(scale=1.0, seed=0):
+    """All five tables in memory, with typed columns (for the in-process paths)"""
+    parts = {table: [] for table in TYPED_TABLES}
+    for tables in iter_chunks(scale, seed):
+        for table, df in tables.items():
+            parts[table].append(df)
+    return {table: pd.concat(frames, ignore_index=True) for table, frames in parts.items()}
+
+def write_csvs(output_dir, scale=1.0, seed=0):
+    """Write the five Olist CSV files (named as in load_data.OLIST_FILES).
+
+    Columns follow schema.sql, timestamps use Olist's text format and missing
+    values are empty fields, so the files load with `python load_data.py`.
+    Returns rows written per table.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rows = {table: 0 for table in OLIST_FILES}
+    for table in OLIST_FILES:
+        path = os.path.join(output_dir, OLIST_FILES[table])
+        if os.path.exists(path):
+            os.remove(path)
+
+    for tables in iter_chunks(scale, seed):
+        for table, df in tables.items():
+            path = os.path.join(output_dir, OLIST_FILES[table])
+            df[list(TYPED_TABLES[table])].to_csv(path, mode='a', index=False, header=rows[table] == 0,
+                                                 date_format=TIMESTAMP_FORMAT, float_format='%.2f')
+            rows[table] += len(df)
+        logger.info(f"Generated {rows['orders']:,} orders")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic Olist CSV files at a given scale")
+    parser.add_argument("output_dir", help="Directory to write the olist_*_dataset.csv files to")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Size relative to the public Olist data (1 = ~99k orders)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (same seed, same files)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        rows = write_csvs(args.output_dir, args.scale, args.seed)
+    except Exception as e:
+        logger.error(f"Error generating data: {str(e)}")
+        sys.exit(1)
+
+    for table, count in rows.items():
+        print(f"{table:<16}{count:>14,}")
+    print(f"\nWrote {args.output_dir} in {time.perf_counter() - start:.1f}s")
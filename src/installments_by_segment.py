@@ -1,63 +1,92 @@
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from utils import execute_query
+from utils import bind_literals, execute_query
+from payment_facts import PAYMENT_FACTS_TABLE, payment_types_sql
+from rfm import build_rfm_segments_query
+from sampling import ratio_estimate, sample_predicate, total_estimate, with_interval
+from typed_schema import purchase_window_sql
+
+def state_condition(states, column='customer_state'):
+    """SQL condition keeping the customers of the given states"""
+    return bind_literals(f"{column} = ANY(string_to_array(:states, ','))", {'states': ','.join(states)})
 
 # Query to get metrics
+# Segments come from the shared RFM layer (see rfm.py) and payments from the
+# per-order payment facts (see payment_facts.py). Customers are matched on
+# (customer_unique_id, customer_state) and each order joins one fact row, so
+# no row is duplicated: averages are per payment and per customer as stated.
+def build_query(start=None, end=None, states=None):
+    """Segment metrics over all history, or with a date range over the
+    orders purchased in [start, end), with RFM scored on those orders.
+    `states` limits the metrics to the customers of those states; RFM is
+    still scored over every state, so segments mean the same everywhere.
 
-query = """
-WITH last_date AS (
-    SELECT MAX(order_purchase_timestamp::timestamp) as max_date 
-    FROM orders
-), 
-customer_rfm AS (
-    SELECT 
+    RFM scored in the query has no statistics, so the windowed form totals
+    payments per customer before joining them to the segments; joining
+    orders to it directly misestimates the join into a nested loop.
+    """
+    if start is None and end is None:
+        segments_cte, segments = "", "rfm_segments"
+        payments = f"""{segments} cs
+    JOIN analytics.customers c
+        ON c.customer_unique_id = cs.customer_unique_id AND c.customer_state = cs.customer_state
+    JOIN analytics.orders o ON c.customer_id = o.customer_id
+    JOIN {PAYMENT_FACTS_TABLE} f ON f.order_id = o.order_id"""
+    else:
+        segments_cte = f"""windowed_rfm AS ({build_rfm_segments_query(start=start, end=end)}),
+customer_payments AS (
+    SELECT
         c.customer_unique_id,
         c.customer_state,
-        EXTRACT(DAYS FROM (
-            (SELECT max_date FROM last_date) - MAX(o.order_purchase_timestamp::timestamp)
-        )) as recency,
-        COUNT(DISTINCT o.order_id) as frequency,
-        SUM(CAST(oi.price AS DECIMAL) + CAST(oi.freight_value AS DECIMAL))::DECIMAL(10,2) as monetary
-    FROM customers c
-    JOIN orders o ON c.customer_id = o.customer_id
-    JOIN order_items oi ON o.order_id = oi.order_id
-    WHERE o.order_status = 'delivered'
+        SUM(f.installments_sum) as installments_sum,
+        SUM(f.payment_count) as payment_count,
+        SUM(f.payment_value) as payment_value,
+        BIT_OR(f.payment_type_mask) as payment_type_mask
+    FROM analytics.customers c
+    JOIN analytics.orders o ON c.customer_id = o.customer_id
+    JOIN {PAYMENT_FACTS_TABLE} f ON f.order_id = o.order_id{purchase_window_sql(['o'], start, end, keyword='WHERE', indent=4)}
     GROUP BY c.customer_unique_id, c.customer_state
 ),
-rfm_scores AS (
-    SELECT *,
-        NTILE(5) OVER (ORDER BY recency DESC) as R,
-        NTILE(5) OVER (ORDER BY frequency) as F,
-        NTILE(5) OVER (ORDER BY monetary) as M
-    FROM customer_rfm
+"""
+        segments = "windowed_rfm"
+        payments = f"""{segments} cs
+    JOIN customer_payments f
+        ON f.customer_unique_id = cs.customer_unique_id AND f.customer_state = cs.customer_state"""
+    if states is not None:
+        segments += f"\n    WHERE {state_condition(states)}"
+        payments += f"\n    WHERE {state_condition(states, 'cs.customer_state')}"
+    return f"""
+WITH {segments_cte}segment_customers AS (
+    SELECT
+        customer_segment,
+        COUNT(*) as customer_count,
+        AVG(monetary) as avg_total_spend
+    FROM {segments}
+    GROUP BY customer_segment
 ),
-customer_segments AS (
-    SELECT *,
-        CASE 
-            WHEN (R >= 4 AND F >= 4 AND M >= 4) THEN 'Champions'
-            WHEN (R >= 3 AND F >= 3 AND M >= 3) THEN 'Loyal Customers'
-            WHEN (R <= 2 AND F >= 3 AND M >= 3) THEN 'At Risk'
-            WHEN (R <= 2 AND F <= 2 AND M <= 2) THEN 'Lost'
-            ELSE 'Others'
-        END as customer_segment
-    FROM rfm_scores
+segment_payments AS (
+    SELECT
+        cs.customer_segment,
+        SUM(f.installments_sum) as installments_sum,
+        SUM(f.payment_count) as payment_count,
+        SUM(f.payment_value) as payment_value,
+        BIT_OR(f.payment_type_mask) as payment_type_mask
+    FROM {payments}
+    GROUP BY cs.customer_segment
 )
 SELECT 
-    cs.customer_segment,
-    ROUND(AVG(CAST(NULLIF(op.payment_installments, '') AS DECIMAL)), 2) as avg_installments,
-    COUNT(DISTINCT cs.customer_unique_id) as customer_count,
-    ROUND(AVG(cs.monetary), 2) as avg_total_spend,
-    ROUND(AVG(CAST(NULLIF(op.payment_value, '') AS DECIMAL)), 2) as avg_payment_value,
-    STRING_AGG(DISTINCT op.payment_type, ', ') as payment_types
-FROM customer_segments cs
-JOIN customers c ON cs.customer_unique_id = c.customer_unique_id
-JOIN orders o ON c.customer_id = o.customer_id
-JOIN order_payments op ON o.order_id = op.order_id
-GROUP BY cs.customer_segment
+    sc.customer_segment,
+    ROUND(sp.installments_sum::numeric / sp.payment_count, 2) as avg_installments,
+    sc.customer_count,
+    ROUND(sc.avg_total_spend, 2) as avg_total_spend,
+    ROUND(sp.payment_value / sp.payment_count, 2) as avg_payment_value,
+    {payment_types_sql('sp.payment_type_mask')} as payment_types
+FROM segment_customers sc
+JOIN segment_payments sp ON sp.customer_segment = sc.customer_segment
 ORDER BY avg_total_spend DESC;
 """
 
+query = build_query()
+
 def hex_to_rgb(hex_color):
     """Convert hex color to RGB tuple"""
     hex_color = hex_color.lstrip('#')
@@ -74,87 +103,177 @@ def get_gradient_color(position, num_bars, start_color, end_color):
         for start, end in zip(start_rgb, end_rgb)
     )
 
+def build_sampled_query(fraction, start=None, end=None, states=None):
+    """Per-segment sums over a customer sample, for ratio estimates.
+
+    Each sampled customer contributes its payment count (m), installment
+    and payment value sums and monetary value, plus their squares and cross
+    products with m (see sampling.ratio_estimate). As in build_query,
+    payments are totalled per customer before joining the RFM scored in the
+    query, which would otherwise probe orders once per sampled customer.
+    """
+    state_filter = ""
+    if states is not None:
+        state_filter = f"\n    WHERE {state_condition(states, 'cs.customer_state')}"
+    return f"""
+WITH sampled_rfm AS ({build_rfm_segments_query(sample_predicate(fraction, ['c', 'o', 'oi']), start, end)}),
+sampled_payments AS (
+    SELECT
+        c.customer_unique_id,
+        c.customer_state,
+        COALESCE(SUM(f.payment_count), 0)::numeric as m,
+        COALESCE(SUM(f.installments_sum), 0)::numeric as installments,
+        COALESCE(SUM(f.payment_value), 0) as payment_value,
+        BIT_OR(f.payment_type_mask) as payment_type_mask
+    FROM analytics.customers c
+    JOIN analytics.orders o ON c.customer_id = o.customer_id
+    LEFT JOIN {PAYMENT_FACTS_TABLE} f ON f.order_id = o.order_id
+    WHERE {sample_predicate(fraction, ['c', 'o'])}{purchase_window_sql(['o'], start, end, indent=4)}
+    GROUP BY c.customer_unique_id, c.customer_state
+),
+customer_payments AS (
+    SELECT cs.customer_segment, cs.monetary, p.m, p.installments, p.payment_value, p.payment_type_mask
+    FROM sampled_rfm cs
+    JOIN sampled_payments p
+        ON p.customer_unique_id = cs.customer_unique_id AND p.customer_state = cs.customer_state{state_filter}
+)
+SELECT
+    customer_segment,
+    COUNT(*) as n,
+    SUM(m) as m, SUM(m * m) as m_sq,
+    SUM(installments) as installments, SUM(installments * installments) as installments_sq,
+    SUM(installments * m) as installments_m,
+    SUM(payment_value) as payment_value, SUM(payment_value * payment_value) as payment_value_sq,
+    SUM(payment_value * m) as payment_value_m,
+    SUM(monetary) as spend, SUM(monetary * monetary) as spend_sq,
+    {payment_types_sql('BIT_OR(payment_type_mask)')} as payment_types
+FROM customer_payments
+GROUP BY customer_segment;
+"""
+
+def get_segment_data(engine=None, sample=None, start=None, end=None, states=None):
+    """Fetch installment and spend metrics per customer segment.
+
+    With `sample` set to a fraction, the metrics are estimated from that
+    share of customers: averages are ratio estimates and customer_count is
+    scaled up, each with _ci_low/_ci_high bounds. `start`/`end` limit the
+    metrics to orders purchased in that range (end exclusive), with RFM
+    scored on those orders, and `states` to the customers of those states.
+    """
+    if sample is None:
+        return execute_query(build_query(start, end, states), engine)
+
+    df = execute_query(build_sampled_query(sample, start, end, states), engine)
+    if df is None:
+        return None
+    for column, name in [('installments', 'avg_installments'), ('payment_value', 'avg_payment_value')]:
+        estimate, half_width = ratio_estimate(df[column], df['m'], df[f"{column}_sq"], df['m_sq'],
+                                              df[f"{column}_m"], df['n'], sample)
+        df = with_interval(df, name, estimate, half_width, digits=2)
+    # Spend is a per-customer mean: a ratio with one unit per customer
+    estimate, half_width = ratio_estimate(df['spend'], df['n'], df['spend_sq'], df['n'], df['spend'],
+                                          df['n'], sample)
+    df = with_interval(df, 'avg_total_spend', estimate, half_width, digits=2)
+    sampled = df['n'].astype(float)
+    estimate, half_width = total_estimate(sampled, sampled, sample)
+    df = with_interval(df, 'customer_count', estimate, half_width, digits=0)
+    columns = [col for col in df.columns
+               if col.startswith(('customer_segment', 'avg_', 'customer_count', 'payment_types'))]
+    return df[columns].sort_values('avg_total_spend', ascending=False).reset_index(drop=True)
+
+def plot_segment_analysis(df):
+    """Create the installments/spend figure for the segment data and return it"""
+    import matplotlib.pyplot as plt
+
+    # Create figure and axis objects with subplots()
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 12))
+    
+    # Generate colors for plots
+    num_segments = len(df)
+    blue_colors = [get_gradient_color(i, num_segments, '#2E5894', '#94BBD9') 
+                  for i in range(num_segments)]
+    
+    # Plot 1: Bar chart for average installments with blue gradient
+    bar_width = 0.6
+    x = range(len(df['customer_segment']))
+    bars1 = ax1.bar(x, df['avg_installments'], bar_width, color=blue_colors)
+    ax1.set_ylabel('Average Installments')
+    ax1.set_title('Average Installments by Customer Segment', pad=-23, y=1.02)
+    ax1.set_xticks(x)
+    ax1.set_xticklabels(df['customer_segment'], rotation=0)
+    
+    # Add value labels on bars
+    for bar in bars1:
+        height = bar.get_height()
+        ax1.text(bar.get_x() + bar.get_width()/2., height,
+                f'{height:.1f}',
+                ha='center', va='bottom')
+    
+    # Add padding to y-axis limits
+    y_max = df['avg_installments'].max()
+    ax1.set_ylim(0, y_max * 1.2)
+    
+    # Plot 2: Bar chart for average spend with light gray
+    bars2 = ax2.bar(x, df['avg_total_spend'], bar_width, color='#CACACA')
+    
+    # Add customer count as text on top of bars
+    for i, bar in enumerate(bars2):
+        height = bar.get_height()
+        ax2.text(bar.get_x() + bar.get_width()/2., height,
+                f'R${height:,.2f}\n(n={df["customer_count"].iloc[i]:,})',
+                ha='center', va='bottom')
+    
+    ax2.set_ylabel('Average Total Spend (R$)')
+    ax2.set_title('Average Spend by Customer Segment (with customer count)', pad=-23, y=1.02)
+    ax2.set_xticks(x)
+    ax2.set_xticklabels(df['customer_segment'], rotation=0)
+    
+    # Add padding to second plot y-axis
+    y_max2 = df['avg_total_spend'].max()
+    ax2.set_ylim(0, y_max2 * 1.2)
+    
+    # Remove top and right spines
+    ax1.spines['top'].set_visible(False)
+    ax1.spines['right'].set_visible(False)
+    ax2.spines['top'].set_visible(False)
+    ax2.spines['right'].set_visible(False)
+    
+    # Add grid lines
+    ax1.grid(True, axis='y', linestyle='--', alpha=0.3, zorder=0)
+    ax2.grid(True, axis='y', linestyle='--', alpha=0.3, zorder=0)
+    
+    # Adjust layout
+    plt.tight_layout()
+    return fig
+
+def print_segment_analysis(df):
+    """Print the detailed per-segment breakdown"""
+    print("\nDetailed Segment Analysis:")
+    print("-" * 80)
+    for _, row in df.iterrows():
+        print(f"\nSegment: {row['customer_segment']}")
+        print(f"Number of Customers: {row['customer_count']:,}")
+        print(f"Average Installments: {row['avg_installments']:.1f}")
+        print(f"Average Total Spend: R${row['avg_total_spend']:,.2f}")
+        print(f"Average Payment Value: R${row['avg_payment_value']:,.2f}")
+        print(f"Payment Types Used: {row['payment_types']}")
+        print("-" * 40)
+
 def create_segment_analysis():
     try:
         # Execute query
-        df = execute_query(query)
+        df = get_segment_data()
         
         if df is None or df.empty:
-            print("No data retrieved from the database!")
+            print("No data retrieved from the database! Has `python rfm.py refresh` been run?")
             return
             
-        # Create figure and axis objects with subplots()
-        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 12))
-        
-        # Generate colors for plots
-        num_segments = len(df)
-        blue_colors = [get_gradient_color(i, num_segments, '#2E5894', '#94BBD9') 
-                      for i in range(num_segments)]
-        
-        # Plot 1: Bar chart for average installments with blue gradient
-        bar_width = 0.6
-        x = range(len(df['customer_segment']))
-        bars1 = ax1.bar(x, df['avg_installments'], bar_width, color=blue_colors)
-        ax1.set_ylabel('Average Installments')
-        ax1.set_title('Average Installments by Customer Segment', pad=-23, y=1.02)
-        ax1.set_xticks(x)
-        ax1.set_xticklabels(df['customer_segment'], rotation=0)
-        
-        # Add value labels on bars
-        for bar in bars1:
-            height = bar.get_height()
-            ax1.text(bar.get_x() + bar.get_width()/2., height,
-                    f'{height:.1f}',
-                    ha='center', va='bottom')
-        
-        # Add padding to y-axis limits
-        y_max = df['avg_installments'].max()
-        ax1.set_ylim(0, y_max * 1.2)
-        
-        # Plot 2: Bar chart for average spend with light gray
-        bars2 = ax2.bar(x, df['avg_total_spend'], bar_width, color='#CACACA')
-        
-        # Add customer count as text on top of bars
-        for i, bar in enumerate(bars2):
-            height = bar.get_height()
-            ax2.text(bar.get_x() + bar.get_width()/2., height,
-                    f'R${height:,.2f}\n(n={df["customer_count"].iloc[i]:,})',
-                    ha='center', va='bottom')
-        
-        ax2.set_ylabel('Average Total Spend (R$)')
-        ax2.set_title('Average Spend by Customer Segment (with customer count)', pad=-23, y=1.02)
-        ax2.set_xticks(x)
-        ax2.set_xticklabels(df['customer_segment'], rotation=0)
-        
-        # Add padding to second plot y-axis
-        y_max2 = df['avg_total_spend'].max()
-        ax2.set_ylim(0, y_max2 * 1.2)
-        
-        # Remove top and right spines
-        ax1.spines['top'].set_visible(False)
-        ax1.spines['right'].set_visible(False)
-        ax2.spines['top'].set_visible(False)
-        ax2.spines['right'].set_visible(False)
-        
-        # Add grid lines
-        ax1.grid(True, axis='y', linestyle='--', alpha=0.3, zorder=0)
-        ax2.grid(True, axis='y', linestyle='--', alpha=0.3, zorder=0)
-        
-        # Adjust layout
-        plt.tight_layout()
+        import matplotlib.pyplot as plt
+
+        plot_segment_analysis(df)
         plt.show()
         
-        # Print detailed analysis
-        print("\nDetailed Segment Analysis:")
-        print("-" * 80)
-        for _, row in df.iterrows():
-            print(f"\nSegment: {row['customer_segment']}")
-            print(f"Number of Customers: {row['customer_count']:,}")
-            print(f"Average Installments: {row['avg_installments']:.1f}")
-            print(f"Average Total Spend: R${row['avg_total_spend']:,.2f}")
-            print(f"Average Payment Value: R${row['avg_payment_value']:,.2f}")
-            print(f"Payment Types Used: {row['payment_types']}")
-            print("-" * 40)
+        print_segment_analysis(df)
             
     except Exception as e:
         print(f"An error occurred: {str(e)}")
@@ -0,0 +1,175 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from utils import get_db_connection
+from typed_schema import TYPED_TABLES
+from schema_keys import PRIMARY_KEYS, drop_key_statements, foreign_key_statements, index_statements
+
+logger = logging.getLogger(__name__)
+
+# File names as published in the Olist Kaggle dataset
+OLIST_FILES = {
+    'customers': 'olist_customers_dataset.csv',
+    'orders': 'olist_orders_dataset.csv',
+    'order_items': 'olist_order_items_dataset.csv',
+    'order_payments': 'olist_order_payments_dataset.csv',
+    'products': 'olist_products_dataset.csv',
+}
+
+# Appends must respect the foreign keys, so parents are loaded before children
+LOAD_WAVES = [
+    ['customers', 'products'],
+    ['orders'],
+    ['order_items', 'order_payments'],
+]
+
+def create_raw_tables(engine):
+    """Create any missing raw tables with the all-text layout of schema.sql"""
+    with engine.begin() as conn:
+        for table, columns in TYPED_TABLES.items():
+            column_defs = ", ".join(f"{col} text" for col in columns)
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS public.{table} ({column_defs})"))
+
+def copy_file(engine, table, path, append):
+    """COPY one CSV file into its table on a dedicated connection.
+
+    Full loads copy straight into the (truncated, key-less) table. Appends
+    copy into a temporary staging table and insert from there, skipping
+    rows whose primary key is already present.
+    """
+    columns = ", ".join(TYPED_TABLES[table])
+    start = time.perf_counter()
+    raw_conn = engine.raw_connection()
+    try:
+        cursor = raw_conn.cursor()
+        target = f"public.{table}"
+        if append:
+            target = f"{table}_stage"
+            cursor.execute(f"CREATE TEMP TABLE {target} (LIKE public.{table}) ON COMMIT DROP")
+
+        with open(path, 'r', encoding='utf-8') as f:
+            cursor.copy_expert(f"COPY {target} ({columns}) FROM STDIN WITH (FORMAT csv, HEADER true)", f)
+        copied = cursor.rowcount
+
+        inserted = copied
+        if append:
+            cursor.execute(f"INSERT INTO public.{table} ({columns}) "
+                           f"SELECT {columns} FROM {target} ON CONFLICT DO NOTHING")
+            inserted = cursor.rowcount
+        raw_conn.commit()
+        cursor.close()
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+    seconds = time.perf_counter() - start
+    size_mb = os.path.getsize(path) / (1024 * 1024)
+    return {
+        'table': table,
+        'rows': copied,
+        'inserted': inserted,
+        'seconds': seconds,
+        'rows_per_sec': copied / seconds if seconds else 0,
+        'mb_per_sec': size_mb / seconds if seconds else 0,
+    }
+
+def build_keys(engine, table):
+    """Primary key and indexes for one table (foreign keys are added afterwards)"""
+    with engine.begin() as conn:
+        for statement in index_statements('public', [table]):
+            conn.execute(text(statement))
+
+def load_olist_csvs(csv_dir, append=False, workers=len(OLIST_FILES), engine=None):
+    """Load the five Olist CSV files into the raw tables concurrently.
+
+    Full loads truncate the tables, drop keys and indexes, copy all files in
+    parallel and then rebuild keys and run ANALYZE. Appends keep the keys and
+    only add rows not already present. Returns per-table throughput stats.
+    """
+    if engine is None:
+        engine = get_db_connection()
+
+    if engine is None:
+        raise Exception("Failed to establish database connection")
+
+    paths = {table: os.path.join(csv_dir, name) for table, name in OLIST_FILES.items()}
+    missing = [path for path in paths.values() if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Missing Olist files: {', '.join(missing)}")
+
+    create_raw_tables(engine)
+    results = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if append:
+            for wave in LOAD_WAVES:
+                results.extend(pool.map(lambda t: copy_file(engine, t, paths[t], True), wave))
+        else:
+            with engine.begin() as conn:
+                for statement in drop_key_statements('public'):
+                    conn.execute(text(statement))
+                conn.execute(text(f"TRUNCATE {', '.join(f'public.{t}' for t in OLIST_FILES)}"))
+            results.extend(pool.map(lambda t: copy_file(engine, t, paths[t], False), OLIST_FILES))
+
+            # Deferred until after the load: index builds run in parallel per
+            # table, then the foreign keys are validated in one pass
+            start = time.perf_counter()
+            list(pool.map(lambda t: build_keys(engine, t), PRIMARY_KEYS))
+            with engine.begin() as conn:
+                for statement in foreign_key_statements('public'):
+                    conn.execute(text(statement))
+            logger.info(f"Built keys and indexes in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        for table in OLIST_FILES:
+            conn.execute(text(f"ANALYZE public.{table}"))
+    logger.info(f"Analyzed tables in {time.perf_counter() - start:.2f}s")
+
+    return results
+
+def print_results(results, total_seconds):
+    print(f"\n{'Table':<16}{'Rows':>12}{'Inserted':>12}{'Seconds':>10}{'Rows/sec':>14}{'MB/sec':>10}")
+    print("-" * 74)
+    for r in results:
+        print(f"{r['table']:<16}{r['rows']:>12,}{r['inserted']:>12,}{r['seconds']:>10.2f}"
+              f"{r['rows_per_sec']:>14,.0f}{r['mb_per_sec']:>10.1f}")
+    print(f"\nTotal time: {total_seconds:.2f}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load the Olist CSV files with COPY")
+    parser.add_argument("csv_dir", help="Directory containing the olist_*_dataset.csv files")
+    parser.add_argument("--append", action="store_true",
+                        help="Add new rows (e.g. a monthly drop) instead of replacing the tables")
+    parser.add_argument("--workers", type=int, default=len(OLIST_FILES),
+                        help="Concurrent COPY connections (default: one per table)")
+    parser.add_argument("--build", action="store_true",
+                        help="Rebuild the typed schema, the RFM layer and the purchase intervals after loading")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        results = load_olist_csvs(args.csv_dir, args.append, args.workers)
+    except Exception as e:
+        logger.error(f"Error loading Olist data: {str(e)}")
+        sys.exit(1)
+    print_results(results, time.perf_counter() - start)
+
+    if args.build:
+        from typed_schema import build_typed_schema, print_report
+        from rfm import refresh_rfm_segments
+        from purchase_intervals import refresh_purchase_intervals
+
+        report = build_typed_schema()
+        # A monthly drop only needs its new orders folded into the RFM state
+        # and appended to the purchase intervals
+        if (report is None or not refresh_rfm_segments(incremental=args.append)
+                or not refresh_purchase_intervals(incremental=args.append)):
+            sys.exit(1)
+        print_report(report)
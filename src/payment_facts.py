@@ -0,0 +1,157 @@
+import argparse
+import logging
+import time
+from sqlalchemy import text
+from typed_schema import ANALYTICS_SCHEMA
+from query_cache import track_changes
+from utils import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+# Per-order payment facts: one row per order with its payment count, total
+# value, installment sum and maximum, and the payment types used as a
+# bitmask. Analyses join orders to this table one-to-one instead of to
+# order_payments, so nothing fans out and no DISTINCT is needed. Rebuilt by
+# the typed build and kept in sync afterwards by statement-level triggers on
+# analytics.order_payments that recompute the orders they touched.
+PAYMENT_FACTS_TABLE = f"{ANALYTICS_SCHEMA}.order_payment_facts"
+
+# Bit per payment type in payment_type_mask; anything else sets OTHER_PAYMENT_BIT
+PAYMENT_TYPE_BITS = {
+    'credit_card': 1,
+    'boleto': 2,
+    'voucher': 4,
+    'debit_card': 8,
+    'not_defined': 16,
+}
+OTHER_PAYMENT_BIT = 32
+
+def payment_type_bit_sql(column):
+    """SQL expression for the bit of one payment type"""
+    cases = " ".join(f"WHEN '{name}' THEN {bit}" for name, bit in PAYMENT_TYPE_BITS.items())
+    return f"CASE {column} {cases} ELSE {OTHER_PAYMENT_BIT} END"
+
+def payment_types_sql(mask):
+    """SQL expression listing the payment types in a mask, e.g. 'boleto, credit_card'"""
+    values = ", ".join(f"({bit}, '{name}')" for name, bit in PAYMENT_TYPE_BITS.items())
+    return (f"(SELECT STRING_AGG(name, ', ' ORDER BY name) FROM (VALUES {values}, "
+            f"({OTHER_PAYMENT_BIT}, 'other')) types(bit, name) WHERE ({mask}) & bit <> 0)")
+
+facts_select = f"""
+SELECT
+    order_id,
+    COUNT(*)::integer as payment_count,
+    SUM(payment_value)::numeric(12, 2) as payment_value,
+    SUM(payment_installments)::integer as installments_sum,
+    MAX(payment_installments) as installments_max,
+    BIT_OR({payment_type_bit_sql('payment_type')}) as payment_type_mask
+FROM {ANALYTICS_SCHEMA}.order_payments
+"""
+
+facts_ddl = f"""
+DROP TABLE IF EXISTS {PAYMENT_FACTS_TABLE};
+CREATE TABLE {PAYMENT_FACTS_TABLE} (
+    order_id text PRIMARY KEY,
+    payment_count integer NOT NULL,
+    payment_value numeric(12, 2),
+    installments_sum integer,
+    installments_max integer,
+    payment_type_mask integer NOT NULL
+);
+"""
+
+# Recompute the facts of the orders a statement on order_payments touched.
+# Transition tables are only referenced in the branch for their event;
+# plpgsql plans each statement on first execution, so the others are never
+# resolved.
+sync_ddl = f"""
+CREATE OR REPLACE FUNCTION {ANALYTICS_SCHEMA}.sync_order_payment_facts(order_ids text[])
+RETURNS void LANGUAGE sql AS $$
+    DELETE FROM {PAYMENT_FACTS_TABLE} WHERE order_id = ANY(order_ids);
+    INSERT INTO {PAYMENT_FACTS_TABLE}
+    {facts_select}
+    WHERE order_id = ANY(order_ids)
+    GROUP BY order_id;
+$$;
+
+CREATE OR REPLACE FUNCTION {ANALYTICS_SCHEMA}.order_payments_sync_trigger()
+RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM {ANALYTICS_SCHEMA}.sync_order_payment_facts(
+            ARRAY(SELECT DISTINCT order_id FROM new_rows));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM {ANALYTICS_SCHEMA}.sync_order_payment_facts(
+            ARRAY(SELECT DISTINCT order_id FROM old_rows));
+    ELSE
+        PERFORM {ANALYTICS_SCHEMA}.sync_order_payment_facts(
+            ARRAY(SELECT order_id FROM new_rows UNION SELECT order_id FROM old_rows));
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS order_payment_facts_insert ON {ANALYTICS_SCHEMA}.order_payments;
+DROP TRIGGER IF EXISTS order_payment_facts_update ON {ANALYTICS_SCHEMA}.order_payments;
+DROP TRIGGER IF EXISTS order_payment_facts_delete ON {ANALYTICS_SCHEMA}.order_payments;
+CREATE TRIGGER order_payment_facts_insert AFTER INSERT ON {ANALYTICS_SCHEMA}.order_payments
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {ANALYTICS_SCHEMA}.order_payments_sync_trigger();
+CREATE TRIGGER order_payment_facts_update AFTER UPDATE ON {ANALYTICS_SCHEMA}.order_payments
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {ANALYTICS_SCHEMA}.order_payments_sync_trigger();
+CREATE TRIGGER order_payment_facts_delete AFTER DELETE ON {ANALYTICS_SCHEMA}.order_payments
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {ANALYTICS_SCHEMA}.order_payments_sync_trigger();
+"""
+
+def build_payment_facts(conn):
+    """Rebuild the facts from analytics.order_payments and install the sync and
+    version triggers"""
+    start = time.perf_counter()
+    conn.execute(text(facts_ddl))
+    conn.execute(text(f"INSERT INTO {PAYMENT_FACTS_TABLE} {facts_select} GROUP BY order_id"))
+    conn.execute(text(sync_ddl))
+    track_changes([PAYMENT_FACTS_TABLE], conn)
+    conn.execute(text(f"ANALYZE {PAYMENT_FACTS_TABLE}"))
+    logger.info(f"Built {PAYMENT_FACTS_TABLE} in {time.perf_counter() - start:.2f}s")
+
+def verify_payment_facts(engine=None):
+    """Compare the facts with a fresh aggregation of order_payments; returns mismatch counts"""
+    if engine is None:
+        engine = get_db_connection()
+
+    query = f"""
+    WITH expected AS ({facts_select} GROUP BY order_id)
+    SELECT
+        (SELECT COUNT(*) FROM {PAYMENT_FACTS_TABLE}) as orders,
+        (SELECT COUNT(*) FROM (SELECT * FROM {PAYMENT_FACTS_TABLE} EXCEPT ALL SELECT * FROM expected) d)
+            as only_stored,
+        (SELECT COUNT(*) FROM (SELECT * FROM expected EXCEPT ALL SELECT * FROM {PAYMENT_FACTS_TABLE}) d)
+            as only_expected
+    """
+    with engine.connect() as conn:
+        row = conn.execute(text(query)).one()
+    return {'orders': row.orders, 'only_stored': row.only_stored, 'only_expected': row.only_expected}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the per-order payment facts")
+    parser.add_argument("command", choices=["build", "verify"],
+                        help="build: rebuild the facts and triggers; verify: compare with order_payments")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        engine = get_db_connection()
+        if engine is None:
+            raise SystemExit(1)
+        with engine.begin() as conn:
+            build_payment_facts(conn)
+    else:
+        result = verify_payment_facts()
+        print(f"Orders:              {result['orders']:,}")
+        print(f"Only in facts:       {result['only_stored']:,}")
+        print(f"Only in payments:    {result['only_expected']:,}")
+        if result['only_stored'] or result['only_expected']:
+            print("Mismatch: run `python payment_facts.py build` to rebuild")
+            raise SystemExit(1)
+        print("Facts match order_payments")
@@ -1,43 +1,25 @@
-import matplotlib.pyplot as plt
-import numpy as np
 from utils import execute_query
-from adjustText import adjust_text
+from purchase_intervals import build_state_intervals_query, get_sampled_state_intervals
 
-# Query to get state performance metrics
-query = """
-WITH customer_purchases AS (
-    SELECT 
-        c.customer_unique_id,
-        c.customer_state,
-        o.order_purchase_timestamp::timestamp,
-        LAG(o.order_purchase_timestamp::timestamp) OVER (
-            PARTITION BY c.customer_unique_id 
-            ORDER BY o.order_purchase_timestamp
-        ) as previous_purchase
-    FROM customers c
-    JOIN orders o ON c.customer_id = o.customer_id
-),
-time_between_purchases AS (
-    SELECT 
-        customer_state,
-        EXTRACT(days FROM (order_purchase_timestamp - previous_purchase)) as days_between_purchases
-    FROM customer_purchases
-    WHERE previous_purchase IS NOT NULL
-)
-SELECT 
-    customer_state,
-    COUNT(*) as number_of_repeat_purchases,
-    ROUND(AVG(days_between_purchases))::integer as avg_days_between_purchases
-FROM time_between_purchases
-GROUP BY customer_state
-HAVING COUNT(*) >= 5
-ORDER BY number_of_repeat_purchases DESC;
-"""
+# Repeat purchases per state, read from the precomputed purchase-interval
+# table (see purchase_intervals.py) rather than windowing every order
+query = build_state_intervals_query()
 
-# Get data using utils.py
-df = execute_query(query)
+def get_quadrant_data(engine=None, start=None, end=None, min_count=5, sample=None):
+    """Fetch repeat purchase counts and average purchase intervals per state.
+
+    With `sample` set to a fraction, both are estimated from that share of
+    customers, with _ci_low/_ci_high bounds.
+    """
+    if sample is not None:
+        return get_sampled_state_intervals(sample, start, end, min_count, engine)
+    return execute_query(build_state_intervals_query(start, end, min_count), engine)
+
+def plot_quadrants(df):
+    """Create the state performance quadrant chart and return the figure"""
+    import matplotlib.pyplot as plt
+    from adjustText import adjust_text
 
-if df is not None:
     # Create figure and axis
     fig, ax = plt.subplots(figsize=(12, 8))
     
@@ -72,7 +54,8 @@ if df is not None:
     
     # Create scatter plot with size based on number of purchases
     sizes = df['number_of_repeat_purchases']
-    normalized_sizes = 100 + (sizes - sizes.min()) / (sizes.max() - sizes.min()) * 400
+    spread = sizes.max() - sizes.min()
+    normalized_sizes = 100 + (sizes - sizes.min()) / spread * 400 if spread else 300
     
     plt.scatter(df['avg_days_between_purchases'], 
                 df['number_of_repeat_purchases'],
@@ -121,32 +104,36 @@ if df is not None:
                       alpha=0.5, pad=5),
              fontsize=10)
     
-    # Add specific annotations for SP and MS
-    sp_row = df[df['customer_state'] == 'SP'].iloc[0]
-    ms_row = df[df['customer_state'] == 'MS'].iloc[0]
-    
-    # SP annotation with more prominent styling
-    plt.annotate(
-        "SP (São Paulo)\nVolume: 1,455 repeat purchases\nHighest total market value",
-        xy=(sp_row['avg_days_between_purchases'], sp_row['number_of_repeat_purchases']),
-        xytext=(sp_row['avg_days_between_purchases'] + 10, sp_row['number_of_repeat_purchases'] - 100),
-        ha='left',
-        va='top',
-        bbox=dict(facecolor='#e3f2fd', edgecolor='#4a90e2', alpha=0.9, pad=5),
-        arrowprops=dict(arrowstyle='->', color='#4a90e2', lw=2),
-        fontsize=10,
-        fontweight='bold')
-    
-    # MS annotation with updated styling
-    plt.annotate(
-        "MS (Mato Grosso do Sul)\nHighest purchase frequency\nLow volume impact",
-        xy=(ms_row['avg_days_between_purchases'], ms_row['number_of_repeat_purchases']),
-        xytext=(ms_row['avg_days_between_purchases'] + 5, ms_row['number_of_repeat_purchases'] + 300),
-        ha='left',
-        va='bottom',
-        bbox=dict(facecolor='#e8f5e9', edgecolor='#66bb6a', alpha=0.9, pad=5),
-        arrowprops=dict(arrowstyle='->', color='#66bb6a', lw=2),
-        fontsize=9)
+    # Add specific annotations for SP and MS (when present in the data)
+    sp_rows = df[df['customer_state'] == 'SP']
+    ms_rows = df[df['customer_state'] == 'MS']
+    
+    if not sp_rows.empty:
+        sp_row = sp_rows.iloc[0]
+        # SP annotation with more prominent styling
+        plt.annotate(
+            "SP (São Paulo)\nVolume: 1,455 repeat purchases\nHighest total market value",
+            xy=(sp_row['avg_days_between_purchases'], sp_row['number_of_repeat_purchases']),
+            xytext=(sp_row['avg_days_between_purchases'] + 10, sp_row['number_of_repeat_purchases'] - 100),
+            ha='left',
+            va='top',
+            bbox=dict(facecolor='#e3f2fd', edgecolor='#4a90e2', alpha=0.9, pad=5),
+            arrowprops=dict(arrowstyle='->', color='#4a90e2', lw=2),
+            fontsize=10,
+            fontweight='bold')
+    
+    if not ms_rows.empty:
+        ms_row = ms_rows.iloc[0]
+        # MS annotation with updated styling
+        plt.annotate(
+            "MS (Mato Grosso do Sul)\nHighest purchase frequency\nLow volume impact",
+            xy=(ms_row['avg_days_between_purchases'], ms_row['number_of_repeat_purchases']),
+            xytext=(ms_row['avg_days_between_purchases'] + 5, ms_row['number_of_repeat_purchases'] + 300),
+            ha='left',
+            va='bottom',
+            bbox=dict(facecolor='#e8f5e9', edgecolor='#66bb6a', alpha=0.9, pad=5),
+            arrowprops=dict(arrowstyle='->', color='#66bb6a', lw=2),
+            fontsize=9)
     
     # Labels and title
     plt.xlabel('Average Days Between Purchases', fontsize=10)
@@ -161,8 +148,13 @@ if df is not None:
     plt.grid(True, alpha=0.2, zorder=0)
     
     plt.tight_layout()
-    plt.show()
-    
+    return fig
+
+def print_quadrant_analysis(df):
+    """Print the states falling in each quadrant"""
+    mean_days = df['avg_days_between_purchases'].mean()
+    mean_purchases = df['number_of_repeat_purchases'].mean()
+
     # Print quadrant analysis
     print("\nQuadrant Analysis:")
     print("\nFAST & HIGH (Ideal):")
@@ -180,5 +172,21 @@ if df is not None:
     print("\nSLOW & LOW (Need Attention):")
     print(df[(df['avg_days_between_purchases'] > mean_days) & 
             (df['number_of_repeat_purchases'] < mean_purchases)]['customer_state'].tolist())
-else:
-    print("Error: Could not retrieve data from database")
\ No newline at end of file
+
+def create_quadrant_plot():
+    # Get data using utils.py
+    df = get_quadrant_data()
+
+    if df is None:
+        print("Error: Could not retrieve data from database")
+        return
+
+    import matplotlib.pyplot as plt
+
+    plot_quadrants(df)
+    plt.show()
+
+    print_quadrant_analysis(df)
+
+if __name__ == "__main__":
+    create_quadrant_plot()
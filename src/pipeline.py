@@ -0,0 +1,209 @@
+import argparse
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils import execute_query, get_rfm_build_info
+
+logger = logging.getLogger(__name__)
+
+# Runs every analysis as one DAG. Shared inputs are declared as their own
+# stages so they are computed once: the MAX(order_purchase_timestamp) anchor
+# and the RFM layer both feed two analyses. Independent stages run
+# concurrently on a bounded thread pool (each query holds one pooled
+# connection), so a full refresh costs roughly the slowest chain rather than
+# the sum of all queries. The sales cube (sales_cube.py) is refreshed after
+# the RFM layer, by month, so dashboard queries against it stay current.
+# --start/--end are passed to every analysis to limit it to a purchase-date
+# range (see the date range notes in typed_schema.py).
+
+def max_purchase_date(inputs):
+    df = execute_query("SELECT MAX(order_purchase_timestamp) as max_date FROM analytics.orders",
+                       label='max_purchase_date')
+    if df is None:
+        raise Exception("Could not read the latest purchase date")
+    return df['max_date'].iloc[0]
+
+def rfm_layer(inputs):
+    """Make sure the RFM table reflects the current data, refreshing it at most once.
+
+    A stale table is brought up to date incrementally; --refresh-rfm forces a
+    full rebuild from all history.
+    """
+    from rfm import refresh_rfm_segments
+
+    info = get_rfm_build_info()
+    force = inputs.get('force_rfm_refresh', False)
+    if not force and info is not None and str(info['max_purchase_date']) == str(inputs['max_purchase_date']):
+        return 'current'
+    if not refresh_rfm_segments(incremental=not force):
+        raise Exception("RFM refresh failed")
+    return 'refreshed'
+
+def purchase_intervals_layer(inputs):
+    """Append orders newer than the interval table's latest purchase"""
+    from purchase_intervals import refresh_purchase_intervals
+
+    if not refresh_purchase_intervals(incremental=True):
+        raise Exception("Purchase interval refresh failed")
+    return 'current'
+
+def sales_cube_layer(inputs):
+    """Bring the sales cube up to date with the data and the RFM layer"""
+    from sales_cube import get_cube_build_info, refresh_sales_cube
+
+    # Any RFM rebuild re-segments customers in every month, so the cube is
+    # only current if it was built from the rfm_segments build in place now;
+    # refresh_sales_cube rebuilds all months itself when that changed
+    info = get_cube_build_info()
+    rfm_info = get_rfm_build_info()
+    if (info is not None and rfm_info is not None and info['rfm_built_at'] == rfm_info['built_at']
+            and str(info['max_purchase_date']) == str(inputs['max_purchase_date'])):
+        return 'current'
+    if not refresh_sales_cube():
+        raise Exception("Sales cube refresh failed")
+    return 'refreshed'
+
+def _analysis(module_name, data_function):
+    def run(inputs):
+        import importlib
+
+        df = getattr(importlib.import_module(module_name), data_function)(
+            start=inputs.get('start'), end=inputs.get('end'))
+        if df is None:
+            raise Exception(f"{module_name}.{data_function} returned no data")
+        return df
+    run.__name__ = f"{module_name}.{data_function}"
+    return run
+
+# stage name -> (dependencies, function taking a dict of dependency results)
+STAGES = {
+    'max_purchase_date': ([], max_purchase_date),
+    'rfm_layer': (['max_purchase_date'], rfm_layer),
+    'sales_cube': (['max_purchase_date', 'rfm_layer'], sales_cube_layer),
+    'installments_by_segment': (['rfm_layer'], _analysis('installments_by_segment', 'get_segment_data')),
+    'customer_segments_by_state': (['rfm_layer'], _analysis('segments_by_state', 'get_state_segment_data')),
+    'sp_top_categories': ([], _analysis('sp_top_categories', 'get_sp_category_data')),
+    'purchase_intervals': ([], purchase_intervals_layer),
+    'state_performance_quadrants': (['purchase_intervals'], _analysis('performance_quadrant', 'get_quadrant_data')),
+}
+
+def required_stages(targets, stages=STAGES):
+    """The targets plus everything they depend on"""
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(stages[name][0])
+    return needed
+
+def run_pipeline(targets=None, workers=4, stages=STAGES, context=None):
+    """Run stages as soon as their dependencies finish.
+
+    Returns (results, timings): results maps stage name to its return value,
+    timings maps stage name to (start offset, seconds, status).
+    """
+    needed = required_stages(targets or list(stages), stages)
+    context = dict(context or {})
+    results = {}
+    timings = {}
+    failed = set()
+    running = {}
+    origin = time.perf_counter()
+
+    def ready(name):
+        deps = stages[name][0]
+        return all(dep in results for dep in deps)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for name in sorted(needed):
+                if name in results or name in failed or name in running.values():
+                    continue
+                if any(dep in failed for dep in stages[name][0]):
+                    failed.add(name)
+                    timings[name] = (time.perf_counter() - origin, 0.0, 'skipped')
+                    continue
+                if ready(name):
+                    inputs = dict(context, **{dep: results[dep] for dep in stages[name][0]})
+                    start = time.perf_counter()
+                    future = pool.submit(stages[name][1], inputs)
+                    future.started_at = start
+                    running[future] = name
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                finished = time.perf_counter()
+                try:
+                    results[name] = future.result()
+                    status = 'ok'
+                except Exception as e:
+                    logger.error(f"Stage {name} failed: {str(e)}")
+                    failed.add(name)
+                    status = 'failed'
+                timings[name] = (future.started_at - origin, finished - future.started_at, status)
+
+    return results, timings
+
+def print_timings(timings, wall_seconds):
+    print(f"\n{'Stage':<36}{'Start':>8}{'Seconds':>10}  Status")
+    print("-" * 64)
+    for name, (offset, seconds, status) in sorted(timings.items(), key=lambda item: item[1][0]):
+        print(f"{name:<36}{offset:>8.2f}{seconds:>10.2f}  {status}")
+    total = sum(seconds for _, seconds, _ in timings.values())
+    print(f"\nWall time: {wall_seconds:.2f}s (sum of stage times: {total:.2f}s)")
+
+def render_results(results, output_dir, origin):
+    """Render the fetched data to image files (headless, in this process).
+
+    Returns timings in the same shape as run_pipeline, offset from `origin`.
+    """
+    import os
+    import importlib
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from render_all import CHARTS
+
+    os.makedirs(output_dir, exist_ok=True)
+    timings = {}
+    for name, (module_name, _, plot_function) in CHARTS.items():
+        if name not in results:
+            continue
+        start = time.perf_counter()
+        fig = getattr(importlib.import_module(module_name), plot_function)(results[name])
+        fig.savefig(os.path.join(output_dir, f"{name}.png"), bbox_inches='tight')
+        plt.close(fig)
+        timings[f"render:{name}"] = (start - origin, time.perf_counter() - start, 'ok')
+    return timings
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run every analysis as one dependency-aware pipeline")
+    parser.add_argument("stages", nargs="*", help=f"Stages to run with their dependencies "
+                                                 f"(default: all): {', '.join(STAGES)}")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent queries (default 4)")
+    parser.add_argument("--refresh-rfm", action="store_true", help="Rebuild the RFM layer even if current")
+    parser.add_argument("--render", metavar="DIR", help="Also render the charts into DIR")
+    parser.add_argument("--start", help="Limit the analyses to orders purchased from this date")
+    parser.add_argument("--end", help="Limit the analyses to orders purchased before this date")
+    args = parser.parse_args()
+    unknown = [name for name in args.stages if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+
+    start = time.perf_counter()
+    results, timings = run_pipeline(args.stages, args.workers,
+                                    context={'force_rfm_refresh': args.refresh_rfm,
+                                             'start': args.start, 'end': args.end})
+    if args.render:
+        timings.update(render_results(results, args.render, start))
+    print_timings(timings, time.perf_counter() - start)
+
+    if any(status == 'failed' for _, _, status in timings.values()):
+        sys.exit(1)
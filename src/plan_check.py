@@ -0,0 +1,179 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from sqlalchemy import text
+from utils import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plan_baseline.json')
+
+# Tables with at least this many (estimated) rows count as large
+DEFAULT_MIN_ROWS = 10000
+# Allowed growth in estimated total cost before a query counts as regressed
+DEFAULT_TOLERANCE = 0.25
+
+# Fixed one-month purchase range for the windowed checks: orders and
+# order_items must be pruned to that month's partitions
+CHECK_WINDOW = ('2018-01-01', '2018-02-01')
+
+def collect_queries():
+    """Analysis queries to check, keyed by name.
+
+    Queries that take a purchase-date range are checked twice: over all
+    history, where whole-table scans are expected, and over CHECK_WINDOW
+    (named '<query>@month'), where they are not.
+    """
+    import rfm
+    import installments_by_segment
+    import segments_by_state
+    import sp_top_categories
+    import performance_quadrant
+    import purchase_intervals
+
+    start, end = CHECK_WINDOW
+    return {
+        'rfm_segments': rfm.rfm_segments_query,
+        'rfm_segments@month': rfm.build_rfm_segments_query(start=start, end=end),
+        'installments_by_segment': installments_by_segment.query,
+        'installments_by_segment@month': installments_by_segment.build_query(start, end),
+        'segments_by_state': segments_by_state.query,
+        'segments_by_state@month': segments_by_state.build_query(start, end),
+        'sp_top_categories': sp_top_categories.query,
+        'sp_top_categories@month': sp_top_categories.build_query(start, end),
+        'performance_quadrant': performance_quadrant.query,
+        'performance_quadrant@month': purchase_intervals.build_state_intervals_query(start, end),
+    }
+
+def explain(conn, query):
+    """Return the top plan node of EXPLAIN for a query (VERBOSE adds schema names)"""
+    result = conn.execute(text(f"EXPLAIN (FORMAT JSON, VERBOSE) {query.strip().rstrip(';')}"))
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+def walk_plan(node):
+    """Yield every node in a plan tree"""
+    yield node
+    for child in node.get('Plans', []):
+        yield from walk_plan(child)
+
+def get_table_sizes(conn):
+    """Estimated row counts for every ordinary table, keyed by schema.table"""
+    result = conn.execute(text("""
+        SELECT n.nspname || '.' || c.relname as table_name, c.reltuples::bigint as row_estimate
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p')
+            AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+    """))
+    return {row[0]: row[1] for row in result}
+
+def get_partition_roots(conn):
+    """Root partitioned table of every partition, keyed by schema.table"""
+    result = conn.execute(text("""
+        SELECT n.nspname || '.' || c.relname, rn.nspname || '.' || r.relname
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_class r ON r.oid = pg_partition_root(c.oid)
+        JOIN pg_namespace rn ON rn.oid = r.relnamespace
+        WHERE c.relispartition
+    """))
+    return {row[0]: row[1] for row in result}
+
+def check_query(plan, table_sizes, baseline, min_rows, tolerance, partition_roots=None):
+    """Return a list of problems found in one query plan.
+
+    Seq scans of partitions count toward their partitioned table: the rows
+    of the distinct partitions scanned are added up, so scanning every
+    month of a large table is flagged while a pruned date range is not.
+    """
+    problems = []
+    allowed = set(baseline.get('allow_seq_scan', []))
+    partition_roots = partition_roots or {}
+
+    scanned = {}
+    for node in walk_plan(plan):
+        if node.get('Node Type') != 'Seq Scan':
+            continue
+        relation = f"{node.get('Schema', 'public')}.{node['Relation Name']}"
+        scanned.setdefault(partition_roots.get(relation, relation), set()).add(relation)
+    for table, relations in scanned.items():
+        rows = sum(table_sizes.get(relation, 0) for relation in relations)
+        if rows >= min_rows and table not in allowed:
+            problems.append(f"Seq Scan on large table {table} (~{rows:,} rows)")
+
+    max_cost = baseline.get('total_cost')
+    cost = plan['Total Cost']
+    if max_cost is None:
+        problems.append("no baseline cost recorded; run with --update-baseline on a loaded database")
+    elif cost > max_cost * (1 + tolerance):
+        problems.append(f"estimated cost {cost:,.0f} exceeds baseline {max_cost:,.0f} "
+                        f"by more than {tolerance:.0%}")
+    return problems
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_baseline(baseline, path=BASELINE_PATH):
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def run_checks(engine, min_rows=DEFAULT_MIN_ROWS, tolerance=DEFAULT_TOLERANCE, update_baseline=False):
+    """EXPLAIN every analysis query and compare it with the stored baseline.
+
+    Returns True when no query regressed.
+    """
+    baseline = load_baseline()
+    failed = False
+
+    with engine.connect() as conn:
+        table_sizes = get_table_sizes(conn)
+        partition_roots = get_partition_roots(conn)
+        for name, query in collect_queries().items():
+            plan = explain(conn, query)
+            entry = baseline.setdefault(name, {})
+
+            if update_baseline:
+                entry['total_cost'] = round(plan['Total Cost'], 2)
+                print(f"{name:<30} baseline cost set to {plan['Total Cost']:,.0f}")
+                continue
+
+            problems = check_query(plan, table_sizes, entry, min_rows, tolerance, partition_roots)
+            status = "FAIL" if problems else "ok"
+            print(f"{name:<30} {status:<5} cost={plan['Total Cost']:,.0f}")
+            for problem in problems:
+                print(f"    - {problem}")
+            failed = failed or bool(problems)
+
+    if update_baseline:
+        save_baseline(baseline)
+    return not failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check analysis query plans for seq scans on large tables and cost regressions"
+    )
+    parser.add_argument("--url", help="Database URL (e.g. a throwaway local Postgres); "
+                                      "defaults to the DB_* settings in .env")
+    parser.add_argument("--min-rows", type=int, default=DEFAULT_MIN_ROWS,
+                        help=f"Row estimate above which a table counts as large (default {DEFAULT_MIN_ROWS:,})")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Allowed relative cost growth over the baseline (default {DEFAULT_TOLERANCE})")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Record the current estimated costs as the new baseline")
+    args = parser.parse_args()
+
+    engine = get_db_connection(args.url)
+    if engine is None:
+        sys.exit(2)
+
+    if not run_checks(engine, args.min_rows, args.tolerance, args.update_baseline):
+        sys.exit(1)
@@ -0,0 +1,287 @@
+import argparse
+import logging
+import time
+from sqlalchemy import text
+from query_cache import track_changes
+from utils import bind_literals, date_range_params, execute_query, get_db_connection
+from sampling import (SAMPLE_BUCKET_COLUMN, ratio_estimate, sample_bucket_sql, sample_predicate,
+                      total_estimate, with_interval)
+
+logger = logging.getLogger(__name__)
+
+# Derived purchase-interval layer: one row per order with the customer's
+# previous purchase and the days since it, so recurrence analyses read
+# intervals instead of re-running LAG() over every order. Rows are keyed on
+# (customer_unique_id, order_purchase_timestamp, order_id) and kept current
+# by appending orders purchased at or after the latest timestamp in the
+# table; only the previous purchase of the customers in that delta is read
+# back. Each row also carries the customer's sampling bucket, copied from
+# customers, so sampled previews read the table through its bucket index.
+PURCHASE_INTERVALS_TABLE = "purchase_intervals"
+
+intervals_ddl = f"""
+CREATE TABLE IF NOT EXISTS {PURCHASE_INTERVALS_TABLE} (
+    customer_unique_id text NOT NULL,
+    order_purchase_timestamp timestamp NOT NULL,
+    order_id text NOT NULL,
+    customer_state text NOT NULL,
+    previous_purchase timestamp,
+    days_between_purchases integer,
+    {SAMPLE_BUCKET_COLUMN} integer NOT NULL,
+    PRIMARY KEY (customer_unique_id, order_purchase_timestamp, order_id)
+);
+-- Tables built before the bucket column get it from the same stable hash
+ALTER TABLE {PURCHASE_INTERVALS_TABLE} ADD COLUMN IF NOT EXISTS {SAMPLE_BUCKET_COLUMN} integer;
+CREATE INDEX IF NOT EXISTS {PURCHASE_INTERVALS_TABLE}_{SAMPLE_BUCKET_COLUMN}_idx
+    ON {PURCHASE_INTERVALS_TABLE} ({SAMPLE_BUCKET_COLUMN});
+UPDATE {PURCHASE_INTERVALS_TABLE} SET {SAMPLE_BUCKET_COLUMN} = {sample_bucket_sql('customer_unique_id')}
+WHERE {SAMPLE_BUCKET_COLUMN} IS NULL;
+ALTER TABLE {PURCHASE_INTERVALS_TABLE} ALTER COLUMN {SAMPLE_BUCKET_COLUMN} SET NOT NULL;
+-- Repeat purchases are a few percent of orders: a partial index covers the
+-- interval aggregates and their date ranges without touching first purchases
+CREATE INDEX IF NOT EXISTS {PURCHASE_INTERVALS_TABLE}_repeat_idx
+    ON {PURCHASE_INTERVALS_TABLE} (order_purchase_timestamp)
+    INCLUDE (customer_state, days_between_purchases)
+    WHERE previous_purchase IS NOT NULL;
+"""
+
+# Orders from the watermark on plus each affected customer's latest stored
+# purchase before it, windowed together so the first new order links to
+# history. Orders sharing the watermark timestamp may have arrived after the
+# last refresh, so they are re-read and re-windowed: stored rows at that
+# timestamp are upserted on the key, and only rows that change are written.
+append_query = f"""
+INSERT INTO {PURCHASE_INTERVALS_TABLE}
+    (customer_unique_id, order_purchase_timestamp, order_id, customer_state,
+     previous_purchase, days_between_purchases, {SAMPLE_BUCKET_COLUMN})
+WITH new_orders AS (
+    SELECT
+        c.customer_unique_id,
+        o.order_purchase_timestamp,
+        o.order_id,
+        c.customer_state,
+        c.{SAMPLE_BUCKET_COLUMN}
+    FROM analytics.orders o
+    JOIN analytics.customers c ON c.customer_id = o.customer_id
+    WHERE o.order_purchase_timestamp >= CAST(:watermark AS timestamp)
+),
+last_known AS (
+    SELECT DISTINCT ON (pi.customer_unique_id)
+        pi.customer_unique_id,
+        pi.order_purchase_timestamp,
+        pi.order_id,
+        pi.customer_state,
+        pi.{SAMPLE_BUCKET_COLUMN}
+    FROM {PURCHASE_INTERVALS_TABLE} pi
+    WHERE pi.customer_unique_id IN (SELECT customer_unique_id FROM new_orders)
+        AND pi.order_purchase_timestamp < CAST(:watermark AS timestamp)
+    ORDER BY pi.customer_unique_id, pi.order_purchase_timestamp DESC, pi.order_id DESC
+),
+windowed AS (
+    SELECT
+        *,
+        LAG(order_purchase_timestamp) OVER (
+            PARTITION BY customer_unique_id
+            ORDER BY order_purchase_timestamp, order_id
+        ) as previous_purchase
+    FROM (
+        SELECT *, true as is_new FROM new_orders
+        UNION ALL
+        SELECT *, false as is_new FROM last_known
+    ) purchases
+)
+SELECT
+    customer_unique_id,
+    order_purchase_timestamp,
+    order_id,
+    customer_state,
+    previous_purchase,
+    EXTRACT(days FROM (order_purchase_timestamp - previous_purchase))::integer,
+    {SAMPLE_BUCKET_COLUMN}
+FROM windowed
+WHERE is_new
+-- Bucket order keeps a sample's rows on shared pages, as in the typed build
+ORDER BY {SAMPLE_BUCKET_COLUMN}
+ON CONFLICT (customer_unique_id, order_purchase_timestamp, order_id) DO UPDATE SET
+    previous_purchase = EXCLUDED.previous_purchase,
+    days_between_purchases = EXCLUDED.days_between_purchases
+WHERE ({PURCHASE_INTERVALS_TABLE}.previous_purchase, {PURCHASE_INTERVALS_TABLE}.days_between_purchases)
+    IS DISTINCT FROM (EXCLUDED.previous_purchase, EXCLUDED.days_between_purchases)
+"""
+
+# Repeat purchases per state in a purchase-date range; :start/:end bound the
+# repeat purchase's timestamp (end exclusive)
+state_intervals_query = f"""
+SELECT
+    customer_state,
+    COUNT(*) as number_of_repeat_purchases,
+    ROUND(AVG(days_between_purchases))::integer as avg_days_between_purchases
+FROM {PURCHASE_INTERVALS_TABLE}
+WHERE previous_purchase IS NOT NULL
+    AND order_purchase_timestamp >= CAST(:start AS timestamp)
+    AND order_purchase_timestamp < CAST(:end AS timestamp)
+GROUP BY customer_state
+HAVING COUNT(*) >= :min_count
+ORDER BY number_of_repeat_purchases DESC;
+"""
+
+def build_state_intervals_query(start=None, end=None, min_count=5):
+    """state_intervals_query with the range and minimum count filled in"""
+    return bind_literals(state_intervals_query, dict(date_range_params(start, end), min_count=int(min_count)))
+
+def build_sampled_state_intervals_query(fraction, start=None, end=None):
+    """Per-state sums of repeat purchases and interval days over a customer sample"""
+    return bind_literals(f"""
+WITH customer_repeats AS (
+    SELECT
+        customer_unique_id,
+        customer_state,
+        COUNT(*) as repeats,
+        SUM(days_between_purchases) as days
+    FROM {PURCHASE_INTERVALS_TABLE} pi
+    WHERE previous_purchase IS NOT NULL
+        AND order_purchase_timestamp >= CAST(:start AS timestamp)
+        AND order_purchase_timestamp < CAST(:end AS timestamp)
+        AND {sample_predicate(fraction, ['pi'])}
+    GROUP BY customer_unique_id, customer_state
+)
+SELECT
+    customer_state,
+    COUNT(*) as n,
+    SUM(repeats) as repeats, SUM(repeats * repeats) as repeats_sq,
+    SUM(days) as days, SUM(days * days) as days_sq, SUM(days * repeats) as days_repeats
+FROM customer_repeats
+GROUP BY customer_state;
+""", date_range_params(start, end))
+
+def get_sampled_state_intervals(fraction, start=None, end=None, min_count=5, engine=None):
+    """get_state_intervals estimated from a customer sample, with _ci_low/_ci_high bounds"""
+    df = execute_query(build_sampled_state_intervals_query(fraction, start, end), engine)
+    if df is None:
+        return None
+    estimate, half_width = total_estimate(df['repeats'], df['repeats_sq'], fraction)
+    df = with_interval(df, 'number_of_repeat_purchases', estimate, half_width, digits=0)
+    estimate, half_width = ratio_estimate(df['days'], df['repeats'], df['days_sq'], df['repeats_sq'],
+                                          df['days_repeats'], df['n'], fraction)
+    df = with_interval(df, 'avg_days_between_purchases', estimate, half_width, digits=0)
+    df = df[df['number_of_repeat_purchases'] >= min_count]
+    columns = [col for col in df.columns if col.startswith(('customer_state', 'number_of', 'avg_days'))]
+    return df[columns].sort_values('number_of_repeat_purchases', ascending=False).reset_index(drop=True)
+
+def refresh_purchase_intervals(engine=None, incremental=False):
+    """Bring the purchase-interval table up to date.
+
+    A full refresh empties the table and windows all orders; an incremental
+    one appends only orders purchased at or after the latest stored
+    timestamp.
+    As with the RFM layer, orders arriving later with an earlier purchase
+    timestamp are only picked up by a full refresh.
+    """
+    try:
+        if engine is None:
+            engine = get_db_connection()
+
+        if engine is None:
+            raise Exception("Failed to establish database connection")
+
+        start = time.perf_counter()
+        mode = 'incremental' if incremental else 'full'
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"),
+                         {"name": PURCHASE_INTERVALS_TABLE})
+            conn.execute(text(intervals_ddl))
+            track_changes([PURCHASE_INTERVALS_TABLE], conn)
+            if not incremental:
+                conn.execute(text(f"TRUNCATE {PURCHASE_INTERVALS_TABLE}"))
+
+            watermark = conn.execute(
+                text(f"SELECT MAX(order_purchase_timestamp) FROM {PURCHASE_INTERVALS_TABLE}")).scalar()
+            appended = conn.execute(text(append_query), {"watermark": watermark or '-infinity'}).rowcount
+            if appended:
+                conn.execute(text(f"ANALYZE {PURCHASE_INTERVALS_TABLE}"))
+
+        logger.info(f"Refreshed {PURCHASE_INTERVALS_TABLE} ({mode}): {appended:,} orders written "
+                    f"in {time.perf_counter() - start:.2f}s")
+        return True
+    except Exception as e:
+        logger.error(f"Error refreshing purchase intervals: {str(e)}")
+        return False
+
+def get_state_intervals(start=None, end=None, min_count=5, engine=None):
+    """Repeat purchases and average days between purchases per state.
+
+    `start`/`end` limit the repeat purchases by purchase date (end
+    exclusive); states with fewer than `min_count` repeats are left out.
+    """
+    return execute_query(build_state_intervals_query(start, end, min_count), engine)
+
+def get_intervals(start=None, end=None, engine=None):
+    """Raw repeat-purchase rows in a purchase-date range, for cohort analyses"""
+    query = bind_literals(f"""
+    SELECT customer_unique_id, customer_state, order_id, order_purchase_timestamp,
+        previous_purchase, days_between_purchases
+    FROM {PURCHASE_INTERVALS_TABLE}
+    WHERE previous_purchase IS NOT NULL
+        AND order_purchase_timestamp >= CAST(:start AS timestamp)
+        AND order_purchase_timestamp < CAST(:end AS timestamp)
+    ORDER BY order_purchase_timestamp
+    """, date_range_params(start, end))
+    return execute_query(query, engine)
+
+def verify_intervals(engine=None):
+    """Compare the table with LAG() over all orders; returns mismatch counts"""
+    if engine is None:
+        engine = get_db_connection()
+
+    columns = "customer_unique_id, order_purchase_timestamp, order_id, previous_purchase, days_between_purchases"
+    query = f"""
+    WITH expected AS (
+        SELECT
+            c.customer_unique_id,
+            o.order_purchase_timestamp,
+            o.order_id,
+            LAG(o.order_purchase_timestamp) OVER w as previous_purchase,
+            EXTRACT(days FROM (o.order_purchase_timestamp - LAG(o.order_purchase_timestamp) OVER w))::integer
+                as days_between_purchases
+        FROM analytics.orders o
+        JOIN analytics.customers c ON c.customer_id = o.customer_id
+        WINDOW w AS (PARTITION BY c.customer_unique_id ORDER BY o.order_purchase_timestamp, o.order_id)
+    ),
+    stored AS (SELECT {columns} FROM {PURCHASE_INTERVALS_TABLE})
+    SELECT
+        (SELECT COUNT(*) FROM stored) as orders,
+        (SELECT COUNT(*) FROM (SELECT * FROM stored EXCEPT ALL SELECT {columns} FROM expected) d) as only_stored,
+        (SELECT COUNT(*) FROM (SELECT {columns} FROM expected EXCEPT ALL SELECT * FROM stored) d) as only_full
+    """
+    with engine.connect() as conn:
+        row = conn.execute(text(query)).one()
+    return {'orders': row.orders, 'only_stored': row.only_stored, 'only_full': row.only_full}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the purchase-interval table")
+    parser.add_argument("command", choices=["refresh", "incremental", "verify", "report"],
+                        help="refresh: rebuild from all orders; incremental: append orders from the "
+                             "latest stored purchase; verify: compare with LAG() over all orders; "
+                             "report: repeat purchases per state")
+    parser.add_argument("--start", help="First purchase date included (report)")
+    parser.add_argument("--end", help="Purchase date the range stops before (report)")
+    parser.add_argument("--min-count", type=int, default=5, help="Minimum repeat purchases per state (report)")
+    args = parser.parse_args()
+
+    if args.command in ("refresh", "incremental"):
+        if not refresh_purchase_intervals(incremental=args.command == "incremental"):
+            raise SystemExit(1)
+    elif args.command == "verify":
+        result = verify_intervals()
+        print(f"Orders:           {result['orders']:,}")
+        print(f"Only in table:    {result['only_stored']:,}")
+        print(f"Only in rebuild:  {result['only_full']:,}")
+        if result['only_stored'] or result['only_full']:
+            print("Mismatch: run `python purchase_intervals.py refresh` to rebuild from all orders")
+            raise SystemExit(1)
+        print("Table matches LAG() over all orders")
+    else:
+        df = get_state_intervals(args.start, args.end, args.min_count)
+        if df is None:
+            raise SystemExit(1)
+        print(df.to_string(index=False))
@@ -0,0 +1,350 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import pandas as pd
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# On-disk result cache for utils.execute_query(..., cache=True).
+#
+# Results are stored as Parquet files keyed by the normalized SQL text plus a
+# data-version fingerprint of every table the query reads, so a cached result
+# is only served while the underlying tables are unchanged.
+
+CACHE_DIR = os.getenv(
+    'QUERY_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.query_cache')
+)
+MAX_CACHE_BYTES = int(float(os.getenv('QUERY_CACHE_MAX_MB', '512')) * 1024 * 1024)
+DEFAULT_TTL_SECONDS = int(os.getenv('QUERY_CACHE_TTL', str(24 * 60 * 60)))
+
+STATS_FILE = 'stats.json'
+
+_stats_lock = threading.Lock()
+
+def normalize_sql(query):
+    """Strip comments and collapse whitespace so formatting changes share a key"""
+    query = re.sub(r'--[^\n]*', ' ', query)
+    query = re.sub(r'/\*.*?\*/', ' ', query, flags=re.DOTALL)
+    return re.sub(r'\s+', ' ', query).strip().rstrip(';').strip()
+
+def referenced_tables(query):
+    """Tables read by a query: FROM/JOIN targets that are not CTE names"""
+    query = normalize_sql(query)
+    cte_names = {name.lower() for name in re.findall(r'(?:\bWITH|,)\s+(\w+)\s+AS\s*\(', query, re.IGNORECASE)}
+    tables = re.findall(r'\b(?:FROM|JOIN)\s+([A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?)', query, re.IGNORECASE)
+    return sorted({t.lower() for t in tables if t.lower() not in cte_names})
+
+# Change log per table, appended to by a statement-level trigger on every
+# INSERT, UPDATE, DELETE and TRUNCATE. The row commits with the write, so a
+# key computed after the commit always sees it; pg_stat_user_tables
+# counters are flushed asynchronously and can lag behind. A table's version
+# is its number of logged statements. The log is append-only, so writers
+# never wait on each other's rows; track_changes() folds it into one row
+# per table, which keeps every sum unchanged.
+#
+# Reading a version never runs DDL: the triggers are installed by the
+# builds that create the tables (typed_schema.py, payment_facts.py, rfm.py,
+# purchase_intervals.py, sales_cube.py) or by `python query_cache.py track`.
+# Tables without the trigger use the pg_stat_user_tables fallback.
+DATA_CHANGES_TABLE = 'public.data_changes'
+VERSION_TRIGGER = 'data_version_bump'
+
+data_changes_ddl = f"""
+CREATE TABLE IF NOT EXISTS {DATA_CHANGES_TABLE} (
+    id bigserial PRIMARY KEY,
+    table_name text NOT NULL,
+    statements bigint NOT NULL DEFAULT 1,
+    changed_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS data_changes_table_name_idx ON {DATA_CHANGES_TABLE} (table_name) INCLUDE (statements);
+
+CREATE OR REPLACE FUNCTION public.bump_data_version()
+RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO {DATA_CHANGES_TABLE} (table_name) VALUES (TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$;
+"""
+
+# Rows deleted here and re-inserted as one per table; rows committed after
+# the DELETE's snapshot are left for the next fold
+compact_changes_query = f"""
+WITH folded AS (
+    DELETE FROM {DATA_CHANGES_TABLE}
+    RETURNING table_name, statements
+)
+INSERT INTO {DATA_CHANGES_TABLE} (table_name, statements)
+SELECT table_name, SUM(statements) FROM folded GROUP BY table_name
+"""
+
+def track_changes(tables, conn):
+    """Install the version trigger on each of the given tables that lacks it.
+
+    Runs in the caller's transaction, so a build that creates a table tracks
+    it in the same commit. Returns the tables now tracked; when the role
+    cannot create the log or add triggers, that is logged and the tables are
+    left to the pg_stat_user_tables fallback.
+    """
+    try:
+        with conn.begin_nested():
+            conn.execute(text(data_changes_ddl))
+            conn.execute(text(compact_changes_query))
+    except Exception as e:
+        logger.warning(f"Cannot create {DATA_CHANGES_TABLE}, falling back to table statistics: {str(e)}")
+        return []
+
+    tracked = []
+    for table in tables:
+        try:
+            with conn.begin_nested():
+                installed = conn.execute(
+                    text("SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = to_regclass(:t) AND tgname = :trigger)"),
+                    {"t": table, "trigger": VERSION_TRIGGER}
+                ).scalar()
+                if not installed:
+                    conn.execute(text(f"""
+                        CREATE TRIGGER {VERSION_TRIGGER}
+                        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                        FOR EACH STATEMENT EXECUTE FUNCTION public.bump_data_version()
+                    """))
+            tracked.append(table)
+        except Exception as e:
+            logger.warning(f"Cannot track changes to {table}, falling back to table statistics: {str(e)}")
+    return tracked
+
+def _read_versions(conn, tables):
+    """(table, relation OIDs, trigger installed, logged statements, statistics) per existing table"""
+    return conn.execute(text(f"""
+        SELECT
+            t.name,
+            ARRAY(
+                -- pg_partition_tree() has no rows for a plain table
+                SELECT relid::oid::bigint FROM pg_partition_tree(t.root)
+                UNION SELECT t.root::oid::bigint
+                ORDER BY 1
+            ),
+            EXISTS (SELECT 1 FROM pg_trigger tr WHERE tr.tgrelid = t.root AND tr.tgname = :trigger),
+            (SELECT COALESCE(SUM(d.statements), 0) FROM {DATA_CHANGES_TABLE} d
+             WHERE d.table_name = n.nspname || '.' || c.relname),
+            ARRAY(
+                SELECT ARRAY[s.relid::bigint, s.n_live_tup, s.n_tup_ins, s.n_tup_upd, s.n_tup_del]
+                FROM pg_stat_user_tables s
+                WHERE s.relid IN (SELECT relid FROM pg_partition_tree(t.root) UNION SELECT t.root)
+                ORDER BY 1
+            )
+        FROM (SELECT name, to_regclass(name) as root FROM unnest(CAST(:tables AS text[])) name) t
+        JOIN pg_class c ON c.oid = t.root
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        ORDER BY t.name
+    """), {"tables": list(tables), "trigger": VERSION_TRIGGER}).fetchall()
+
+def get_data_version(tables, engine):
+    """Fingerprint of the current contents of each table; read-only.
+
+    Uses the relation OIDs (they change when a table is rebuilt and swapped
+    in, and include partitions) and, for tracked tables, the number of
+    statements logged in data_changes. Untracked tables use the
+    live/insert/update/delete counters from pg_stat_user_tables, which may
+    lag a just-committed write.
+    """
+    version = {table: {'relations': []} for table in tables}
+    with engine.connect() as conn:
+        if conn.execute(text("SELECT to_regclass(:name)"), {"name": DATA_CHANGES_TABLE}).scalar() is None:
+            return _stats_version(tables, engine)
+        rows = _read_versions(conn, tables)
+
+    for table, relations, tracked, counter, stats in rows:
+        entry = version[table]
+        entry['relations'] = list(relations)
+        if tracked:
+            entry['version'] = counter
+        else:
+            entry['stats'] = [list(row) for row in stats]
+    return version
+
+def _stats_version(tables, engine):
+    """Fingerprint from relation OIDs and pg_stat_user_tables counters only"""
+    version = {}
+    with engine.connect() as conn:
+        for table in tables:
+            rows = conn.execute(text("""
+                SELECT
+                    tree.relid::oid::bigint,
+                    COALESCE(s.n_live_tup, 0),
+                    COALESCE(s.n_tup_ins, 0),
+                    COALESCE(s.n_tup_upd, 0),
+                    COALESCE(s.n_tup_del, 0)
+                FROM (
+                    SELECT relid FROM pg_partition_tree(to_regclass(:table_name))
+                    UNION
+                    SELECT to_regclass(:table_name)
+                ) tree
+                LEFT JOIN pg_stat_user_tables s ON s.relid = tree.relid
+                WHERE tree.relid IS NOT NULL
+                ORDER BY 1
+            """), {"table_name": table}).fetchall()
+            version[table] = {'relations': [list(row) for row in rows]}
+    return version
+
+def cache_key(query, engine):
+    """Cache key for a query given the current data version of its tables"""
+    normalized = normalize_sql(query)
+    version = get_data_version(referenced_tables(query), engine)
+    payload = json.dumps({'sql': normalized, 'data_version': version}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _paths(key, cache_dir):
+    return os.path.join(cache_dir, f"{key}.parquet"), os.path.join(cache_dir, f"{key}.json")
+
+def _bump(counter, cache_dir, amount=1):
+    """Add to a persistent hit/miss/eviction counter"""
+    path = os.path.join(cache_dir, STATS_FILE)
+    with _stats_lock:
+        stats = read_stats(cache_dir)
+        stats[counter] = stats.get(counter, 0) + amount
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(stats, f)
+
+def read_stats(cache_dir=CACHE_DIR):
+    """Hit/miss/eviction counters accumulated since the cache was last cleared"""
+    path = os.path.join(cache_dir, STATS_FILE)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def get(key, ttl=DEFAULT_TTL_SECONDS, cache_dir=CACHE_DIR):
+    """Return the cached DataFrame for a key, or None on a miss or expiry"""
+    data_path, meta_path = _paths(key, cache_dir)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if time.time() - meta['created_at'] > ttl:
+            _remove(key, cache_dir)
+            _bump('misses', cache_dir)
+            return None
+        df = pd.read_parquet(data_path)
+        # The data file's mtime doubles as the LRU access time
+        os.utime(data_path, None)
+    except (OSError, ValueError, KeyError):
+        _bump('misses', cache_dir)
+        return None
+    _bump('hits', cache_dir)
+    return df
+
+def put(key, df, query, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """Store a result and evict least recently used entries over the size limit"""
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path, meta_path = _paths(key, cache_dir)
+    tmp_path = f"{data_path}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, data_path)
+    except Exception as e:
+        # e.g. no Parquet engine installed, or a column type Parquet can't hold
+        logger.warning(f"Could not cache query result: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    with open(meta_path, 'w') as f:
+        json.dump({'created_at': time.time(), 'sql': normalize_sql(query),
+                   'bytes': os.path.getsize(data_path)}, f)
+    evict(cache_dir, max_bytes)
+    return True
+
+def _remove(key, cache_dir):
+    for path in _paths(key, cache_dir):
+        if os.path.exists(path):
+            os.remove(path)
+
+def _entries(cache_dir):
+    """(last access time, size, key) for every cached result"""
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for name in os.listdir(cache_dir):
+        if name.endswith('.parquet'):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, name[:-len('.parquet')]))
+    return entries
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """Remove least recently used entries until the cache fits in max_bytes"""
+    entries = sorted(_entries(cache_dir))
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, key in entries:
+        if total <= max_bytes:
+            break
+        _remove(key, cache_dir)
+        total -= size
+        evicted += 1
+    if evicted:
+        _bump('evictions', cache_dir, evicted)
+    return evicted
+
+def clear(cache_dir=CACHE_DIR):
+    """Delete every cached result and reset the counters"""
+    removed = 0
+    for _, _, key in _entries(cache_dir):
+        _remove(key, cache_dir)
+        removed += 1
+    stats_path = os.path.join(cache_dir, STATS_FILE)
+    if os.path.exists(stats_path):
+        os.remove(stats_path)
+    return removed
+
+def summary(cache_dir=CACHE_DIR):
+    """Entry count, size and hit/miss counters"""
+    entries = _entries(cache_dir)
+    stats = read_stats(cache_dir)
+    lookups = stats.get('hits', 0) + stats.get('misses', 0)
+    return {
+        'entries': len(entries),
+        'size_mb': sum(size for _, size, _ in entries) / (1024 * 1024),
+        'max_size_mb': MAX_CACHE_BYTES / (1024 * 1024),
+        'hits': stats.get('hits', 0),
+        'misses': stats.get('misses', 0),
+        'evictions': stats.get('evictions', 0),
+        'hit_rate': stats.get('hits', 0) / lookups if lookups else 0.0,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the on-disk query result cache")
+    parser.add_argument("command", choices=["stats", "clear", "track"],
+                        help="stats: show size and hit/miss counters; clear: delete all entries; "
+                             "track: install the version trigger on tables")
+    parser.add_argument("tables", nargs="*", help="Tables to track, e.g. analytics.orders (track)")
+    args = parser.parse_args()
+
+    if args.command == "track":
+        from utils import get_db_connection
+
+        engine = get_db_connection()
+        if engine is None:
+            raise SystemExit(1)
+        with engine.begin() as conn:
+            tracked = track_changes(args.tables, conn)
+        print(f"Tracking {len(tracked)} of {len(args.tables)} tables: {', '.join(tracked)}")
+        if len(tracked) < len(args.tables):
+            raise SystemExit(1)
+    elif args.command == "clear":
+        print(f"Removed {clear()} cached results from {CACHE_DIR}")
+    else:
+        info = summary()
+        print(f"Cache directory:  {CACHE_DIR}")
+        print(f"Entries:          {info['entries']:,}")
+        print(f"Size:             {info['size_mb']:.1f} MB of {info['max_size_mb']:.0f} MB")
+        print(f"Hits / misses:    {info['hits']:,} / {info['misses']:,} ({info['hit_rate']:.1%} hit rate)")
+        print(f"Evictions:        {info['evictions']:,}")
@@ -0,0 +1,195 @@
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Per-query instrumentation for utils.execute_query.
+#
+# Every call produces one record: label, wall time split into database time
+# (cursor execute) and fetch plus DataFrame-construction time, rows and result
+# memory.
+# With QUERY_METRICS=1 records are appended to a JSON-lines log and folded
+# into a Prometheus text file (for node_exporter's textfile collector). With
+# QUERY_EXPLAIN_SLOW_MS set, queries slower than that are re-run under
+# EXPLAIN (ANALYZE, BUFFERS) and the plan is stored with the record.
+
+METRICS_DIR = os.getenv(
+    'QUERY_METRICS_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.query_metrics')
+)
+LOG_FILE = 'queries.jsonl'
+PROM_FILE = 'queries.prom'
+
+_lock = threading.Lock()
+_totals = {}
+
+def enabled():
+    return os.getenv('QUERY_METRICS', '').lower() in ('1', 'true', 'yes')
+
+def explain_threshold():
+    """Slow-query threshold in seconds for EXPLAIN capture, or None when off"""
+    value = os.getenv('QUERY_EXPLAIN_SLOW_MS')
+    return float(value) / 1000 if value else None
+
+def explain_analyze(query, engine):
+    """EXPLAIN (ANALYZE, BUFFERS) plan of a read-only query, as JSON.
+
+    ANALYZE executes the statement, so anything but SELECT/WITH is refused;
+    the transaction is rolled back either way.
+    """
+    if not re.match(r'\s*(SELECT|WITH)\b', query, re.IGNORECASE):
+        return None
+    with engine.connect() as conn:
+        plan = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query.strip().rstrip(';')}")).scalar()
+        conn.rollback()
+    return plan[0] if isinstance(plan, list) else json.loads(plan)[0]
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+def write_prometheus(totals, path):
+    """Write per-label totals in the Prometheus text exposition format"""
+    metrics = [
+        ('olist_query_calls_total', 'counter', 'Queries executed', 'calls'),
+        ('olist_query_cache_hits_total', 'counter', 'Queries served from the result cache', 'cache_hits'),
+        ('olist_query_wall_seconds_total', 'counter', 'Wall time spent in execute_query', 'wall_seconds'),
+        ('olist_query_db_seconds_total', 'counter', 'Time spent executing on the server', 'db_seconds'),
+        ('olist_query_frame_seconds_total', 'counter', 'Time spent fetching and building DataFrames', 'frame_seconds'),
+        ('olist_query_rows_total', 'counter', 'Rows returned', 'rows'),
+        ('olist_query_last_wall_seconds', 'gauge', 'Wall time of the latest call', 'last_wall_seconds'),
+        ('olist_query_last_result_bytes', 'gauge', 'Memory size of the latest result', 'last_result_bytes'),
+    ]
+    lines = []
+    for name, kind, help_text, field in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for label, values in sorted(totals.items()):
+            lines.append(f'{name}{{query="{_escape(label)}"}} {values[field]}')
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+def _fold(totals, record):
+    values = totals.setdefault(record['label'], {
+        'calls': 0, 'cache_hits': 0, 'wall_seconds': 0.0, 'db_seconds': 0.0, 'frame_seconds': 0.0,
+        'rows': 0, 'last_wall_seconds': 0.0, 'last_result_bytes': 0,
+    })
+    values['calls'] += 1
+    values['cache_hits'] += int(record['cached'])
+    values['wall_seconds'] += record['wall_seconds']
+    values['db_seconds'] += record['db_seconds']
+    values['frame_seconds'] += record['frame_seconds']
+    values['rows'] += record['rows']
+    values['last_wall_seconds'] = record['wall_seconds']
+    values['last_result_bytes'] = record['result_bytes']
+
+def record(label, query, wall_seconds, db_seconds, frame_seconds, df, cached=False, engine=None,
+           metrics_dir=METRICS_DIR):
+    """Log one execute_query call and, when enabled, persist it.
+
+    Returns the record dict.
+    """
+    entry = {
+        'ts': time.time(),
+        'label': label,
+        'cached': cached,
+        'wall_seconds': round(wall_seconds, 6),
+        'db_seconds': round(db_seconds, 6),
+        'frame_seconds': round(frame_seconds, 6),
+        'rows': len(df),
+        'result_bytes': int(df.memory_usage(deep=True).sum()),
+    }
+    logger.info(f"Query {label}: {entry['rows']:,} rows in {wall_seconds:.3f}s "
+                f"(db {db_seconds:.3f}s, frame {frame_seconds:.3f}s, "
+                f"{entry['result_bytes'] / (1024 * 1024):.1f} MB){' [cached]' if cached else ''}")
+
+    threshold = explain_threshold()
+    if threshold is not None and not cached and engine is not None and wall_seconds >= threshold:
+        try:
+            entry['plan'] = explain_analyze(query, engine)
+        except Exception as e:
+            logger.warning(f"Could not capture EXPLAIN ANALYZE for {label}: {str(e)}")
+
+    if enabled():
+        os.makedirs(metrics_dir, exist_ok=True)
+        with _lock:
+            with open(os.path.join(metrics_dir, LOG_FILE), 'a') as f:
+                f.write(json.dumps(entry, default=str) + "\n")
+            _fold(_totals, entry)
+            write_prometheus(_totals, os.path.join(metrics_dir, PROM_FILE))
+    return entry
+
+def read_log(metrics_dir=METRICS_DIR, label=None):
+    """All records in the JSON-lines log, optionally for one label"""
+    import pandas as pd
+
+    path = os.path.join(metrics_dir, LOG_FILE)
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    df = pd.read_json(path, lines=True)
+    if label is not None:
+        df = df[df['label'] == label]
+    return df
+
+def summary(metrics_dir=METRICS_DIR):
+    """Per-label call counts and wall-time percentiles from the log"""
+    df = read_log(metrics_dir)
+    if df.empty:
+        return df
+    df = df[~df['cached']]
+    grouped = df.groupby('label')
+    return grouped.agg(
+        calls=('wall_seconds', 'size'),
+        p50_seconds=('wall_seconds', 'median'),
+        p95_seconds=('wall_seconds', lambda s: s.quantile(0.95)),
+        db_share=('db_seconds', 'sum'),
+        last_rows=('rows', 'last'),
+        last_mb=('result_bytes', lambda s: s.iloc[-1] / (1024 * 1024)),
+    ).assign(db_share=lambda t: t['db_share'] / grouped['wall_seconds'].sum()).sort_values('p50_seconds',
+                                                                                         ascending=False)
+
+def export_prometheus(metrics_dir=METRICS_DIR):
+    """Rebuild the Prometheus file from the whole log (e.g. across processes)"""
+    totals = {}
+    path = os.path.join(metrics_dir, LOG_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                _fold(totals, json.loads(line))
+    write_prometheus(totals, os.path.join(metrics_dir, PROM_FILE))
+    return len(totals)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect the query metrics log")
+    parser.add_argument("command", choices=["summary", "plans", "export"],
+                        help="summary: per-query timings; plans: captured slow-query plans; "
+                             "export: rebuild the Prometheus file from the log")
+    parser.add_argument("--label", help="Only this query label (plans)")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        print(f"Wrote {export_prometheus()} query labels to {os.path.join(METRICS_DIR, PROM_FILE)}")
+    elif args.command == "plans":
+        log = read_log(label=args.label)
+        if log.empty or 'plan' not in log:
+            print("No plans captured; set QUERY_EXPLAIN_SLOW_MS to enable capture")
+        else:
+            for _, row in log[log['plan'].notna()].iterrows():
+                plan = row['plan']
+                print(f"\n{row['label']} ({row['wall_seconds']:.3f}s, "
+                      f"execution {plan.get('Execution Time', 0):.1f} ms)")
+                print(json.dumps(plan['Plan'], indent=2))
+    else:
+        table = summary()
+        if table.empty:
+            print(f"No queries logged in {METRICS_DIR}; run with QUERY_METRICS=1")
+        else:
+            print(table.round(3).to_string())
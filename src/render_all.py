@@ -0,0 +1,142 @@
+import argparse
+import hashlib
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'images')
+MANIFEST_NAME = '.render_manifest.json'
+
+# Chart name (output file stem) -> (module, data function, plot function)
+CHARTS = {
+    'state_performance_quadrants': ('performance_quadrant', 'get_quadrant_data', 'plot_quadrants'),
+    'customer_segments_by_state': ('segments_by_state', 'get_state_segment_data',
+                                   'plot_state_segment_distribution'),
+    'sp_top_categories': ('sp_top_categories', 'get_sp_category_data', 'plot_categories'),
+    'installments_by_segment': ('installments_by_segment', 'get_segment_data', 'plot_segment_analysis'),
+}
+
+def _init_worker():
+    # Headless: select Agg before any chart module imports pyplot
+    import matplotlib
+    matplotlib.use('Agg')
+
+def hash_frame(df):
+    """Content hash of a DataFrame: values, index, column names and dtypes"""
+    import pandas as pd
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps([str(c) for c in df.columns]).encode('utf-8'))
+    digest.update(json.dumps([str(t) for t in df.dtypes]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+def render_key(module_name, df, params):
+    """Hash of everything that determines a chart's pixels.
+
+    Covers the input data, the render parameters and the chart module's
+    source, so both data changes and styling edits trigger a re-render.
+    """
+    module = importlib.import_module(module_name)
+    with open(module.__file__, 'rb') as f:
+        source_hash = hashlib.sha256(f.read()).hexdigest()
+    payload = json.dumps({'data': hash_frame(df), 'params': params, 'source': source_hash}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def render_chart(name, output_dir, params, previous_key=None, force=False):
+    """Fetch one chart's data and render it to a file unless nothing changed.
+
+    Runs in a worker process. Returns (name, status, key, seconds).
+    """
+    start = time.perf_counter()
+    module_name, data_function, plot_function = CHARTS[name]
+    module = importlib.import_module(module_name)
+
+    df = getattr(module, data_function)()
+    if df is None or df.empty:
+        return name, 'no data', previous_key, time.perf_counter() - start
+
+    key = render_key(module_name, df, params)
+    path = os.path.join(output_dir, f"{name}.{params['format']}")
+    if not force and key == previous_key and os.path.exists(path):
+        return name, 'unchanged', key, time.perf_counter() - start
+
+    import matplotlib.pyplot as plt
+
+    fig = getattr(module, plot_function)(df)
+    fig.savefig(path, dpi=params['dpi'], bbox_inches='tight')
+    plt.close(fig)
+    return name, 'rendered', key, time.perf_counter() - start
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def render_all(charts=None, output_dir=IMAGES_DIR, dpi=100, fmt='png', workers=None, force=False):
+    """Render charts in parallel worker processes, skipping unchanged ones.
+
+    Returns a list of (name, status, seconds).
+    """
+    charts = charts or list(CHARTS)
+    params = {'dpi': dpi, 'format': fmt}
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers or min(len(charts), os.cpu_count() or 1),
+                             initializer=_init_worker) as pool:
+        futures = {
+            pool.submit(render_chart, name, output_dir, params, manifest.get(f"{name}.{fmt}"), force): name
+            for name in charts
+        }
+        for future in as_completed(futures):
+            try:
+                name, status, key, seconds = future.result()
+            except Exception as e:
+                logger.error(f"Error rendering {futures[future]}: {e.__class__.__name__}: {str(e)}")
+                results.append((futures[future], 'failed', 0.0))
+                continue
+            if key is not None:
+                manifest[f"{name}.{fmt}"] = key
+            results.append((name, status, seconds))
+
+    save_manifest(output_dir, manifest)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render every chart to image files without a display")
+    parser.add_argument("charts", nargs="*",
+                        help=f"Charts to render (default: all): {', '.join(CHARTS)}")
+    parser.add_argument("--output-dir", default=IMAGES_DIR, help="Where to write the images")
+    parser.add_argument("--format", default="png", choices=["png", "svg", "pdf"])
+    parser.add_argument("--dpi", type=int, default=100)
+    parser.add_argument("--workers", type=int, help="Worker processes (default: one per chart, up to CPU count)")
+    parser.add_argument("--force", action="store_true", help="Re-render even if nothing changed")
+    args = parser.parse_args()
+    unknown = [name for name in args.charts if name not in CHARTS]
+    if unknown:
+        parser.error(f"unknown charts: {', '.join(unknown)}")
+
+    start = time.perf_counter()
+    results = render_all(args.charts, args.output_dir, args.dpi, args.format, args.workers, args.force)
+    for name, status, seconds in sorted(results):
+        print(f"{name:<32}{status:<12}{seconds:>8.2f}s")
+    print(f"\nTotal: {time.perf_counter() - start:.2f}s")
+
+    if any(status == 'failed' for _, status, _ in results):
+        sys.exit(1)
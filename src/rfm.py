@@ -0,0 +1,345 @@
+import argparse
+import logging
+import time
+from sqlalchemy import text
+from query_cache import track_changes
+from utils import get_db_connection, get_rfm_build_info, RFM_SEGMENTS_TABLE
+from typed_schema import purchase_window_sql
+
+logger = logging.getLogger(__name__)
+
+# Shared RFM layer: one row per (customer_unique_id, customer_state) with the
+# raw recency/frequency/monetary values, their NTILE(5) scores and the segment.
+# Built once by `python rfm.py refresh` from the typed analytics tables (see
+# typed_schema.py) and read by every segment analysis.
+# NTILE scoring and segment rules shared by the full query and the incremental
+# build; both feed it a customer_rfm CTE with identical columns
+rfm_scoring_sql = """
+rfm_scores AS (
+    -- Ties are broken by customer so bucket edges are reproducible
+    -- (rfm_engine.py relies on this for exact parity)
+    SELECT
+        *,
+        NTILE(5) OVER (ORDER BY recency DESC, customer_unique_id COLLATE "C", customer_state COLLATE "C") as R,
+        NTILE(5) OVER (ORDER BY frequency, customer_unique_id COLLATE "C", customer_state COLLATE "C") as F,
+        NTILE(5) OVER (ORDER BY monetary, customer_unique_id COLLATE "C", customer_state COLLATE "C") as M
+    FROM customer_rfm
+)
+SELECT
+    *,
+    CASE
+        WHEN (R >= 4 AND F >= 4 AND M >= 4) THEN 'Champions'
+        WHEN (R >= 3 AND F >= 3 AND M >= 3) THEN 'Loyal Customers'
+        WHEN (R <= 2 AND F >= 3 AND M >= 3) THEN 'At Risk'
+        WHEN (R <= 2 AND F <= 2 AND M <= 2) THEN 'Lost'
+        ELSE 'Others'
+    END as customer_segment
+FROM rfm_scores
+"""
+
+def build_rfm_segments_query(customer_filter=None, start=None, end=None):
+    """Full RFM computation, optionally over the rows matching a SQL
+    condition on `c`, `o` and `oi` (customers, orders and order_items), e.g.
+    a sampling predicate.
+
+    `start`/`end` limit it to orders purchased in that range (end
+    exclusive): recency is then measured from the latest purchase in the
+    range rather than in all history, and every orders-side table is
+    filtered so only the range's partitions are read.
+    """
+    condition = f"\n        AND {customer_filter}" if customer_filter else ""
+    condition += purchase_window_sql(['o', 'oi'], start, end)
+    anchor_filter = purchase_window_sql(['orders'], start, end, keyword='WHERE', indent=4)
+    return f"""
+WITH last_date AS (
+    SELECT MAX(order_purchase_timestamp) as max_date
+    FROM analytics.orders{anchor_filter}
+),
+customer_rfm AS (
+    SELECT
+        c.customer_unique_id,
+        c.customer_state,
+        EXTRACT(DAYS FROM (
+            (SELECT max_date FROM last_date) -
+            MAX(o.order_purchase_timestamp)
+        )) as recency,
+        COUNT(DISTINCT o.order_id) as frequency,
+        SUM(oi.price + oi.freight_value)::DECIMAL(10,2) as monetary
+    FROM analytics.customers c
+    JOIN analytics.orders o ON c.customer_id = o.customer_id
+    JOIN analytics.order_items oi ON o.order_id = oi.order_id
+    WHERE o.order_status = 'delivered'{condition}
+    GROUP BY c.customer_unique_id, c.customer_state
+),{rfm_scoring_sql}"""
+
+# Full computation over all history; the reference the incremental state is
+# verified against
+rfm_segments_query = build_rfm_segments_query()
+
+# Incremental state: running per-customer aggregates of delivered orders,
+# the orders already folded into them and the watermark from which orders
+# are still scanned. Orders purchased before the watermark are settled:
+# folded, or in a final status other than delivered. Orders still open
+# (shipped, processing, ...) hold the watermark back so they are folded
+# once delivered, but only for PENDING_WINDOW_DAYS; an order delivered
+# later than that is only picked up by a full refresh.
+AGGREGATES_TABLE = f"{RFM_SEGMENTS_TABLE}_aggregates"
+WATERMARK_TABLE = f"{RFM_SEGMENTS_TABLE}_watermark"
+FOLDED_TABLE = f"{RFM_SEGMENTS_TABLE}_folded_orders"
+
+SETTLED_STATUSES = ('delivered', 'canceled', 'unavailable')
+PENDING_WINDOW_DAYS = 90
+
+incremental_state_ddl = f"""
+CREATE TABLE IF NOT EXISTS {AGGREGATES_TABLE} (
+    customer_unique_id text NOT NULL,
+    customer_state text NOT NULL,
+    last_purchase timestamp NOT NULL,
+    frequency bigint NOT NULL,
+    monetary numeric NOT NULL,
+    PRIMARY KEY (customer_unique_id, customer_state)
+);
+CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+    watermark timestamp NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS {FOLDED_TABLE} (
+    order_id text PRIMARY KEY,
+    order_purchase_timestamp timestamp NOT NULL
+);
+"""
+
+# Delivered orders from the watermark on that are not folded yet, marked as
+# folded and added to the running totals per customer. The range predicates
+# prune orders and order_items to the months from the watermark on, so the
+# cost follows the size of that window.
+fold_delta_query = f"""
+WITH delta AS (
+    SELECT o.order_id, o.customer_id, o.order_purchase_timestamp
+    FROM analytics.orders o
+    WHERE o.order_status = 'delivered'
+        AND o.order_purchase_timestamp >= CAST(:watermark AS timestamp)
+        AND NOT EXISTS (SELECT 1 FROM {FOLDED_TABLE} f WHERE f.order_id = o.order_id)
+),
+marked AS (
+    INSERT INTO {FOLDED_TABLE} (order_id, order_purchase_timestamp)
+    SELECT order_id, order_purchase_timestamp FROM delta
+)
+INSERT INTO {AGGREGATES_TABLE} AS a
+    (customer_unique_id, customer_state, last_purchase, frequency, monetary)
+SELECT
+    c.customer_unique_id,
+    c.customer_state,
+    MAX(d.order_purchase_timestamp),
+    COUNT(DISTINCT d.order_id),
+    SUM(oi.price + oi.freight_value)
+FROM delta d
+JOIN analytics.customers c ON c.customer_id = d.customer_id
+JOIN analytics.order_items oi ON oi.order_id = d.order_id
+WHERE oi.order_purchase_timestamp >= CAST(:watermark AS timestamp)
+GROUP BY c.customer_unique_id, c.customer_state
+ON CONFLICT (customer_unique_id, customer_state) DO UPDATE SET
+    last_purchase = GREATEST(a.last_purchase, EXCLUDED.last_purchase),
+    frequency = a.frequency + EXCLUDED.frequency,
+    monetary = a.monetary + EXCLUDED.monetary
+"""
+
+# Next watermark: the oldest order still open, but no more than
+# PENDING_WINDOW_DAYS before the latest purchase, and never moving back
+next_watermark_query = f"""
+SELECT GREATEST(
+    CAST(:watermark AS timestamp),
+    CAST(:max_date AS timestamp) - interval '{PENDING_WINDOW_DAYS} days',
+    LEAST(
+        CAST(:max_date AS timestamp),
+        (SELECT MIN(order_purchase_timestamp) FROM analytics.orders
+         WHERE order_purchase_timestamp >= CAST(:watermark AS timestamp)
+            AND order_purchase_timestamp >= CAST(:max_date AS timestamp) - interval '{PENDING_WINDOW_DAYS} days'
+            AND order_status NOT IN ({", ".join(f"'{status}'" for status in SETTLED_STATUSES)}))
+    )
+)
+"""
+
+# Scores and segments from the running aggregates; recency is anchored on
+# MAX(order_purchase_timestamp) over all orders
+rfm_aggregates_query = f"""
+WITH customer_rfm AS (
+    SELECT
+        customer_unique_id,
+        customer_state,
+        EXTRACT(DAYS FROM (CAST(:max_date AS timestamp) - last_purchase)) as recency,
+        frequency,
+        monetary::DECIMAL(10,2) as monetary
+    FROM {AGGREGATES_TABLE}
+),{rfm_scoring_sql}"""
+
+build_log_ddl = f"""
+CREATE TABLE IF NOT EXISTS {RFM_SEGMENTS_TABLE}_build_log (
+    built_at timestamptz NOT NULL DEFAULT now(),
+    customer_count integer NOT NULL,
+    max_purchase_date timestamp,
+    build_seconds numeric(10, 3)
+);
+ALTER TABLE {RFM_SEGMENTS_TABLE}_build_log ADD COLUMN IF NOT EXISTS build_mode text;
+ALTER TABLE {RFM_SEGMENTS_TABLE}_build_log ADD COLUMN IF NOT EXISTS delta_customers integer;
+"""
+
+def refresh_rfm_segments(engine=None, incremental=False):
+    """Rebuild the RFM segments table and record the build.
+
+    A full refresh resets the running aggregates and folds in all history.
+    An incremental refresh folds in the delivered orders purchased from the
+    stored watermark on that are not folded yet, including orders that
+    were still open at the last refresh and have been delivered since, then
+    recomputes the quintiles and segments from the aggregates (one row per
+    customer). With nothing new to fold and no newer purchase it does
+    nothing. Orders arriving with a purchase timestamp before the
+    watermark, orders delivered more than PENDING_WINDOW_DAYS after
+    purchase and orders that stop being delivered are only picked up by a
+    full refresh.
+    """
+    try:
+        if engine is None:
+            engine = get_db_connection()
+
+        if engine is None:
+            raise Exception("Failed to establish database connection")
+
+        start = time.perf_counter()
+        mode = 'incremental' if incremental else 'full'
+        # Build into a side table and swap it in, all in one transaction, so
+        # readers keep seeing the previous build until the new one commits.
+        with engine.begin() as conn:
+            # Serialize refreshes: two concurrent folds would double count
+            conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": RFM_SEGMENTS_TABLE})
+            conn.execute(text(build_log_ddl))
+            if incremental and conn.execute(text("SELECT to_regclass(:t)"), {"t": FOLDED_TABLE}).scalar() is None:
+                # State from before folded orders were tracked cannot tell which are in
+                logger.info(f"No {FOLDED_TABLE} yet; running a full refresh")
+                incremental, mode = False, 'full'
+            conn.execute(text(incremental_state_ddl))
+            if not incremental:
+                conn.execute(text(f"TRUNCATE {AGGREGATES_TABLE}, {WATERMARK_TABLE}, {FOLDED_TABLE}"))
+
+            watermark = conn.execute(text(f"SELECT MAX(watermark) FROM {WATERMARK_TABLE}")).scalar()
+            params = {"watermark": watermark or '-infinity'}
+            max_date = conn.execute(
+                text("SELECT MAX(order_purchase_timestamp) FROM analytics.orders "
+                     "WHERE order_purchase_timestamp >= CAST(:watermark AS timestamp)"),
+                params
+            ).scalar()
+            delta_customers = conn.execute(text(fold_delta_query), params).rowcount
+
+            segments_exist = conn.execute(text("SELECT to_regclass(:t)"), {"t": RFM_SEGMENTS_TABLE}).scalar()
+            if incremental and segments_exist and delta_customers == 0:
+                last_max_date = conn.execute(text(
+                    f"SELECT max_purchase_date FROM {RFM_SEGMENTS_TABLE}_build_log ORDER BY built_at DESC LIMIT 1"
+                )).scalar()
+                if last_max_date == max_date:
+                    logger.info(f"{RFM_SEGMENTS_TABLE} is up to date (watermark {watermark})")
+                    return True
+
+            max_date = max_date or watermark
+            if max_date is not None:
+                new_watermark = conn.execute(text(next_watermark_query),
+                                             {**params, "max_date": max_date}).scalar()
+                conn.execute(text(f"DELETE FROM {WATERMARK_TABLE}"))
+                conn.execute(text(f"INSERT INTO {WATERMARK_TABLE} (watermark) VALUES (:watermark)"),
+                             {"watermark": new_watermark})
+                # Orders before the watermark are never scanned again
+                conn.execute(text(f"DELETE FROM {FOLDED_TABLE} "
+                                  f"WHERE order_purchase_timestamp < CAST(:watermark AS timestamp)"),
+                             {"watermark": new_watermark})
+
+            conn.execute(text(f"DROP TABLE IF EXISTS {RFM_SEGMENTS_TABLE}_build"))
+            conn.execute(text(f"CREATE TABLE {RFM_SEGMENTS_TABLE}_build AS {rfm_aggregates_query}"),
+                         {"max_date": max_date})
+            conn.execute(text(f"DROP TABLE IF EXISTS {RFM_SEGMENTS_TABLE}"))
+            conn.execute(text(f"ALTER TABLE {RFM_SEGMENTS_TABLE}_build RENAME TO {RFM_SEGMENTS_TABLE}"))
+            conn.execute(text(
+                f"CREATE INDEX {RFM_SEGMENTS_TABLE}_unique_id_idx "
+                f"ON {RFM_SEGMENTS_TABLE} (customer_unique_id)"
+            ))
+            conn.execute(text(
+                f"CREATE INDEX {RFM_SEGMENTS_TABLE}_state_segment_idx "
+                f"ON {RFM_SEGMENTS_TABLE} (customer_state, customer_segment)"
+            ))
+            track_changes([RFM_SEGMENTS_TABLE], conn)
+            customer_count = conn.execute(text(f"SELECT COUNT(*) FROM {RFM_SEGMENTS_TABLE}")).scalar()
+            conn.execute(
+                text(f"""
+                    INSERT INTO {RFM_SEGMENTS_TABLE}_build_log
+                        (customer_count, max_purchase_date, build_seconds, build_mode, delta_customers)
+                    VALUES (:customer_count, :max_date, :build_seconds, :mode, :delta_customers)
+                """),
+                {"customer_count": customer_count, "max_date": max_date, "mode": mode,
+                 "build_seconds": time.perf_counter() - start, "delta_customers": delta_customers}
+            )
+            conn.execute(text(f"ANALYZE {AGGREGATES_TABLE}"))
+            conn.execute(text(f"ANALYZE {RFM_SEGMENTS_TABLE}"))
+
+        logger.info(f"Rebuilt {RFM_SEGMENTS_TABLE} ({mode}): {customer_count:,} rows, "
+                    f"{delta_customers:,} customers updated in {time.perf_counter() - start:.2f}s")
+        return True
+    except Exception as e:
+        logger.error(f"Error refreshing RFM segments: {str(e)}")
+        return False
+
+def verify_incremental(engine=None):
+    """Compare the current RFM table with a full rebuild from all history.
+
+    Returns counts of rows only in the stored table and only in the full
+    computation; both are zero when the incremental state is exact.
+    """
+    if engine is None:
+        engine = get_db_connection()
+
+    columns = "customer_unique_id, customer_state, recency, frequency, monetary, r, f, m, customer_segment"
+    query = f"""
+    WITH full_rebuild AS ({rfm_segments_query}),
+    stored AS (SELECT {columns} FROM {RFM_SEGMENTS_TABLE}),
+    expected AS (SELECT {columns} FROM full_rebuild)
+    SELECT
+        (SELECT COUNT(*) FROM stored) as customers,
+        (SELECT COUNT(*) FROM (SELECT * FROM stored EXCEPT ALL SELECT * FROM expected) d) as only_stored,
+        (SELECT COUNT(*) FROM (SELECT * FROM expected EXCEPT ALL SELECT * FROM stored) d) as only_full
+    """
+    with engine.connect() as conn:
+        row = conn.execute(text(query)).one()
+    return {'customers': row.customers, 'only_stored': row.only_stored, 'only_full': row.only_full}
+
+def print_status(engine=None):
+    """Print when the RFM layer was last built"""
+    info = get_rfm_build_info(engine)
+    if info is None:
+        print(f"{RFM_SEGMENTS_TABLE} has not been built yet; run `python rfm.py refresh`")
+        return
+    print(f"Table:            {RFM_SEGMENTS_TABLE}")
+    print(f"Built at:         {info['built_at']}")
+    print(f"Customers:        {info['customer_count']:,}")
+    print(f"Data as of:       {info['max_purchase_date']}")
+    print(f"Build time:       {float(info['build_seconds']):.2f}s")
+    if info.get('build_mode'):
+        print(f"Build mode:       {info['build_mode']} ({int(info['delta_customers'] or 0):,} customers updated)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the shared RFM segments table")
+    parser.add_argument("command", choices=["refresh", "incremental", "verify", "status"],
+                        help="refresh: rebuild from all history; incremental: fold in orders past the "
+                             "watermark; verify: compare with a full rebuild; status: show the last build")
+    args = parser.parse_args()
+
+    if args.command in ("refresh", "incremental"):
+        if not refresh_rfm_segments(incremental=args.command == "incremental"):
+            raise SystemExit(1)
+    elif args.command == "verify":
+        result = verify_incremental()
+        print(f"Customers:        {result['customers']:,}")
+        print(f"Only in table:    {result['only_stored']:,}")
+        print(f"Only in rebuild:  {result['only_full']:,}")
+        if result['only_stored'] or result['only_full']:
+            print("Mismatch: run `python rfm.py refresh` to rebuild from all history")
+            raise SystemExit(1)
+        print("Incremental state matches a full rebuild")
+        raise SystemExit(0)
+    print_status()
@@ -0,0 +1,206 @@
+import argparse
+import sys
+import time
+import numpy as np
+import pandas as pd
+from utils import execute_query, RFM_SEGMENTS_TABLE
+
+# In-process RFM scoring. Recency/frequency/monetary and the NTILE(5) scores
+# are computed once; re-segmenting under a different rule set is then a
+# vectorized pass over small integer arrays, so many threshold variants can be
+# compared without going back to the database.
+
+# Segment rules in priority order, mirroring the CASE in rfm.py. Each rule maps
+# a score to an inclusive (min, max) range; None leaves that side open.
+# Customers matching no rule fall into DEFAULT_SEGMENT.
+DEFAULT_RULES = [
+    ('Champions', {'R': (4, None), 'F': (4, None), 'M': (4, None)}),
+    ('Loyal Customers', {'R': (3, None), 'F': (3, None), 'M': (3, None)}),
+    ('At Risk', {'R': (None, 2), 'F': (3, None), 'M': (3, None)}),
+    ('Lost', {'R': (None, 2), 'F': (None, 2), 'M': (None, 2)}),
+]
+DEFAULT_SEGMENT = 'Others'
+
+# Tie-break columns, matching the ORDER BY in rfm.rfm_segments_query
+TIEBREAK = ['customer_unique_id', 'customer_state']
+
+def compute_rfm_base(items, max_date=None):
+    """Per-customer recency, frequency and monetary values from order items.
+
+    `items` has one row per order item with customer_unique_id,
+    customer_state, order_id, order_status, order_purchase_timestamp, price
+    and freight_value, i.e. the join used by rfm.py. Recency is measured from
+    max_date (default: the latest purchase in `items`, matching the SQL,
+    which anchors on MAX over all orders).
+    """
+    if max_date is None:
+        max_date = items['order_purchase_timestamp'].max()
+
+    delivered = items[items['order_status'] == 'delivered']
+    base = delivered.groupby(['customer_unique_id', 'customer_state'], sort=False).agg(
+        last_purchase=('order_purchase_timestamp', 'max'),
+        frequency=('order_id', 'nunique'),
+        monetary=('price', 'sum'),
+        freight=('freight_value', 'sum'),
+    ).reset_index()
+    base['monetary'] = (base['monetary'] + base.pop('freight')).round(2)
+    base['recency'] = (max_date - base.pop('last_purchase')).dt.days
+    return base[['customer_unique_id', 'customer_state', 'recency', 'frequency', 'monetary']]
+
+def ntile(order, n=5):
+    """Bucket numbers 1..n for rows given their sort positions, like SQL NTILE(n).
+
+    NTILE gives the first (rows % n) buckets one extra row each; `order` is
+    the argsort of the window's ORDER BY.
+    """
+    rows = len(order)
+    size, extra = divmod(rows, n)
+    position = np.arange(rows)
+    big = extra * (size + 1)
+    # Guard size == 0 (fewer rows than buckets): every row is in the first block
+    small_bucket = extra + (position - big) // size if size else np.zeros(rows, dtype=int)
+    bucket = np.where(position < big, position // (size + 1), small_bucket) + 1
+
+    result = np.empty(rows, dtype=np.int8)
+    result[order] = bucket
+    return result
+
+def _sort_order(base, column, ascending):
+    return base.sort_values([column] + TIEBREAK, ascending=[ascending, True, True],
+                            kind='mergesort').index.to_numpy()
+
+def score_rfm(base, n=5):
+    """Add R, F and M quintile scores to an RFM base frame"""
+    scores = base.reset_index(drop=True).copy()
+    scores['monetary'] = scores['monetary'].astype(float)
+    scores['r'] = ntile(_sort_order(scores, 'recency', False), n)
+    scores['f'] = ntile(_sort_order(scores, 'frequency', True), n)
+    scores['m'] = ntile(_sort_order(scores, 'monetary', True), n)
+    return scores
+
+def segment_customers(scores, rules=None, default=DEFAULT_SEGMENT):
+    """Segment label per customer under a rule set (first matching rule wins)"""
+    rules = DEFAULT_RULES if rules is None else rules
+    columns = {'R': scores['r'].to_numpy(), 'F': scores['f'].to_numpy(), 'M': scores['m'].to_numpy()}
+
+    conditions = []
+    for _, bounds in rules:
+        matched = np.ones(len(scores), dtype=bool)
+        for score, (low, high) in bounds.items():
+            if low is not None:
+                matched &= columns[score] >= low
+            if high is not None:
+                matched &= columns[score] <= high
+        conditions.append(matched)
+    labels = np.select(conditions, [name for name, _ in rules], default=default)
+    return pd.Series(labels, index=scores.index, name='customer_segment')
+
+def compare_rule_sets(scores, variants, by=None):
+    """Segment shares (%) for several named rule sets side by side.
+
+    `variants` maps a variant name to a rule list. With `by` (e.g.
+    'customer_state') shares are computed within each group.
+    """
+    results = {}
+    for name, rules in variants.items():
+        segments = segment_customers(scores, rules)
+        if by is None:
+            results[name] = segments.value_counts(normalize=True) * 100
+        else:
+            results[name] = segments.groupby(scores[by]).value_counts(normalize=True) * 100
+    return pd.DataFrame(results).fillna(0)
+
+def load_rfm_base(engine=None):
+    """RFM base values for every customer from the shared RFM table"""
+    query = f"""
+    SELECT customer_unique_id, customer_state, recency, frequency, monetary
+    FROM {RFM_SEGMENTS_TABLE}
+    """
+    return execute_query(query, engine)
+
+def load_rfm_items(engine=None):
+    """Order items joined to their order and customer, as compute_rfm_base expects"""
+    query = """
+    SELECT
+        c.customer_unique_id,
+        c.customer_state,
+        o.order_id,
+        o.order_status,
+        o.order_purchase_timestamp,
+        oi.price::float8 as price,
+        oi.freight_value::float8 as freight_value
+    FROM analytics.customers c
+    JOIN analytics.orders o ON c.customer_id = o.customer_id
+    JOIN analytics.order_items oi ON o.order_id = oi.order_id
+    """
+    return execute_query(query, engine)
+
+def verify_parity(engine=None):
+    """Check the engine reproduces the SQL RFM computation exactly.
+
+    Builds the recency/frequency/monetary base in-process from the order
+    items, compares it with the SQL base (rfm.rfm_segments_query) per
+    customer, then scores and segments it and compares R, F, M and the
+    segment. Returns a dict of mismatch counts.
+    """
+    from rfm import rfm_segments_query
+
+    sql = execute_query(rfm_segments_query, engine)
+    items = load_rfm_items(engine)
+    max_date = execute_query("SELECT MAX(order_purchase_timestamp) as max_date FROM analytics.orders", engine)
+    if sql is None or items is None or max_date is None:
+        raise Exception("Could not read the analytics tables; run `python typed_schema.py build` first")
+
+    scores = score_rfm(compute_rfm_base(items, max_date['max_date'].iloc[0]))
+    scores['customer_segment'] = segment_customers(scores)
+    merged = scores.merge(sql.rename(columns=lambda col: f"sql_{col}"), how='outer', indicator=True,
+                          left_on=TIEBREAK, right_on=[f"sql_{col}" for col in TIEBREAK])
+    both = merged[merged['_merge'] == 'both']
+    return {
+        'customers': len(sql),
+        'missing_customers': int((merged['_merge'] == 'right_only').sum()),
+        'extra_customers': int((merged['_merge'] == 'left_only').sum()),
+        'recency_mismatches': int((both['recency'] != both['sql_recency']).sum()),
+        'frequency_mismatches': int((both['frequency'] != both['sql_frequency']).sum()),
+        'monetary_mismatches': int(((both['monetary'] - both['sql_monetary'].astype(float)).abs() >= 0.005).sum()),
+        'r_mismatches': int((both['r'] != both['sql_r']).sum()),
+        'f_mismatches': int((both['f'] != both['sql_f']).sum()),
+        'm_mismatches': int((both['m'] != both['sql_m']).sum()),
+        'segment_mismatches': int((both['customer_segment'] != both['sql_customer_segment']).sum()),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-process RFM scoring and what-if segmentation")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check base values, scores and segments match the SQL RFM computation exactly")
+    args = parser.parse_args()
+
+    if args.verify:
+        result = verify_parity()
+        print(f"Customers checked: {result['customers']:,}")
+        for key in result:
+            if key != 'customers':
+                print(f"  {key:<22}{result[key]:>8,}")
+        if any(result[key] for key in result if key != 'customers'):
+            sys.exit(1)
+        print("Parity OK")
+        sys.exit(0)
+
+    base = load_rfm_base()
+    if base is None:
+        sys.exit(1)
+
+    start = time.perf_counter()
+    scores = score_rfm(base)
+    print(f"Scored {len(scores):,} customers in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    # Example: how strict should Champions be?
+    variants = {
+        'current': DEFAULT_RULES,
+        'strict champions': [('Champions', {'R': (5, None), 'F': (5, None), 'M': (5, None)})] + DEFAULT_RULES[1:],
+        'loose champions': [('Champions', {'R': (4, None), 'M': (4, None)})] + DEFAULT_RULES[1:],
+    }
+    start = time.perf_counter()
+    comparison = compare_rule_sets(scores, variants)
+    print(f"Compared {len(variants)} rule sets in {(time.perf_counter() - start) * 1000:.0f} ms\n")
+    print(comparison.round(1))
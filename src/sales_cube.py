@@ -0,0 +1,347 @@
+import argparse
+import logging
+import time
+import pandas as pd
+from sqlalchemy import text
+from query_cache import track_changes
+from utils import (bind_literals, date_range_params, execute_query, get_db_connection, get_rfm_build_info,
+                   RFM_SEGMENTS_TABLE)
+
+logger = logging.getLogger(__name__)
+
+# Pre-aggregated sales cube: order, item, revenue, freight, payment and
+# installment totals per purchase month for every combination of customer
+# state, product category and RFM segment (GROUP BY month, CUBE(...)). Every
+# grouping set includes the month, so a month's rows depend only on that
+# month's orders and the cube is refreshed by replacing whole months.
+#
+# Items are aggregated per (order, category) and payments per order before
+# joining, so neither fans out the other. An order's payments are attributed
+# to its highest-revenue category; order_count is exact in every row, but
+# summed over several categories it counts multi-category orders once per
+# category. Every RFM refresh, incremental or not, re-ranks all customers,
+# so a build whose rfm_segments build differs from the previous cube build's
+# replaces every month: all months always carry the same segment assignment.
+SALES_CUBE_TABLE = "sales_cube"
+BUILD_LOG_TABLE = f"{SALES_CUBE_TABLE}_build_log"
+
+# grouping_level is GROUPING(customer_state, product_category_name,
+# customer_segment): a set bit means that dimension is rolled up
+STATE_ROLLED_UP = 4
+CATEGORY_ROLLED_UP = 2
+SEGMENT_ROLLED_UP = 1
+
+def grouping_level(*dimensions):
+    """grouping_level of the rows keyed by exactly these dimensions (besides month)"""
+    level = STATE_ROLLED_UP | CATEGORY_ROLLED_UP | SEGMENT_ROLLED_UP
+    bits = {'customer_state': STATE_ROLLED_UP, 'product_category_name': CATEGORY_ROLLED_UP,
+            'customer_segment': SEGMENT_ROLLED_UP}
+    for dimension in dimensions:
+        level &= ~bits[dimension]
+    return level
+
+cube_query = f"""
+WITH scoped_orders AS (
+    SELECT
+        o.order_id,
+        c.customer_state,
+        COALESCE(s.customer_segment, 'Unscored') as customer_segment,
+        date_trunc('month', o.order_purchase_timestamp)::date as purchase_month
+    FROM analytics.orders o
+    JOIN analytics.customers c ON c.customer_id = o.customer_id
+    LEFT JOIN {RFM_SEGMENTS_TABLE} s
+        ON s.customer_unique_id = c.customer_unique_id AND s.customer_state = c.customer_state
+    WHERE o.order_purchase_timestamp >= CAST(:from_month AS timestamp)
+),
+order_categories AS (
+    SELECT
+        oi.order_id,
+        p.product_category_name,
+        COUNT(*) as item_count,
+        SUM(oi.price) as revenue,
+        SUM(oi.freight_value) as freight,
+        ROW_NUMBER() OVER (
+            PARTITION BY oi.order_id
+            ORDER BY SUM(oi.price) DESC, p.product_category_name
+        ) as category_rank
+    FROM scoped_orders so
+    JOIN analytics.order_items oi ON oi.order_id = so.order_id
+    JOIN analytics.products p ON p.product_id = oi.product_id
+    WHERE oi.order_purchase_timestamp >= CAST(:from_month AS timestamp)
+    GROUP BY oi.order_id, p.product_category_name
+),
+order_totals AS (
+    SELECT
+        op.order_id,
+        SUM(op.payment_value) as payment_value,
+        COUNT(*) as payment_count,
+        SUM(op.payment_installments) as installment_sum
+    FROM scoped_orders so
+    JOIN analytics.order_payments op ON op.order_id = so.order_id
+    WHERE op.order_purchase_timestamp >= CAST(:from_month AS timestamp)
+    GROUP BY op.order_id
+),
+facts AS (
+    SELECT
+        so.*,
+        oc.product_category_name,
+        COALESCE(oc.item_count, 0) as item_count,
+        COALESCE(oc.revenue, 0) as revenue,
+        COALESCE(oc.freight, 0) as freight,
+        CASE WHEN COALESCE(oc.category_rank, 1) = 1 THEN ot.payment_value END as payment_value,
+        CASE WHEN COALESCE(oc.category_rank, 1) = 1 THEN ot.payment_count END as payment_count,
+        CASE WHEN COALESCE(oc.category_rank, 1) = 1 THEN ot.installment_sum END as installment_sum
+    FROM scoped_orders so
+    LEFT JOIN order_categories oc ON oc.order_id = so.order_id
+    LEFT JOIN order_totals ot ON ot.order_id = so.order_id
+)
+SELECT
+    purchase_month,
+    customer_state,
+    product_category_name,
+    customer_segment,
+    GROUPING(customer_state, product_category_name, customer_segment)::smallint as grouping_level,
+    COUNT(DISTINCT order_id) as order_count,
+    SUM(item_count)::bigint as item_count,
+    SUM(revenue)::numeric(14, 2) as revenue,
+    SUM(freight)::numeric(14, 2) as freight,
+    COALESCE(SUM(payment_value), 0)::numeric(14, 2) as payment_value,
+    COALESCE(SUM(payment_count), 0)::bigint as payment_count,
+    COALESCE(SUM(installment_sum), 0)::bigint as installment_sum
+FROM facts
+GROUP BY purchase_month, CUBE (customer_state, product_category_name, customer_segment)
+"""
+
+cube_ddl = f"""
+CREATE TABLE IF NOT EXISTS {SALES_CUBE_TABLE} (
+    purchase_month date NOT NULL,
+    customer_state text,
+    product_category_name text,
+    customer_segment text,
+    grouping_level smallint NOT NULL,
+    order_count bigint NOT NULL,
+    item_count bigint NOT NULL,
+    revenue numeric(14, 2) NOT NULL,
+    freight numeric(14, 2) NOT NULL,
+    payment_value numeric(14, 2) NOT NULL,
+    payment_count bigint NOT NULL,
+    installment_sum bigint NOT NULL
+);
+CREATE INDEX IF NOT EXISTS {SALES_CUBE_TABLE}_level_month_idx
+    ON {SALES_CUBE_TABLE} (grouping_level, purchase_month);
+CREATE TABLE IF NOT EXISTS {BUILD_LOG_TABLE} (
+    built_at timestamptz NOT NULL DEFAULT now(),
+    build_mode text NOT NULL,
+    from_month date,
+    months_rebuilt integer NOT NULL,
+    row_count integer NOT NULL,
+    max_purchase_date timestamp,
+    rfm_built_at timestamptz,
+    build_seconds numeric(10, 3)
+);
+"""
+
+def refresh_sales_cube(engine=None, full=False, since=None):
+    """Rebuild the cube months touched by new orders and record the build.
+
+    By default the months from the one holding the last build's latest
+    purchase onwards are replaced (all months on the first build); `since`
+    ('YYYY-MM' or a date) rebuilds from that month instead and full=True
+    rebuilds every month. Every month is also rebuilt when rfm_segments was
+    rebuilt since the last cube build, so segments never mix across months.
+    """
+    try:
+        if engine is None:
+            engine = get_db_connection()
+
+        if engine is None:
+            raise Exception("Failed to establish database connection")
+
+        start = time.perf_counter()
+        rfm_info = get_rfm_build_info(engine)
+        if rfm_info is None:
+            raise Exception(f"{RFM_SEGMENTS_TABLE} has not been built; run `python rfm.py refresh` first")
+
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": SALES_CUBE_TABLE})
+            conn.execute(text(cube_ddl))
+            track_changes([SALES_CUBE_TABLE], conn)
+
+            last_rfm_built_at = conn.execute(
+                text(f"SELECT rfm_built_at FROM {BUILD_LOG_TABLE} ORDER BY built_at DESC LIMIT 1")).scalar()
+            resegment = last_rfm_built_at is not None and last_rfm_built_at != rfm_info['built_at']
+
+            if resegment:
+                from_month = None
+                mode = 'resegment'
+            elif since is not None:
+                from_month = pd.Timestamp(since).to_period('M').to_timestamp().date()
+                mode = 'since'
+            else:
+                watermark = None if full else conn.execute(
+                    text(f"SELECT MAX(max_purchase_date) FROM {BUILD_LOG_TABLE}")).scalar()
+                from_month = None if watermark is None else pd.Timestamp(watermark).to_period('M').to_timestamp().date()
+                mode = 'full' if from_month is None else 'incremental'
+
+            bound = from_month or '-infinity'
+            conn.execute(text(f"DELETE FROM {SALES_CUBE_TABLE} WHERE purchase_month >= CAST(:from_month AS date)"),
+                         {"from_month": bound})
+            row_count = conn.execute(
+                text(f"INSERT INTO {SALES_CUBE_TABLE} {cube_query}"), {"from_month": bound}
+            ).rowcount
+            months, max_date = conn.execute(
+                text("SELECT COUNT(DISTINCT date_trunc('month', order_purchase_timestamp)), "
+                     "MAX(order_purchase_timestamp) FROM analytics.orders "
+                     "WHERE order_purchase_timestamp >= CAST(:from_month AS timestamp)"),
+                {"from_month": bound}
+            ).one()
+            if max_date is None:
+                max_date = conn.execute(text("SELECT MAX(order_purchase_timestamp) FROM analytics.orders")).scalar()
+            conn.execute(
+                text(f"""
+                    INSERT INTO {BUILD_LOG_TABLE}
+                        (build_mode, from_month, months_rebuilt, row_count, max_purchase_date,
+                         rfm_built_at, build_seconds)
+                    VALUES (:mode, :from_month, :months, :row_count, :max_date, :rfm_built_at, :build_seconds)
+                """),
+                {"mode": mode, "from_month": from_month, "months": months, "row_count": row_count,
+                 "max_date": max_date, "rfm_built_at": rfm_info['built_at'],
+                 "build_seconds": time.perf_counter() - start}
+            )
+            conn.execute(text(f"ANALYZE {SALES_CUBE_TABLE}"))
+
+        logger.info(f"Refreshed {SALES_CUBE_TABLE} ({mode}): {months} months, {row_count:,} rows "
+                    f"in {time.perf_counter() - start:.2f}s")
+        return True
+    except Exception as e:
+        logger.error(f"Error refreshing sales cube: {str(e)}")
+        return False
+
+def get_cube_build_info(engine=None):
+    """Return the most recent cube build record as a dict, or None if never built"""
+    query = f"SELECT * FROM {BUILD_LOG_TABLE} ORDER BY built_at DESC LIMIT 1"
+    df = execute_query(query, engine)
+    if df is None or df.empty:
+        return None
+    return df.iloc[0].to_dict()
+
+def _rollup(dimensions, engine=None, start=None, end=None):
+    """Cube totals for one grouping of the dimensions, over all months or
+    the months starting in [start, end)"""
+    columns = ", ".join(dimensions)
+    months = bind_literals("AND purchase_month >= CAST(:start AS date) AND purchase_month < CAST(:end AS date)",
+                           date_range_params(start, end))
+    query = f"""
+    SELECT
+        {columns},
+        SUM(order_count)::bigint as order_count,
+        SUM(item_count)::bigint as item_count,
+        SUM(revenue) as revenue,
+        SUM(freight) as freight,
+        SUM(payment_value) as payment_value,
+        SUM(payment_count)::bigint as payment_count,
+        SUM(installment_sum)::bigint as installment_sum
+    FROM {SALES_CUBE_TABLE}
+    WHERE grouping_level = {grouping_level(*dimensions)}
+        {months}
+    GROUP BY {columns}
+    """
+    return execute_query(query, engine, label=f"sales_cube.{'_'.join(dimensions)}")
+
+def top_categories(state='SP', n=10, engine=None, start=None, end=None):
+    """Top-n categories by items purchased in a state (all states when None).
+
+    Returns product_category_name, category_english, item_count and revenue.
+    `start`/`end` limit the cube to the months starting in that range, as in
+    every query below.
+    """
+    from categories import CATEGORY_TRANSLATIONS
+
+    if state is None:
+        df = _rollup(['product_category_name'], engine, start, end)
+    else:
+        df = _rollup(['customer_state', 'product_category_name'], engine, start, end)
+        if df is not None:
+            df = df[df['customer_state'] == state]
+    if df is None:
+        return None
+    df = df[df['product_category_name'].notna()]
+    df = df.sort_values(['item_count', 'product_category_name'], ascending=[False, True]).head(n)
+    df = df.assign(category_english=df['product_category_name'].map(
+        lambda name: CATEGORY_TRANSLATIONS.get(name, name.replace('_', ' ').title())))
+    return df[['product_category_name', 'category_english', 'item_count', 'revenue']].reset_index(drop=True)
+
+def segment_mix_by_state(measure='order_count', engine=None, start=None, end=None):
+    """Share of each state's orders (or revenue, items, ...) per RFM segment.
+
+    Returns a state x segment table of shares that sum to 1 per state.
+    Customer counts are not additive over months, so the mix is by orders;
+    rfm_segments itself has the per-customer view.
+    """
+    df = _rollup(['customer_state', 'customer_segment'], engine, start, end)
+    if df is None:
+        return None
+    table = df.pivot_table(index='customer_state', columns='customer_segment', values=measure,
+                           aggfunc='sum', fill_value=0).astype(float)
+    return table.div(table.sum(axis=1), axis=0)
+
+def installments_by_segment(engine=None, start=None, end=None):
+    """Average installments and payment value per payment, by RFM segment"""
+    df = _rollup(['customer_segment'], engine, start, end)
+    if df is None:
+        return None
+    payments = df['payment_count'].astype(float).where(lambda s: s > 0)
+    df = df.assign(
+        avg_installments=(df['installment_sum'].astype(float) / payments).round(2),
+        avg_payment_value=(df['payment_value'].astype(float) / payments).round(2),
+        avg_order_value=(df['payment_value'].astype(float) / df['order_count'].astype(float)).round(2),
+    )
+    return df[['customer_segment', 'order_count', 'payment_count', 'avg_installments', 'avg_payment_value',
+               'avg_order_value']].sort_values('avg_order_value', ascending=False).reset_index(drop=True)
+
+def print_status(engine=None):
+    """Print when the cube was last built and whether its segments are current"""
+    info = get_cube_build_info(engine)
+    if info is None:
+        print(f"{SALES_CUBE_TABLE} has not been built yet; run `python sales_cube.py refresh`")
+        return
+    print(f"Table:            {SALES_CUBE_TABLE}")
+    print(f"Built at:         {info['built_at']}")
+    print(f"Build mode:       {info['build_mode']} ({info['months_rebuilt']} months from "
+          f"{info['from_month'] or 'the start'})")
+    print(f"Rows rebuilt:     {info['row_count']:,}")
+    print(f"Data as of:       {info['max_purchase_date']}")
+    print(f"Build time:       {float(info['build_seconds']):.2f}s")
+    rfm_info = get_rfm_build_info(engine)
+    if rfm_info is not None and rfm_info['built_at'] != info['rfm_built_at']:
+        print(f"Segments:         rfm_segments rebuilt since ({rfm_info['built_at']}); "
+              f"the next `python sales_cube.py refresh` re-segments every month")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage and query the pre-aggregated sales cube")
+    parser.add_argument("command", choices=["refresh", "status", "report"],
+                        help="refresh: rebuild months with new orders; status: show the last build; "
+                             "report: answer the chart questions from the cube")
+    parser.add_argument("--full", action="store_true", help="Rebuild every month even if segments are current (refresh)")
+    parser.add_argument("--since", metavar="YYYY-MM", help="Rebuild from this month onwards (refresh)")
+    parser.add_argument("--state", default="SP", help="State for the category ranking (report)")
+    parser.add_argument("--start", metavar="YYYY-MM", help="First month included (report)")
+    parser.add_argument("--end", metavar="YYYY-MM", help="Month the report stops before (report)")
+    args = parser.parse_args()
+
+    if args.command == "refresh":
+        if not refresh_sales_cube(full=args.full, since=args.since):
+            raise SystemExit(1)
+    elif args.command == "report":
+        start = args.start and pd.Timestamp(args.start).date()
+        end = args.end and pd.Timestamp(args.end).date()
+        categories = top_categories(args.state, start=start, end=end)
+        mix = segment_mix_by_state(start=start, end=end)
+        installments = installments_by_segment(start=start, end=end)
+        if categories is None or mix is None or installments is None:
+            raise SystemExit(1)
+        print(f"Top categories in {args.state}:\n{categories.to_string(index=False)}")
+        print(f"\nSegment mix by state (share of orders):\n{mix.round(3).to_string()}")
+        print(f"\nInstallments by segment:\n{installments.to_string(index=False)}")
+    else:
+        print_status()
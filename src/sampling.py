@@ -0,0 +1,131 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+# Customer-level sampling for fast previews of the analyses.
+#
+# A customer is in the sample when a stable hash of customer_unique_id falls
+# below the sampling fraction, so the same customers are chosen on every run
+# and a customer's orders are always kept together (RFM scores are computed
+# over whole customers). Each sampled customer stands for 1/fraction
+# customers: totals are scaled up and come with approximate 95% confidence
+# intervals from the customer-level (cluster) variance; averages are ratio
+# estimates with linearized variances and shares are proportions of
+# sampled customers. Intervals use the finite-population correction, so
+# they shrink to zero at fraction 1.
+
+# The typed build stores each customer's bucket in an indexed sample_bucket
+# column on customers and on their orders, items and payments
+# (SAMPLE_BUCKET_SOURCES in typed_schema.py), and purchase_intervals copies
+# it from customers, so a sampled query filters every table it joins on that
+# column and reads only the sampled rows.
+SAMPLE_BUCKET_COLUMN = 'sample_bucket'
+
+# Hash space the fraction is resolved in; the effective fraction is a
+# multiple of 1 / SAMPLE_BUCKETS
+SAMPLE_BUCKETS = 10000
+# Normal quantile for 95% intervals
+Z = 1.96
+
+def sample_buckets(fraction):
+    """Number of hash buckets kept for a sampling fraction"""
+    if not 0 < fraction <= 1:
+        raise ValueError(f"Sampling fraction must be in (0, 1], got {fraction}")
+    return max(1, round(fraction * SAMPLE_BUCKETS))
+
+def effective_fraction(fraction):
+    """The fraction actually sampled, after rounding to whole buckets"""
+    return sample_buckets(fraction) / SAMPLE_BUCKETS
+
+def sample_bucket_sql(column='customer_unique_id'):
+    """SQL expression for a customer's bucket in [0, SAMPLE_BUCKETS).
+
+    The first 32 bits of md5(customer_unique_id) pick the bucket, which is
+    the same on every run and every Postgres version.
+    """
+    return f"((('x' || substr(md5({column}), 1, 8))::bit(32)::bigint % {SAMPLE_BUCKETS})::integer)"
+
+def sample_predicate(fraction, aliases=('c',)):
+    """SQL condition keeping a stable `fraction` of customers, on the stored
+    bucket of each alias; pass every typed table the query joins so each is
+    read through its bucket index"""
+    return " AND ".join(f"{alias}.{SAMPLE_BUCKET_COLUMN} < {sample_buckets(fraction)}" for alias in aliases)
+
+def total_estimate(sum_y, sum_y2, fraction):
+    """Scaled-up total and CI half-width from per-customer sums of y and y^2"""
+    fraction = effective_fraction(fraction)
+    sum_y = sum_y.astype(float)
+    half_width = Z * np.sqrt((1 - fraction) * sum_y2.astype(float)) / fraction
+    return sum_y / fraction, half_width
+
+def ratio_estimate(sum_y, sum_m, sum_y2, sum_m2, sum_ym, n, fraction):
+    """Ratio sum(y) / sum(m) over sampled customers and its CI half-width.
+
+    Uses the linearized (delta-method) variance of a ratio under cluster
+    sampling, with customers as clusters.
+    """
+    fraction = effective_fraction(fraction)
+    sum_y, sum_m = sum_y.astype(float), sum_m.astype(float)
+    ratio = sum_y / sum_m
+    residuals = (sum_y2.astype(float) - 2 * ratio * sum_ym.astype(float)
+                 + ratio ** 2 * sum_m2.astype(float)).clip(lower=0)
+    n = n.astype(float)
+    variance = (1 - fraction) * residuals / sum_m ** 2 * n / (n - 1).where(n > 1)
+    return ratio, Z * np.sqrt(variance)
+
+def proportion_estimate(count, total, fraction):
+    """Share count / total of sampled customers and its CI half-width"""
+    fraction = effective_fraction(fraction)
+    share = count.astype(float) / total.astype(float)
+    return share, Z * np.sqrt((1 - fraction) * share * (1 - share) / total.astype(float))
+
+def with_interval(df, column, estimate, half_width, digits=None):
+    """Set `column` and its `_ci_low`/`_ci_high` bounds on a DataFrame"""
+    values = {column: estimate, f"{column}_ci_low": estimate - half_width, f"{column}_ci_high": estimate + half_width}
+    if digits is not None:
+        values = {name: value.round(digits) for name, value in values.items()}
+    return df.assign(**values)
+
+def preview(fraction, engine=None, start=None, end=None):
+    """Run every analysis on a customer sample, optionally over the orders
+    purchased in [start, end).
+
+    Returns {analysis: (DataFrame, seconds)}.
+    """
+    import time
+    import installments_by_segment
+    import performance_quadrant
+    import segments_by_state
+    import sp_top_categories
+
+    analyses = {
+        'installments_by_segment': installments_by_segment.get_segment_data,
+        'customer_segments_by_state': segments_by_state.get_state_segment_data,
+        'sp_top_categories': sp_top_categories.get_sp_category_data,
+        'state_performance_quadrants': performance_quadrant.get_quadrant_data,
+    }
+    results = {}
+    for name, fetch in analyses.items():
+        began = time.perf_counter()
+        results[name] = (fetch(engine, sample=fraction, start=start, end=end), time.perf_counter() - began)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preview every analysis on a stable customer sample")
+    parser.add_argument("--fraction", type=float, default=0.05,
+                        help="Share of customers sampled (default 0.05)")
+    parser.add_argument("--start", help="First purchase date included")
+    parser.add_argument("--end", help="Purchase date the analyses stop before")
+    args = parser.parse_args()
+
+    pd.set_option('display.width', 200)
+    failed = False
+    for name, (df, seconds) in preview(args.fraction, start=args.start, end=args.end).items():
+        print(f"\n{name} ({effective_fraction(args.fraction):.2%} sample, {seconds:.2f}s)")
+        if df is None:
+            failed = True
+            print("  failed")
+        else:
+            print(df.to_string(index=False))
+    if failed:
+        raise SystemExit(1)
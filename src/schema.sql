@@ -134,6 +134,100 @@ CREATE TABLE public.products (
 
 ALTER TABLE public.products OWNER TO postgres;
 
+--
+-- Name: customers customers_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.customers
+    ADD CONSTRAINT customers_pkey PRIMARY KEY (customer_id) INCLUDE (customer_unique_id, customer_state);
+
+--
+-- Name: products products_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.products
+    ADD CONSTRAINT products_pkey PRIMARY KEY (product_id) INCLUDE (product_category_name);
+
+--
+-- Name: orders orders_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.orders
+    ADD CONSTRAINT orders_pkey PRIMARY KEY (order_id) INCLUDE (customer_id, order_status, order_purchase_timestamp);
+
+--
+-- Name: order_items order_items_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.order_items
+    ADD CONSTRAINT order_items_pkey PRIMARY KEY (order_id, order_item_id) INCLUDE (product_id, price, freight_value);
+
+--
+-- Name: order_payments order_payments_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.order_payments
+    ADD CONSTRAINT order_payments_pkey PRIMARY KEY (order_id, payment_sequential) INCLUDE (payment_type, payment_installments, payment_value);
+
+--
+-- Name: customers_customer_unique_id_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX customers_customer_unique_id_idx ON public.customers USING btree (customer_unique_id) INCLUDE (customer_id, customer_state);
+
+--
+-- Name: orders_customer_id_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX orders_customer_id_idx ON public.orders USING btree (customer_id) INCLUDE (order_id, order_status, order_purchase_timestamp);
+
+--
+-- Name: orders_order_purchase_timestamp_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX orders_order_purchase_timestamp_idx ON public.orders USING btree (order_purchase_timestamp);
+
+--
+-- Name: order_items_product_id_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX order_items_product_id_idx ON public.order_items USING btree (product_id) INCLUDE (order_id);
+
+--
+-- Name: products_product_category_name_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX products_product_category_name_idx ON public.products USING btree (product_category_name);
+
+--
+-- Name: orders orders_customer_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.orders
+    ADD CONSTRAINT orders_customer_id_fkey FOREIGN KEY (customer_id) REFERENCES public.customers(customer_id);
+
+--
+-- Name: order_items order_items_order_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.order_items
+    ADD CONSTRAINT order_items_order_id_fkey FOREIGN KEY (order_id) REFERENCES public.orders(order_id);
+
+--
+-- Name: order_items order_items_product_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.order_items
+    ADD CONSTRAINT order_items_product_id_fkey FOREIGN KEY (product_id) REFERENCES public.products(product_id);
+
+--
+-- Name: order_payments order_payments_order_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.order_payments
+    ADD CONSTRAINT order_payments_order_id_fkey FOREIGN KEY (order_id) REFERENCES public.orders(order_id);
+
+
 -- Completed on 2025-01-20 09:31:15
 
 --
@@ -0,0 +1,134 @@
+# Keys and indexes for the five Olist tables. The same definitions are applied
+# to the raw tables (written out in schema.sql) and to the typed analytics
+# tables (applied by typed_schema.py after each build).
+
+# table -> (key columns, extra columns carried in the index for index-only joins)
+PRIMARY_KEYS = {
+    'customers': (['customer_id'], ['customer_unique_id', 'customer_state']),
+    'products': (['product_id'], ['product_category_name']),
+    'orders': (['order_id'], ['customer_id', 'order_status', 'order_purchase_timestamp']),
+    'order_items': (['order_id', 'order_item_id'], ['product_id', 'price', 'freight_value']),
+    'order_payments': (['order_id', 'payment_sequential'],
+                       ['payment_type', 'payment_installments', 'payment_value']),
+}
+
+# (table, columns, referenced table, referenced columns); parents are listed first
+FOREIGN_KEYS = [
+    ('orders', ['customer_id'], 'customers', ['customer_id']),
+    ('order_items', ['order_id'], 'orders', ['order_id']),
+    ('order_items', ['product_id'], 'products', ['product_id']),
+    ('order_payments', ['order_id'], 'orders', ['order_id']),
+]
+
+# Tables range-partitioned on a column in the typed schema (typed_schema.py
+# partitions them by purchase month; the raw tables are not partitioned).
+# Postgres requires the partition column in the primary key of a partitioned
+# table, so it is appended to their keys, and foreign keys between two of
+# them reference it as well.
+PARTITIONED_TABLES = {
+    'orders': 'order_purchase_timestamp',
+    'order_items': 'order_purchase_timestamp',
+    'order_payments': 'order_purchase_timestamp',
+}
+
+# (table, key columns, included columns) for the join and group-by paths used
+# by the analyses: customer_unique_id lookups back to customer_id, orders by
+# customer, the MAX(order_purchase_timestamp) recency anchor and category rollups
+INDEXES = [
+    ('customers', ['customer_unique_id'], ['customer_id', 'customer_state']),
+    ('orders', ['customer_id'], ['order_id', 'order_status', 'order_purchase_timestamp']),
+    ('orders', ['order_purchase_timestamp'], []),
+    ('order_items', ['product_id'], ['order_id']),
+    ('products', ['product_category_name'], []),
+]
+
+def primary_key_name(table):
+    return f"{table}_pkey"
+
+def foreign_key_name(table, columns):
+    return f"{table}_{'_'.join(columns)}_fkey"
+
+def index_name(table, columns):
+    return f"{table}_{'_'.join(columns)}_idx"
+
+def primary_key_columns(table, partitioned=False):
+    """Key columns of a table's primary key, with the partition column if partitioned"""
+    columns = list(PRIMARY_KEYS[table][0])
+    partition_column = PARTITIONED_TABLES.get(table) if partitioned else None
+    if partition_column is not None and partition_column not in columns:
+        columns.append(partition_column)
+    return columns
+
+def foreign_key_columns(table, columns, ref_table, ref_columns, partitioned=False):
+    """(columns, referenced columns) of a foreign key; references between two
+    partitioned tables also match on the partition column"""
+    if partitioned and table in PARTITIONED_TABLES and ref_table in PARTITIONED_TABLES:
+        return list(columns) + [PARTITIONED_TABLES[table]], list(ref_columns) + [PARTITIONED_TABLES[ref_table]]
+    return list(columns), list(ref_columns)
+
+def _only(table, partitioned):
+    # ONLY keeps constraints off inheritance children; partitioned tables reject it
+    return "" if partitioned and table in PARTITIONED_TABLES else "ONLY "
+
+def create_key_statements(schema, tables=None, partitioned=False):
+    """DDL adding primary keys, indexes and foreign keys, in dependency order.
+
+    partitioned=True adapts the keys to the PARTITIONED_TABLES layout.
+    """
+    return index_statements(schema, tables, partitioned) + foreign_key_statements(schema, tables, partitioned)
+
+def index_statements(schema, tables=None, partitioned=False):
+    """DDL adding the primary keys and indexes of each table"""
+    tables = tables or list(PRIMARY_KEYS)
+    statements = []
+    for table, (_, include) in PRIMARY_KEYS.items():
+        if table in tables:
+            columns = primary_key_columns(table, partitioned)
+            include = [col for col in include if col not in columns]
+            include_sql = f" INCLUDE ({', '.join(include)})" if include else ""
+            statements.append(
+                f"ALTER TABLE {_only(table, partitioned)}{schema}.{table} ADD CONSTRAINT {primary_key_name(table)} "
+                f"PRIMARY KEY ({', '.join(columns)}){include_sql}"
+            )
+    for table, columns, include in INDEXES:
+        if table in tables:
+            include_sql = f" INCLUDE ({', '.join(include)})" if include else ""
+            statements.append(
+                f"CREATE INDEX {index_name(table, columns)} ON {schema}.{table} "
+                f"USING btree ({', '.join(columns)}){include_sql}"
+            )
+    return statements
+
+def foreign_key_statements(schema, tables=None, partitioned=False):
+    """DDL adding the foreign keys between tables (run after index_statements)"""
+    tables = tables or list(PRIMARY_KEYS)
+    statements = []
+    for table, columns, ref_table, ref_columns in FOREIGN_KEYS:
+        if table in tables and ref_table in tables:
+            key, ref_key = foreign_key_columns(table, columns, ref_table, ref_columns, partitioned)
+            statements.append(
+                f"ALTER TABLE {_only(table, partitioned)}{schema}.{table} "
+                f"ADD CONSTRAINT {foreign_key_name(table, columns)} "
+                f"FOREIGN KEY ({', '.join(key)}) REFERENCES {schema}.{ref_table}({', '.join(ref_key)})"
+            )
+    return statements
+
+def drop_key_statements(schema, tables=None):
+    """DDL dropping everything create_key_statements adds, foreign keys first"""
+    tables = tables or list(PRIMARY_KEYS)
+    statements = []
+    for table, columns, ref_table, _ in FOREIGN_KEYS:
+        if table in tables or ref_table in tables:
+            statements.append(
+                f"ALTER TABLE IF EXISTS {schema}.{table} "
+                f"DROP CONSTRAINT IF EXISTS {foreign_key_name(table, columns)}"
+            )
+    for table, columns, _ in INDEXES:
+        if table in tables:
+            statements.append(f"DROP INDEX IF EXISTS {schema}.{index_name(table, columns)}")
+    for table in PRIMARY_KEYS:
+        if table in tables:
+            statements.append(
+                f"ALTER TABLE IF EXISTS {schema}.{table} DROP CONSTRAINT IF EXISTS {primary_key_name(table)}"
+            )
+    return statements
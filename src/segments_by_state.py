@@ -1,76 +1,90 @@
-import matplotlib.pyplot as plt
 import pandas as pd
-import numpy as np
 from utils import execute_query
+from rfm import build_rfm_segments_query
+from sampling import proportion_estimate, sample_predicate, total_estimate, with_interval
 
 # Query to get segment distribution by state
+# Segments come from the shared RFM layer (see rfm.py)
 query = """
-WITH last_date AS (
-    SELECT MAX(order_purchase_timestamp::timestamp) as max_date
-    FROM orders
-),
-customer_rfm AS (
-    SELECT 
-        c.customer_unique_id,
-        c.customer_state,
-        EXTRACT(DAYS FROM (
-            (SELECT max_date FROM last_date) - 
-            MAX(o.order_purchase_timestamp::timestamp)
-        )) as recency,
-        COUNT(DISTINCT o.order_id) as frequency,
-        SUM(CAST(oi.price AS DECIMAL) + CAST(oi.freight_value AS DECIMAL))::DECIMAL(10,2) as monetary
-    FROM customers c
-    JOIN orders o ON c.customer_id = o.customer_id
-    JOIN order_items oi ON o.order_id = oi.order_id
-    WHERE o.order_status = 'delivered'
-    GROUP BY c.customer_unique_id, c.customer_state
-),
-rfm_scores AS (
-    SELECT 
-        *,
-        NTILE(5) OVER (ORDER BY recency DESC) as R,
-        NTILE(5) OVER (ORDER BY frequency) as F,
-        NTILE(5) OVER (ORDER BY monetary) as M
-    FROM customer_rfm
-),
-customer_segments AS (
-    SELECT 
-        *,
-        CASE
-            WHEN (R >= 4 AND F >= 4 AND M >= 4) THEN 'Champions'
-            WHEN (R >= 3 AND F >= 3 AND M >= 3) THEN 'Loyal Customers'
-            WHEN (R <= 2 AND F >= 3 AND M >= 3) THEN 'At Risk'
-            WHEN (R <= 2 AND F <= 2 AND M <= 2) THEN 'Lost'
-            ELSE 'Others'
-        END as customer_segment
-    FROM rfm_scores
-)
 SELECT 
     customer_state,
     customer_segment,
     COUNT(*) as customer_count
-FROM customer_segments
+FROM rfm_segments
 GROUP BY customer_state, customer_segment
 ORDER BY customer_state, customer_segment;
 """
 
-def create_state_segment_distribution():
-    # Get data
-    df = execute_query(query)
+# Define segment order
+segment_order = ['Champions', 'Loyal Customers', 'At Risk', 'Lost', 'Others']
+
+def build_query(start=None, end=None):
+    """Customer counts per state and segment; with a date range, RFM is
+    scored on the orders purchased in [start, end) instead of read from
+    rfm_segments"""
+    if start is None and end is None:
+        return query
+    return f"""
+WITH windowed_rfm AS ({build_rfm_segments_query(start=start, end=end)})
+SELECT
+    customer_state,
+    customer_segment,
+    COUNT(*) as customer_count
+FROM windowed_rfm
+GROUP BY customer_state, customer_segment
+ORDER BY customer_state, customer_segment;
+"""
+
+def build_sampled_query(fraction, start=None, end=None):
+    """Customer counts per state and segment, with RFM scored on a customer sample"""
+    return f"""
+WITH sampled_rfm AS ({build_rfm_segments_query(sample_predicate(fraction, ['c', 'o', 'oi']), start, end)})
+SELECT
+    customer_state,
+    customer_segment,
+    COUNT(*) as sampled_customers
+FROM sampled_rfm
+GROUP BY customer_state, customer_segment
+ORDER BY customer_state, customer_segment;
+"""
+
+def get_state_segment_data(engine=None, sample=None, start=None, end=None):
+    """Fetch customer counts per state and segment.
+
+    With `sample` set to a fraction, RFM is scored on that share of
+    customers; customer_count is scaled up and the counts and each
+    segment's share of its state come with _ci_low/_ci_high bounds.
+    `start`/`end` score RFM on the orders purchased in that range (end
+    exclusive) only.
+    """
+    if sample is None:
+        return execute_query(build_query(start, end), engine)
+
+    df = execute_query(build_sampled_query(sample, start, end), engine)
     if df is None:
-        print("Error: Could not retrieve data from database")
-        return
-        
-    # Define segment order
-    segment_order = ['Champions', 'Loyal Customers', 'At Risk', 'Lost', 'Others']
-    
+        return None
+    sampled = df['sampled_customers'].astype(float)
+    # A 0/1 indicator per customer: the sum of squares equals the count
+    estimate, half_width = total_estimate(sampled, sampled, sample)
+    df = with_interval(df, 'customer_count', estimate, half_width, digits=0)
+    state_totals = df.groupby('customer_state')['sampled_customers'].transform('sum')
+    share, half_width = proportion_estimate(df['sampled_customers'], state_totals, sample)
+    df = with_interval(df, 'share', share, half_width, digits=4)
+    return df.drop(columns='sampled_customers')
+
+def prepare_state_segments(df):
+    """Pivot segment counts by state and compute each segment's share.
+
+    Returns (counts, percentages, total customers per state), with states
+    sorted by total customer count.
+    """
     # Pivot the data for easier plotting
     df_pivot = df.pivot(index='customer_state', 
                        columns='customer_segment', 
                        values='customer_count').fillna(0)
     
-    # Reorder columns
-    df_pivot = df_pivot[segment_order]
+    # Reorder columns (a subset of states may lack a segment)
+    df_pivot = df_pivot.reindex(columns=segment_order, fill_value=0)
     
     # Calculate percentages
     df_pct = df_pivot.div(df_pivot.sum(axis=1), axis=0) * 100
@@ -79,7 +93,15 @@ def create_state_segment_distribution():
     total_customers = df_pivot.sum(axis=1)
     df_pivot = df_pivot.loc[total_customers.sort_values(ascending=True).index]
     df_pct = df_pct.loc[total_customers.sort_values(ascending=True).index]
-    
+    return df_pivot, df_pct, total_customers
+
+def plot_state_segment_distribution(df):
+    """Create the stacked segment-share chart for the state data and return it"""
+    import numpy as np
+    import matplotlib.pyplot as plt
+
+    df_pivot, df_pct, total_customers = prepare_state_segments(df)
+
     # Create figure and axis with adjusted size
     fig, ax = plt.subplots(figsize=(13, 10))
     
@@ -138,38 +160,42 @@ def create_state_segment_distribution():
                        color=color,
                        fontsize=fontsize,
                        fontweight=weight)
-        left += df_pct[segment]
+        left += df_pct[segment].to_numpy()
     
-    # Add annotations for key insights
-    ax.annotate('Largest customer base (39,156)\nwith lowest champions and at risk % \nand highest others %',
-                xy=(95, df_pivot.index.get_loc('SP')),
-                xytext=(101, df_pivot.index.get_loc('SP')),
+    # Add annotations for key insights (for the states shown)
+    if 'SP' in df_pivot.index:
+        ax.annotate('Largest customer base (39,156)\nwith lowest champions and at risk % \nand highest others %',
+                    xy=(95, df_pivot.index.get_loc('SP')),
+                    xytext=(101, df_pivot.index.get_loc('SP')),
+                    ha='left', va='center',
+                    bbox=dict(facecolor='white', edgecolor='none', alpha=0.7),
+                    arrowprops=dict(arrowstyle='->'))
+
+    if 'PB' in df_pivot.index:
+        ax.annotate('Exceptionally low lost customer %',
+                    xy=(85, df_pivot.index.get_loc('PB')),
+                    xytext=(101, df_pivot.index.get_loc('PB')),
+                    ha='left', va='center',
+                    bbox=dict(facecolor='white', edgecolor='none', alpha=0.7),
+                    arrowprops=dict(arrowstyle='->'))
+
+    if 'AC' in df_pivot.index:
+        ax.annotate('Highest at-risk %',
+                xy=(60, df_pivot.index.get_loc('AC')),
+                xytext=(101, df_pivot.index.get_loc('AC')),
                 ha='left', va='center',
-                bbox=dict(facecolor='white', edgecolor='none', alpha=0.7),
-                arrowprops=dict(arrowstyle='->'))
-                
-    ax.annotate('Exceptionally low lost customer %',
-                xy=(85, df_pivot.index.get_loc('PB')),
-                xytext=(101, df_pivot.index.get_loc('PB')),
+                bbox=dict(facecolor='white', edgecolor='none', alpha=1.0),  # Make fully opaque
+                arrowprops=dict(arrowstyle='->'),
+                zorder=5)  # Add zorder to ensure it's above the grid
+
+    if 'AP' in df_pivot.index:
+        ax.annotate('Highest loyal customer %',  # Change to one line
+                xy=(40, df_pivot.index.get_loc('AP') - 0.1), 
+                xytext=(101, df_pivot.index.get_loc('AP') - 0.2),  # Shift down by adjusting the y-position
                 ha='left', va='center',
-                bbox=dict(facecolor='white', edgecolor='none', alpha=0.7),
+                bbox=dict(facecolor='white', edgecolor='none', alpha=1.0),
                 arrowprops=dict(arrowstyle='->'))
-                
-    ax.annotate('Highest at-risk %',
-            xy=(60, df_pivot.index.get_loc('AC')),
-            xytext=(101, df_pivot.index.get_loc('AC')),
-            ha='left', va='center',
-            bbox=dict(facecolor='white', edgecolor='none', alpha=1.0),  # Make fully opaque
-            arrowprops=dict(arrowstyle='->'),
-            zorder=5)  # Add zorder to ensure it's above the grid
-                
-    ax.annotate('Highest loyal customer %',  # Change to one line
-            xy=(40, df_pivot.index.get_loc('AP') - 0.1), 
-            xytext=(101, df_pivot.index.get_loc('AP') - 0.2),  # Shift down by adjusting the y-position
-            ha='left', va='center',
-            bbox=dict(facecolor='white', edgecolor='none', alpha=1.0),
-            arrowprops=dict(arrowstyle='->'))
-    
+
     # Customize the plot
     ax.set_title('Customer Segment Distribution by State', pad=20, fontsize=12)
     ax.set_xlabel('Percentage of Customers', fontsize=10)
@@ -194,8 +220,12 @@ def create_state_segment_distribution():
     
     # Adjust layout to fit everything
     plt.subplots_adjust(right=0.85)  # Make room for annotations
-    plt.show()
-    
+    return fig
+
+def print_state_insights(df):
+    """Print the key per-state insights"""
+    _, df_pct, total_customers = prepare_state_segments(df)
+
     # Print summary statistics
     print("\nKey Insights:")
     print("\n1. São Paulo (SP)")
@@ -212,5 +242,19 @@ def create_state_segment_distribution():
     print("\n4. Customer Loyalty Leader")
     print(f"   - Amapá (AP): {df_pct.loc['AP', 'Loyal Customers']:.1f}% loyal customers")
 
+def create_state_segment_distribution():
+    # Get data
+    df = get_state_segment_data()
+    if df is None:
+        print("Error: Could not retrieve data from database. Has `python rfm.py refresh` been run?")
+        return
+
+    import matplotlib.pyplot as plt
+
+    plot_state_segment_distribution(df)
+    plt.show()
+
+    print_state_insights(df)
+
 if __name__ == "__main__":
     create_state_segment_distribution()
\ No newline at end of file
@@ -0,0 +1,494 @@
+import argparse
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import query_cache
+from utils import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+# Local HTTP service for the analyses.
+#
+# GET /<analysis>.json|.png|.svg?state=SP,RJ&start=2017-01-01&end=2018-01-01
+# returns one analysis (named as the charts in render_all.py) as JSON rows or
+# a rendered chart. Payloads are held in memory per analysis, parameters,
+# format and data version, and built only on a miss: the data is fetched
+# once per analysis and date range (every state at once, except the
+# installments, which filter states in SQL), then filtered, serialized or
+# rendered. Concurrent misses for the same payload or data wait for one
+# computation (single flight), so a burst of dashboard viewers costs one
+# query, not one per request.
+#
+# The data version is the query_cache fingerprint of every table the
+# analyses read, polled in the background; requests never query the
+# database for it. ETags hash the version with the request, so
+# If-None-Match is answered with 304 before any payload is looked up. When
+# the version changes the cache is dropped and the default payloads are
+# computed again ahead of the first request.
+#
+# GET /metrics reports request counts and p50/p99 latencies per route in the
+# Prometheus text format; GET / lists the analyses and the cache state.
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = int(os.getenv('SERVE_PORT', '8050'))
+# Seconds between data-version checks
+DEFAULT_POLL_SECONDS = float(os.getenv('SERVE_POLL_SECONDS', '10'))
+# Payloads and DataFrames kept in memory, least recently used dropped first
+MAX_CACHE_ENTRIES = int(os.getenv('SERVE_CACHE_ENTRIES', '256'))
+# Latest requests per route the percentiles are computed over
+LATENCY_WINDOW = 10000
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+STATE_PATTERN = re.compile(r'[A-Z]{2}')
+PATH_PATTERN = re.compile(r'/(\w+)\.(json|png|svg)')
+
+def _load_quadrants(start, end, states, version):
+    from performance_quadrant import get_quadrant_data
+    return get_quadrant_data(start=start, end=end)
+
+def _load_state_segments(start, end, states, version):
+    from segments_by_state import get_state_segment_data
+    return get_state_segment_data(start=start, end=end)
+
+def _load_top_categories(start, end, states, version):
+    from sp_top_categories import get_top_categories
+    return get_top_categories(None, 10, start=start, end=end, version=version)
+
+def _load_installments(start, end, states, version):
+    from installments_by_segment import get_segment_data
+    return get_segment_data(start=start, end=end, states=states)
+
+def _plot_quadrants(df, states):
+    from performance_quadrant import plot_quadrants
+    return plot_quadrants(df)
+
+def _plot_state_segments(df, states):
+    from segments_by_state import plot_state_segment_distribution
+    return plot_state_segment_distribution(df)
+
+def _plot_top_categories(df, states):
+    from sp_top_categories import plot_categories
+    return plot_categories(df, states[0])
+
+def _plot_installments(df, states):
+    from installments_by_segment import plot_segment_analysis
+    return plot_segment_analysis(df)
+
+# analysis -> (load(start, end, states, version), plot(df, states), whether states are
+# filtered in SQL rather than in memory, default states, most states a chart
+# shows; JSON rows take any number of states)
+ANALYSES = {
+    'state_performance_quadrants': (_load_quadrants, _plot_quadrants, False, None, None),
+    'customer_segments_by_state': (_load_state_segments, _plot_state_segments, False, None, None),
+    'sp_top_categories': (_load_top_categories, _plot_top_categories, False, ['SP'], 1),
+    'installments_by_segment': (_load_installments, _plot_installments, True, None, None),
+}
+
+_state = {'version': None, 'checked_at': None}
+_cache = OrderedDict()
+_inflight = {}
+_cache_lock = threading.Lock()
+_counters = {'hits': 0, 'misses': 0, 'loads': 0, 'renders': 0, 'not_modified': 0}
+# pyplot keeps global state: one figure is drawn at a time
+_render_lock = threading.Lock()
+
+_latencies = {}
+_responses = {}
+_metrics_lock = threading.Lock()
+
+def data_tables():
+    """Tables the analyses read, with or without a date range"""
+    import installments_by_segment
+    import performance_quadrant
+    import segments_by_state
+    import sp_top_categories
+
+    queries = [performance_quadrant.query]
+    for module in (installments_by_segment, segments_by_state, sp_top_categories):
+        queries += [module.build_query(), module.build_query('2000-01-01', '2100-01-01')]
+    return sorted({table for query in queries for table in query_cache.referenced_tables(query)})
+
+def read_data_version(tables, engine):
+    """Short hash of the current data version of the tables"""
+    version = query_cache.get_data_version(tables, engine)
+    payload = json.dumps(version, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+def set_data_version(version):
+    """Switch to a new data version, dropping everything cached for the old one"""
+    with _cache_lock:
+        changed = version != _state['version']
+        if changed:
+            _cache.clear()
+        _state['version'] = version
+        _state['checked_at'] = time.time()
+    return changed
+
+def cached(key, compute):
+    """Value for a key from the in-memory cache, computed once on a miss.
+
+    Callers missing a key that is already being computed wait for that
+    result instead of computing it again (single flight). Failures are
+    raised to every waiting caller and not cached.
+    """
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            _counters['hits'] += 1
+            return _cache[key]
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+            _counters['misses'] += 1
+    if not leader:
+        return future.result()
+
+    try:
+        value = compute()
+    except Exception as e:
+        with _cache_lock:
+            del _inflight[key]
+        future.set_exception(e)
+        raise
+    with _cache_lock:
+        del _inflight[key]
+        _cache[key] = value
+        while len(_cache) > MAX_CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    future.set_result(value)
+    return value
+
+def parse_params(analysis, fmt, query):
+    """(states, start, end) from a query string; raises ValueError when invalid.
+
+    `state` takes one or more comma-separated state codes (repeatable),
+    `start`/`end` ISO dates bounding the purchase dates (end exclusive).
+    """
+    params = parse_qs(query)
+    unknown = sorted(set(params) - {'state', 'start', 'end'})
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(unknown)}")
+
+    _, _, _, default_states, max_states = ANALYSES[analysis]
+    states = sorted({state.strip().upper() for value in params.get('state', [])
+                     for state in value.split(',') if state.strip()}) or default_states
+    invalid = [state for state in states or [] if not STATE_PATTERN.fullmatch(state)]
+    if invalid:
+        raise ValueError(f"Invalid state codes: {', '.join(invalid)}")
+    if fmt != 'json' and max_states is not None and len(states) > max_states:
+        raise ValueError(f"{analysis} charts show at most {max_states} state; "
+                         f"request {analysis}.json for more")
+
+    bounds = []
+    for name in ('start', 'end'):
+        values = params.get(name)
+        if values is None:
+            bounds.append(None)
+            continue
+        try:
+            bounds.append(date.fromisoformat(values[-1]).isoformat())
+        except ValueError:
+            raise ValueError(f"{name} must be a date (YYYY-MM-DD), got {values[-1]!r}")
+    start, end = bounds
+    if start is not None and end is not None and start >= end:
+        raise ValueError("start must be before end")
+    return states, start, end
+
+def etag(version, analysis, fmt, states, start, end):
+    """Strong validator for one payload: changes with the data version"""
+    payload = json.dumps([version, analysis, fmt, states, start, end])
+    return '"' + hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32] + '"'
+
+def matches_etag(header, tag):
+    """Whether an If-None-Match header matches the current tag"""
+    if header is None:
+        return False
+    candidates = [value.strip() for value in header.split(',')]
+    return '*' in candidates or any(value.removeprefix('W/') == tag for value in candidates)
+
+def get_frame(analysis, states, start, end, version):
+    """Analysis data for a date range; all states unless they are filtered in SQL"""
+    load, _, in_sql, _, _ = ANALYSES[analysis]
+    sql_states = states if in_sql else None
+
+    def compute():
+        with _cache_lock:
+            _counters['loads'] += 1
+        df = load(start, end, sql_states, version)
+        if df is None:
+            raise RuntimeError(f"{analysis} could not be fetched")
+        return df
+
+    key = ('frame', analysis, start, end, tuple(sql_states or ()), version)
+    df = cached(key, compute)
+    if states and not in_sql:
+        df = df[df['customer_state'].isin(states)].reset_index(drop=True)
+    return df
+
+def render(analysis, df, fmt, states, dpi=100):
+    """Chart image bytes for a DataFrame"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    plot = ANALYSES[analysis][1]
+    with _cache_lock:
+        _counters['renders'] += 1
+    with _render_lock:
+        fig = plot(df, states)
+        try:
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format=fmt, dpi=dpi, bbox_inches='tight')
+        finally:
+            plt.close(fig)
+    return buffer.getvalue()
+
+def get_payload(analysis, fmt, states, start, end, version):
+    """Response body for a request: from memory, or built on a miss"""
+    def compute():
+        df = get_frame(analysis, states, start, end, version)
+        if fmt == 'json':
+            body = {
+                'analysis': analysis,
+                'data_version': version,
+                'params': {'state': states, 'start': start, 'end': end},
+                'rows': json.loads(df.to_json(orient='records', date_format='iso')),
+            }
+            return json.dumps(body).encode('utf-8')
+        if df.empty:
+            raise LookupError(f"No {analysis} data for these parameters")
+        return render(analysis, df, fmt, states)
+
+    return cached(('payload', analysis, fmt, tuple(states or ()), start, end, version), compute)
+
+def warm_cache(version, formats=('json', 'png')):
+    """Build the default payload of every analysis for a data version"""
+    start = time.perf_counter()
+    for analysis, (_, _, _, default_states, _) in ANALYSES.items():
+        for fmt in formats:
+            try:
+                get_payload(analysis, fmt, default_states, None, None, version)
+            except Exception as e:
+                logger.error(f"Error precomputing {analysis}.{fmt}: {str(e)}")
+    logger.info(f"Precomputed {len(ANALYSES) * len(formats)} payloads for data version {version} "
+                f"in {time.perf_counter() - start:.2f}s")
+
+def watch_data_version(tables, engine, interval, stop, warm=True):
+    """Poll the data version until `stop` is set, re-warming the cache on changes"""
+    while not stop.wait(interval):
+        try:
+            version = read_data_version(tables, engine)
+        except Exception as e:
+            logger.error(f"Error reading the data version: {str(e)}")
+            continue
+        if set_data_version(version):
+            logger.info(f"Data version changed to {version}")
+            if warm:
+                warm_cache(version)
+
+def record_request(route, status, seconds):
+    with _metrics_lock:
+        _latencies.setdefault(route, {'window': deque(maxlen=LATENCY_WINDOW), 'count': 0, 'sum': 0.0})
+        entry = _latencies[route]
+        entry['window'].append(seconds)
+        entry['count'] += 1
+        entry['sum'] += seconds
+        _responses[(route, status)] = _responses.get((route, status), 0) + 1
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of sorted values"""
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+def latency_summary():
+    """route -> {count, p50_ms, p99_ms} over the latest LATENCY_WINDOW requests"""
+    with _metrics_lock:
+        windows = {route: (sorted(entry['window']), entry['count']) for route, entry in _latencies.items()}
+    return {route: {'count': count, 'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+                    'p99_ms': round(percentile(values, 0.99) * 1000, 3)}
+            for route, (values, count) in sorted(windows.items())}
+
+def prometheus_metrics():
+    """Request and cache metrics in the Prometheus text exposition format"""
+    with _metrics_lock:
+        latencies = {route: (sorted(entry['window']), entry['count'], entry['sum'])
+                     for route, entry in _latencies.items()}
+        responses = dict(_responses)
+    with _cache_lock:
+        counters = dict(_counters)
+        entries = len(_cache)
+
+    lines = [
+        "# HELP olist_serve_request_seconds Request latency (quantiles over the latest requests)",
+        "# TYPE olist_serve_request_seconds summary",
+    ]
+    for route, (values, count, total) in sorted(latencies.items()):
+        for q in (0.5, 0.99):
+            lines.append(f'olist_serve_request_seconds{{route="{route}",quantile="{q}"}} {percentile(values, q)}')
+        lines.append(f'olist_serve_request_seconds_count{{route="{route}"}} {count}')
+        lines.append(f'olist_serve_request_seconds_sum{{route="{route}"}} {total}')
+    lines += ["# HELP olist_serve_responses_total Responses by route and status",
+              "# TYPE olist_serve_responses_total counter"]
+    for (route, status), count in sorted(responses.items()):
+        lines.append(f'olist_serve_responses_total{{route="{route}",status="{status}"}} {count}')
+    for name, help_text in [('hits', 'Cache lookups served from memory'),
+                            ('misses', 'Cache lookups that computed a value'),
+                            ('loads', 'Analysis queries issued'),
+                            ('renders', 'Charts rendered'),
+                            ('not_modified', 'Requests answered with 304 Not Modified')]:
+        lines += [f"# HELP olist_serve_{name}_total {help_text}", f"# TYPE olist_serve_{name}_total counter",
+                  f"olist_serve_{name}_total {counters[name]}"]
+    lines += ["# HELP olist_serve_cache_entries Payloads and DataFrames held in memory",
+              "# TYPE olist_serve_cache_entries gauge", f"olist_serve_cache_entries {entries}"]
+    return "\n".join(lines) + "\n"
+
+def status():
+    """Analyses, data version, cache counters and latencies, for GET /"""
+    with _cache_lock:
+        counters = dict(_counters, entries=len(_cache))
+        version, checked_at = _state['version'], _state['checked_at']
+    return {
+        'analyses': {name: [f"/{name}.{fmt}" for fmt in CONTENT_TYPES] for name in ANALYSES},
+        'params': {'state': 'comma-separated state codes', 'start': 'YYYY-MM-DD', 'end': 'YYYY-MM-DD (exclusive)'},
+        'data_version': version,
+        'data_version_checked_at': checked_at,
+        'cache': counters,
+        'latency': latency_summary(),
+    }
+
+class AnalyticsHandler(BaseHTTPRequestHandler):
+    server_version = 'OlistAnalytics/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        began = time.perf_counter()
+        route, code = 'unknown', 500
+        try:
+            route, code = self._handle()
+        except Exception as e:
+            logger.error(f"Error serving {self.path}: {e.__class__.__name__}: {str(e)}")
+            self._send_json(500, {'error': 'internal error'})
+        finally:
+            record_request(route, code, time.perf_counter() - began)
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        if url.path == '/':
+            return 'index', self._send_json(200, status())
+        if url.path == '/metrics':
+            return 'metrics', self._send(200, prometheus_metrics().encode('utf-8'),
+                                         'text/plain; version=0.0.4')
+
+        match = PATH_PATTERN.fullmatch(url.path)
+        if match is None or match.group(1) not in ANALYSES:
+            return 'unknown', self._send_json(404, {'error': f"Unknown path {url.path}"})
+        analysis, fmt = match.groups()
+        route = f"{analysis}.{fmt}"
+        try:
+            states, start, end = parse_params(analysis, fmt, url.query)
+        except ValueError as e:
+            return route, self._send_json(400, {'error': str(e)})
+
+        version = _state['version']
+        if version is None:
+            return route, self._send_json(503, {'error': 'Data version not available yet'},
+                                          {'Retry-After': '5'})
+        tag = etag(version, analysis, fmt, states, start, end)
+        headers = {'ETag': tag, 'Cache-Control': 'no-cache', 'X-Data-Version': version}
+        if matches_etag(self.headers.get('If-None-Match'), tag):
+            with _cache_lock:
+                _counters['not_modified'] += 1
+            return route, self._send(304, b'', None, headers)
+
+        try:
+            body = get_payload(analysis, fmt, states, start, end, version)
+        except LookupError as e:
+            return route, self._send_json(404, {'error': str(e)})
+        except RuntimeError as e:
+            return route, self._send_json(503, {'error': str(e)}, {'Retry-After': '5'})
+        return route, self._send(200, body, CONTENT_TYPES[fmt], headers)
+
+    def _send(self, code, body, content_type, headers=None):
+        self.send_response(code)
+        if content_type is not None:
+            self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if code != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+        return code
+
+    def _send_json(self, code, payload, headers=None):
+        return self._send(code, json.dumps(payload).encode('utf-8'), CONTENT_TYPES['json'], headers)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+class AnalyticsServer(ThreadingHTTPServer):
+    # Dozens of dashboards may connect at once; the default backlog is 5
+    request_queue_size = 128
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, poll_seconds=DEFAULT_POLL_SECONDS, warm=True):
+    """Serve the analyses until interrupted; returns False if the database is unreachable"""
+    engine = get_db_connection()
+    if engine is None:
+        return False
+    tables = data_tables()
+    try:
+        set_data_version(read_data_version(tables, engine))
+    except Exception as e:
+        logger.error(f"Error reading the data version: {str(e)}")
+        return False
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=watch_data_version, args=(tables, engine, poll_seconds, stop, warm),
+                                name='data-version', daemon=True)]
+    if warm:
+        threads.append(threading.Thread(target=warm_cache, args=(_state['version'],), name='warm', daemon=True))
+    for thread in threads:
+        thread.start()
+
+    server = AnalyticsServer((host, port), AnalyticsHandler)
+    logger.info(f"Serving {len(ANALYSES)} analyses on http://{host}:{server.server_port}/ "
+                f"(data version {_state['version']}, checked every {poll_seconds:g}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the analyses as JSON and charts over HTTP")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Address to bind (default {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port (default {DEFAULT_PORT})")
+    parser.add_argument("--poll-seconds", type=float, default=DEFAULT_POLL_SECONDS,
+                        help=f"Seconds between data-version checks (default {DEFAULT_POLL_SECONDS:g})")
+    parser.add_argument("--no-warm", action="store_true",
+                        help="Don't precompute the default payloads; build everything on first request")
+    args = parser.parse_args()
+
+    if not serve(args.host, args.port, args.poll_seconds, warm=not args.no_warm):
+        raise SystemExit(1)
@@ -1,44 +1,192 @@
+import argparse
+import os
+import threading
+import time
 import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np
-from utils import get_db_connection
+import query_cache
+from utils import execute_query, get_db_connection
+from sampling import sample_predicate, total_estimate, with_interval
+from typed_schema import purchase_window_sql
 
-def get_sp_category_data():
-    """Fetch top 10 product categories purchased in SP state"""
-    engine = get_db_connection()
-    
-    query = """
-    SELECT 
+# Category ranking for every state in one pass: purchases are counted per
+# (state, category), ranked within each state by a partitioned ROW_NUMBER and
+# translated with a join to analytics.category_translation. The full ranking
+# is small (states x categories), so one query serves any state and any N.
+def build_query(start=None, end=None):
+    """The ranking over items of orders purchased in [start, end) (all history by default)"""
+    return f"""
+WITH category_counts AS (
+    SELECT
+        c.customer_state,
         p.product_category_name,
         COUNT(*) as purchase_count
-    FROM products p
-    JOIN order_items oi ON p.product_id = oi.product_id
-    JOIN orders o ON oi.order_id = o.order_id
-    JOIN customers c ON o.customer_id = c.customer_id
-    WHERE c.customer_state = 'SP'
-        AND p.product_category_name IS NOT NULL
-    GROUP BY p.product_category_name
-    ORDER BY purchase_count DESC
-    LIMIT 10;
+    FROM analytics.order_items oi
+    JOIN analytics.products p ON p.product_id = oi.product_id
+    JOIN analytics.orders o ON o.order_id = oi.order_id
+    JOIN analytics.customers c ON c.customer_id = o.customer_id
+    WHERE p.product_category_name IS NOT NULL{purchase_window_sql(['oi', 'o'], start, end)}
+    GROUP BY c.customer_state, p.product_category_name
+)
+SELECT
+    cc.customer_state,
+    ROW_NUMBER() OVER (
+        PARTITION BY cc.customer_state
+        ORDER BY cc.purchase_count DESC, cc.product_category_name
+    ) as category_rank,
+    cc.product_category_name,
+    COALESCE(t.category_english, INITCAP(REPLACE(cc.product_category_name, '_', ' '))) as category_english,
+    cc.purchase_count
+FROM category_counts cc
+LEFT JOIN analytics.category_translation t ON t.product_category_name = cc.product_category_name
+ORDER BY cc.customer_state, category_rank;
+"""
+
+query = build_query()
+
+def build_sampled_query(fraction, start=None, end=None):
+    """Per-(state, category) purchase sums over a customer sample.
+
+    sum_y/sum_y2 are the sums of each sampled customer's purchase count and
+    its square, for the scaled-up count and its interval (see sampling.py).
     """
-    
-    df = pd.read_sql_query(query, engine)
-    
-    # Translate category names
-    category_translations = {
-        'beleza_saude': 'Health & Beauty',
-        'cama_mesa_banho': 'Bed, Bath & Table',
-        'esporte_lazer': 'Sports & Leisure',
-        'moveis_decoracao': 'Furniture & Decor',
-        'informatica_acessorios': 'Computer Accessories',
-        'utilidades_domesticas': 'Household Items',
-        'relogios_presentes': 'Watches & Gifts',
-        'telefonia': 'Mobile Phones & Accessories',
-        'automotivo': 'Automotive',
-        'brinquedos': 'Toys'
-    }
-    df['category_english'] = df['product_category_name'].map(category_translations)
-    return df
+    return f"""
+WITH customer_counts AS (
+    SELECT
+        c.customer_unique_id,
+        c.customer_state,
+        p.product_category_name,
+        COUNT(*) as purchases
+    FROM analytics.customers c
+    JOIN analytics.orders o ON o.customer_id = c.customer_id
+    JOIN analytics.order_items oi ON oi.order_id = o.order_id
+    JOIN analytics.products p ON p.product_id = oi.product_id
+    WHERE p.product_category_name IS NOT NULL
+        AND {sample_predicate(fraction, ['c', 'o', 'oi'])}{purchase_window_sql(['o', 'oi'], start, end)}
+    GROUP BY c.customer_unique_id, c.customer_state, p.product_category_name
+)
+SELECT
+    cc.customer_state,
+    cc.product_category_name,
+    COALESCE(t.category_english, INITCAP(REPLACE(cc.product_category_name, '_', ' '))) as category_english,
+    SUM(cc.purchases) as sum_y,
+    SUM(cc.purchases * cc.purchases) as sum_y2
+FROM customer_counts cc
+LEFT JOIN analytics.category_translation t ON t.product_category_name = cc.product_category_name
+GROUP BY cc.customer_state, cc.product_category_name, t.category_english;
+"""
+
+def get_sampled_top_categories(fraction, states=None, n=10, engine=None, start=None, end=None):
+    """get_top_categories estimated from a customer sample.
+
+    purchase_count is scaled up to the full population and comes with
+    purchase_count_ci_low/high bounds; ranks follow the estimates.
+    """
+    df = execute_query(build_sampled_query(fraction, start, end), engine)
+    if df is None:
+        return None
+    if states is not None:
+        df = df[df['customer_state'].isin(list(states))]
+    estimate, half_width = total_estimate(df['sum_y'], df['sum_y2'], fraction)
+    df = with_interval(df, 'purchase_count', estimate, half_width, digits=0)
+    df = df.sort_values(['customer_state', 'purchase_count', 'product_category_name'],
+                        ascending=[True, False, True])
+    df['category_rank'] = df.groupby('customer_state').cumcount() + 1
+    return df[df['category_rank'] <= n][[
+        'customer_state', 'category_rank', 'product_category_name', 'category_english',
+        'purchase_count', 'purchase_count_ci_low', 'purchase_count_ci_high',
+    ]].reset_index(drop=True)
+
+# (start, end) -> (data version, {state: full category ranking}), for the
+# MAX_CACHED_RANGES most recently computed ranges
+_rankings = {}
+MAX_CACHED_RANGES = 16
+# Data version read by get_top_categories itself, re-read at most every
+# VERSION_CHECK_SECONDS so cached lookups do not query the database
+VERSION_CHECK_SECONDS = float(os.getenv('RANKINGS_VERSION_CHECK_SECONDS', '5'))
+_data_version = {'value': None, 'checked_at': None}
+_rankings_lock = threading.Lock()
+
+def current_data_version(engine):
+    """query_cache data version of the ranking's tables, read at most every VERSION_CHECK_SECONDS"""
+    now = time.monotonic()
+    with _rankings_lock:
+        checked_at = _data_version['checked_at']
+        if checked_at is not None and now - checked_at < VERSION_CHECK_SECONDS:
+            return _data_version['value']
+    try:
+        value = query_cache.get_data_version(query_cache.referenced_tables(query), engine)
+    except Exception:
+        value = None
+    with _rankings_lock:
+        _data_version.update(value=value, checked_at=now)
+    return value
+
+def get_top_categories(states=None, n=10, engine=None, sample=None, start=None, end=None,
+                       version=None, cache=True):
+    """Top-n categories by purchases for each state (all states by default).
+
+    Rankings are cached per date range and data version; a miss for any
+    state re-ranks all states with one query. Pass `version` when the
+    caller already tracks the data version (serve.py passes its polled
+    one); otherwise it is re-read at most every VERSION_CHECK_SECONDS.
+    cache=False always runs the query. Returns customer_state,
+    category_rank, product_category_name, category_english and
+    purchase_count, or None on error. With `sample` set to a fraction, the
+    counts are estimated from that share of customers instead.
+    `start`/`end` limit the ranking to orders purchased in that range (end
+    exclusive).
+    """
+    if sample is not None:
+        return get_sampled_top_categories(sample, states, n, engine, start, end)
+
+    if engine is None:
+        engine = get_db_connection()
+    wanted = list(states) if states is not None else None
+
+    rankings = None
+    if cache:
+        if version is None:
+            version = current_data_version(engine)
+        with _rankings_lock:
+            cached_version, cached = _rankings.get((start, end), (None, None))
+            if (cached is not None and version is not None and cached_version == version
+                    and (wanted is None or all(state in cached for state in wanted))):
+                rankings = cached
+
+    if rankings is None:
+        df = execute_query(build_query(start, end), engine)
+        if df is None:
+            return None
+        rankings = {state: group for state, group in df.groupby('customer_state', sort=False)}
+        if cache and version is not None:
+            with _rankings_lock:
+                _rankings.pop((start, end), None)
+                _rankings[(start, end)] = (version, rankings)
+                while len(_rankings) > MAX_CACHED_RANGES:
+                    del _rankings[next(iter(_rankings))]
+
+    wanted = wanted if wanted is not None else sorted(rankings)
+    frames = [rankings[state] for state in wanted if state in rankings]
+    if not frames:
+        return pd.DataFrame(columns=['customer_state', 'category_rank', 'product_category_name',
+                                     'category_english', 'purchase_count'])
+    df = pd.concat(frames, ignore_index=True)
+    return df[df['category_rank'] <= n].reset_index(drop=True)
+
+def get_sp_category_data(engine=None, sample=None, start=None, end=None, cache=True):
+    """Fetch top 10 product categories purchased in SP state"""
+    df = get_top_categories(['SP'], 10, engine, sample, start, end, cache=cache)
+    if df is None:
+        return None
+    columns = ['product_category_name', 'purchase_count', 'category_english']
+    return df[columns + [col for col in df.columns if col.startswith('purchase_count_ci')]]
+
+def print_top_categories(df):
+    """Print the category ranking state by state"""
+    for state, group in df.groupby('customer_state'):
+        print(f"\n{state}")
+        for _, row in group.iterrows():
+            print(f"  {row['category_rank']:>2}. {row['category_english']:<40}{row['purchase_count']:>10,}")
 
 def hex_to_rgb(hex_color):
     """Convert hex color to RGB tuple"""
@@ -50,15 +198,17 @@ def get_gradient_color(position, num_bars, start_color='#2E5894', end_color='#94
     start_rgb = hex_to_rgb(start_color)
     end_rgb = hex_to_rgb(end_color)
     
-    fraction = position / (num_bars - 1)
+    fraction = position / (num_bars - 1) if num_bars > 1 else 0
     return tuple(
         start + (end - start) * fraction
         for start, end in zip(start_rgb, end_rgb)
     )
 
-def create_category_plot(df):
-    """Create and display a bar plot of the top categories"""
-    plt.figure(figsize=(12, 6))
+def plot_categories(df, state='SP'):
+    """Create a bar plot of a state's top categories and return the figure"""
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(12, 6))
     ax = plt.gca()
     
     # Create bars with gradient colors
@@ -67,7 +217,8 @@ def create_category_plot(df):
     plt.bar(x, df['purchase_count'], width=0.8, color=colors)
     
     # Customize the plot
-    plt.title('Top 10 Product Categories Purchased in São Paulo', pad=20)
+    place = 'São Paulo' if state == 'SP' else state
+    plt.title(f'Top {len(df)} Product Categories Purchased in {place}', pad=20)
     plt.xlabel('Product Category')
     plt.ylabel('Number of Purchases')
     
@@ -82,18 +233,37 @@ def create_category_plot(df):
     for i, count in enumerate(df['purchase_count']):
         plt.text(i, count + 50, f'{int(count):,}', ha='center', va='bottom')
     
-    # Set y-axis limits to match original
-    plt.ylim(0, 5500)
+    # Set y-axis limits to match original (SP); other states scale to their data
+    plt.ylim(0, 5500 if state == 'SP' else df['purchase_count'].max() * 1.15)
     
     # Add grid lines
     plt.grid(True, axis='y', linestyle='--', alpha=0.3, zorder=0)
     
     # Adjust layout to prevent label cutoff
     plt.tight_layout()
-    
-    # Show the plot
+    return fig
+
+def create_category_plot(df):
+    """Create and display a bar plot of the top categories"""
+    import matplotlib.pyplot as plt
+
+    plot_categories(df)
     plt.show()
 
 if __name__ == "__main__":
-    df = get_sp_category_data()
-    create_category_plot(df)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Top product categories by state")
+    parser.add_argument("--report", action="store_true",
+                        help="Print the ranking for every state instead of plotting SP")
+    parser.add_argument("--states", nargs="+", help="Only these states (with --report)")
+    parser.add_argument("-n", type=int, default=10, help="Categories per state (default 10)")
+    parser.add_argument("--start", help="First purchase date included")
+    parser.add_argument("--end", help="Purchase date the ranking stops before")
+    args = parser.parse_args()
+
+    if args.report:
+        df = get_top_categories(args.states, args.n, start=args.start, end=args.end)
+        if df is not None:
+            print_top_categories(df)
+    else:
+        df = get_sp_category_data(start=args.start, end=args.end)
+        create_category_plot(df)
\ No newline at end of file
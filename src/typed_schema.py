@@ -0,0 +1,491 @@
+import argparse
+import logging
+import time
+from sqlalchemy import text
+from utils import bind_literals, date_range_params, get_db_connection, execute_query
+from schema_keys import (PRIMARY_KEYS, FOREIGN_KEYS, PARTITIONED_TABLES, create_key_statements,
+                         drop_key_statements, foreign_key_columns, index_name)
+from query_cache import track_changes
+from sampling import SAMPLE_BUCKET_COLUMN, sample_bucket_sql
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_SCHEMA = "analytics"
+
+# Target types for each raw (all-text) table in schema.sql. Columns are listed in
+# schema.sql order; anything not text is cast once here instead of in every query.
+TYPED_TABLES = {
+    'customers': {
+        'customer_id': 'text',
+        'customer_unique_id': 'text',
+        'customer_zip_code_prefix': 'text',
+        'customer_city': 'text',
+        'customer_state': 'text',
+    },
+    'orders': {
+        'order_id': 'text',
+        'customer_id': 'text',
+        'order_status': 'text',
+        'order_purchase_timestamp': 'timestamp',
+        'order_approved_at': 'timestamp',
+        'order_delivered_carrier_date': 'timestamp',
+        'order_delivered_customer_date': 'timestamp',
+        'order_estimated_delivery_date': 'timestamp',
+    },
+    'order_items': {
+        'order_id': 'text',
+        'order_item_id': 'integer',
+        'product_id': 'text',
+        'seller_id': 'text',
+        'shipping_limit_date': 'timestamp',
+        'price': 'numeric(10,2)',
+        'freight_value': 'numeric(10,2)',
+    },
+    'order_payments': {
+        'order_id': 'text',
+        'payment_sequential': 'integer',
+        'payment_type': 'text',
+        'payment_installments': 'integer',
+        'payment_value': 'numeric(10,2)',
+    },
+    'products': {
+        'product_id': 'text',
+        'product_category_name': 'text',
+        'product_name_length': 'integer',
+        'product_description_length': 'integer',
+        'product_photos_qty': 'integer',
+        'product_weight_g': 'integer',
+        'product_length_cm': 'integer',
+        'product_height_cm': 'integer',
+        'product_width_cm': 'integer',
+    },
+}
+
+# Orders, order_items and order_payments are range-partitioned by purchase
+# month (PARTITIONED_TABLES in schema_keys.py). order_items and
+# order_payments carry their order's purchase timestamp, copied from
+# analytics.orders when they are built, so a purchase-date range prunes all
+# three tables. Partitions cover every month with orders; a default partition
+# takes rows inserted for other months until the next build.
+PURCHASE_COLUMN = 'order_purchase_timestamp'
+
+# Tables carrying each customer's sampling bucket (sampling.py) in an indexed
+# column, and the table it is copied from at build time: customers compute it
+# from customer_unique_id, orders take their customer's and items and
+# payments their order's. A sampled query filters every table it joins on
+# its own bucket column, so each is read through that index rather than
+# scanned in full.
+SAMPLE_BUCKET_SOURCES = {
+    'customers': None,
+    'orders': 'customers',
+    'order_items': 'orders',
+    'order_payments': 'orders',
+}
+
+# Columns a row cannot be loaded without; a missing value rejects the row
+REQUIRED_COLUMNS = {
+    'customers': ['customer_id', 'customer_unique_id'],
+    'orders': ['order_id', 'customer_id', 'order_purchase_timestamp'],
+    'order_items': ['order_id', 'order_item_id', 'product_id'],
+    'order_payments': ['order_id', 'payment_sequential'],
+    'products': ['product_id'],
+}
+
+# Lenient casts: return NULL instead of raising so bad values can be reported.
+# They stay PARALLEL UNSAFE: the EXCEPTION block opens a subtransaction, which
+# is not allowed once a query runs in parallel mode. try_timestamp is only
+# STABLE, since text-to-timestamp parsing depends on the session's DateStyle.
+try_cast_functions = f"""
+CREATE SCHEMA IF NOT EXISTS {ANALYTICS_SCHEMA};
+
+CREATE OR REPLACE FUNCTION {ANALYTICS_SCHEMA}.try_timestamp(value text) RETURNS timestamp
+LANGUAGE plpgsql STABLE STRICT AS $$
+BEGIN
+    RETURN NULLIF(btrim(value), '')::timestamp;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION {ANALYTICS_SCHEMA}.try_numeric(value text) RETURNS numeric
+LANGUAGE plpgsql IMMUTABLE STRICT AS $$
+BEGIN
+    RETURN NULLIF(btrim(value), '')::numeric;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION {ANALYTICS_SCHEMA}.try_integer(value text) RETURNS integer
+LANGUAGE plpgsql IMMUTABLE STRICT AS $$
+DECLARE
+    parsed numeric;
+BEGIN
+    -- Accept '3' and '3.0' (pandas float exports), reject '3.5'
+    parsed := NULLIF(btrim(value), '')::numeric;
+    IF parsed <> trunc(parsed) THEN
+        RETURN NULL;
+    END IF;
+    RETURN parsed::integer;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END $$;
+"""
+
+# One partition per month from first_date to last_date; months that already
+# have a partition are skipped
+partition_functions = f"""
+CREATE OR REPLACE FUNCTION {ANALYTICS_SCHEMA}.create_month_partitions(
+    parent text, first_date timestamp, last_date timestamp
+) RETURNS integer LANGUAGE plpgsql AS $$
+DECLARE
+    month timestamp;
+    created integer := 0;
+BEGIN
+    FOR month IN
+        SELECT generate_series(date_trunc('month', first_date), date_trunc('month', last_date), interval '1 month')
+    LOOP
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I.%I PARTITION OF %I.%I FOR VALUES FROM (%L) TO (%L)',
+                       '{ANALYTICS_SCHEMA}', parent || '_' || to_char(month, 'YYYY_MM'),
+                       '{ANALYTICS_SCHEMA}', parent, month, month + interval '1 month');
+        created := created + 1;
+    END LOOP;
+    RETURN created;
+END $$;
+"""
+
+rejected_rows_ddl = f"""
+CREATE TABLE IF NOT EXISTS {ANALYTICS_SCHEMA}.rejected_rows (
+    table_name text NOT NULL,
+    rejected_columns text[] NOT NULL,
+    raw_row jsonb NOT NULL,
+    rejected_at timestamptz NOT NULL DEFAULT now()
+);
+"""
+
+def typed_expression(column, column_type):
+    """SQL expression converting a raw text column to its typed value"""
+    if column_type == 'text':
+        return f"NULLIF(src.{column}, '')"
+    if column_type == 'timestamp':
+        return f"{ANALYTICS_SCHEMA}.try_timestamp(src.{column})"
+    if column_type == 'integer':
+        return f"{ANALYTICS_SCHEMA}.try_integer(src.{column})"
+    if column_type.startswith('numeric'):
+        return f"{ANALYTICS_SCHEMA}.try_numeric(src.{column})::{column_type}"
+    raise ValueError(f"Unsupported column type: {column_type}")
+
+def typed_columns(table_name):
+    """Columns and types of a typed table: its raw columns plus, for tables
+    partitioned on a column they do not have, that column from analytics.orders,
+    and the sampling bucket where SAMPLE_BUCKET_SOURCES lists the table"""
+    columns = dict(TYPED_TABLES[table_name])
+    partition_column = PARTITIONED_TABLES.get(table_name)
+    if partition_column is not None and partition_column not in columns:
+        columns[partition_column] = TYPED_TABLES['orders'][partition_column]
+    if table_name in SAMPLE_BUCKET_SOURCES:
+        columns[SAMPLE_BUCKET_COLUMN] = 'integer'
+    return columns
+
+def purchase_window_sql(aliases, start=None, end=None, keyword='AND', indent=8):
+    """Conditions limiting each alias to orders purchased in [start, end).
+
+    Returns '' when both bounds are None, else one line per alias (the first
+    starting with `keyword`, the rest with AND), indented by `indent`
+    spaces, to append to a WHERE clause. The bounds are inlined as
+    literals so the planner prunes partitions when it plans the query. Each
+    partitioned table prunes on its own column only, so pass every one the
+    query joins.
+    """
+    if start is None and end is None:
+        return ""
+    params = date_range_params(start, end)
+    conditions = [
+        bind_literals(f"{alias}.{PURCHASE_COLUMN} >= CAST(:start AS timestamp) "
+                      f"AND {alias}.{PURCHASE_COLUMN} < CAST(:end AS timestamp)", params)
+        for alias in aliases
+    ]
+    separator = "\n" + " " * indent
+    return f"{separator}{keyword} " + f"{separator}AND ".join(conditions)
+
+def _parent_key(table_name, parent=None):
+    """(columns, parent table, parent columns) of the foreign key a child table
+    takes its partition column through, or of its key to `parent`"""
+    for table, columns, ref_table, ref_columns in FOREIGN_KEYS:
+        if table == table_name and (ref_table == parent or parent is None and ref_table in PARTITIONED_TABLES):
+            return columns, ref_table, ref_columns
+    raise ValueError(f"{table_name} has no parent {parent or 'partitioned table'} to take columns from")
+
+def dependent_tables(tables):
+    """`tables` plus every typed table that copies a column from one of them
+    (the partition column or the sampling bucket), in TYPED_TABLES order"""
+    tables = set(tables)
+    # TYPED_TABLES lists parents first, so dependencies cascade down the chain
+    for table_name in TYPED_TABLES:
+        if (table_name in PARTITIONED_TABLES and 'orders' in tables
+                or SAMPLE_BUCKET_SOURCES.get(table_name) in tables):
+            tables.add(table_name)
+    return [t for t in TYPED_TABLES if t in tables]
+
+def build_table_statements(table_name):
+    """Return the SQL statements that rebuild one typed table from its raw table"""
+    columns = TYPED_TABLES[table_name]
+    required = REQUIRED_COLUMNS[table_name]
+    stage = f"{table_name}_typed_stage"
+
+    casts = ",\n            ".join(
+        f"{typed_expression(col, col_type)} AS {col}" for col, col_type in columns.items()
+    )
+    # A column is rejected when the raw value is present but did not cast, or
+    # when a required column is missing altogether
+    checks = []
+    for col, col_type in columns.items():
+        raw_value = f"NULLIF(btrim((raw).{col}), '')"
+        if col_type != 'text':
+            checks.append(f"CASE WHEN {raw_value} IS NOT NULL AND {col} IS NULL THEN '{col}' END")
+        if col in required:
+            checks.append(f"CASE WHEN {raw_value} IS NULL THEN '{col}' END")
+    rejected = "ARRAY_REMOVE(ARRAY[\n            " + ",\n            ".join(checks) + "\n        ]::text[], NULL)"
+
+    column_defs = ",\n    ".join(f"{col} {col_type}" for col, col_type in typed_columns(table_name).items())
+    table = f"{ANALYTICS_SCHEMA}.{table_name}"
+    partition_column = PARTITIONED_TABLES.get(table_name)
+
+    # Columns not in the raw table: copied from a parent row or computed,
+    # column -> expression over the stage row `s` and the joined parents
+    copied, parents = {}, []
+    if partition_column is not None and partition_column not in columns:
+        # Partitioned like its parent, whose duplicates are already removed;
+        # rows without a parent get a NULL partition key, land in the default
+        # partition and are rejected as orphans by orphan_statements()
+        parents.append(_parent_key(table_name)[1])
+        copied[partition_column] = f"{parents[0]}.{partition_column}"
+    if table_name in SAMPLE_BUCKET_SOURCES:
+        source = SAMPLE_BUCKET_SOURCES[table_name]
+        if source is None:
+            copied[SAMPLE_BUCKET_COLUMN] = sample_bucket_sql('s.customer_unique_id')
+        else:
+            if source not in parents:
+                parents.append(source)
+            copied[SAMPLE_BUCKET_COLUMN] = f"{source}.{SAMPLE_BUCKET_COLUMN}"
+    joins = ""
+    for parent in parents:
+        key, _, parent_key = _parent_key(table_name, parent)
+        join = " AND ".join(f"{parent}.{pc} = s.{c}" for c, pc in zip(key, parent_key))
+        joins += f"\n            LEFT JOIN {ANALYTICS_SCHEMA}.{parent} {parent} ON {join}"
+    # Rows are written in bucket order, so a sample's rows share pages and a
+    # sampled query reads about its fraction of each table
+    order = f"\n            ORDER BY {copied[SAMPLE_BUCKET_COLUMN]}" if SAMPLE_BUCKET_COLUMN in copied else ""
+    insert = f"""
+            INSERT INTO {table} ({", ".join([*columns, *copied])})
+            SELECT {", ".join([f"s.{col}" for col in columns] + list(copied.values()))}
+            FROM {stage} s{joins}
+            WHERE cardinality(s.rejected_columns) = 0{order}
+            """
+
+    statements = [
+        f"DROP TABLE IF EXISTS {table} CASCADE",
+        f"""
+        CREATE TEMP TABLE {stage} ON COMMIT DROP AS
+        SELECT typed.*, {rejected} AS rejected_columns
+        FROM (
+            SELECT
+            {casts},
+            src AS raw
+            FROM public.{table_name} src
+        ) typed
+        """,
+    ]
+    if partition_column is None:
+        statements += [
+            f"CREATE TABLE {table} (\n    {column_defs}\n)",
+            insert,
+        ]
+    elif partition_column in columns:
+        statements += [
+            f"CREATE TABLE {table} (\n    {column_defs}\n) PARTITION BY RANGE ({partition_column})",
+            f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT",
+            f"""
+            SELECT {ANALYTICS_SCHEMA}.create_month_partitions('{table_name}', MIN({partition_column}),
+                MAX({partition_column}))
+            FROM {stage}
+            WHERE cardinality(rejected_columns) = 0
+            """,
+            insert,
+        ]
+    else:
+        statements += [
+            f"CREATE TABLE {table} (\n    {column_defs}\n) PARTITION BY RANGE ({partition_column})",
+            f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT",
+            f"""
+            SELECT {ANALYTICS_SCHEMA}.create_month_partitions('{table_name}', MIN({partition_column}),
+                MAX({partition_column}))
+            FROM {ANALYTICS_SCHEMA}.{parents[0]}
+            """,
+            insert,
+        ]
+    statements.append(f"""
+        INSERT INTO {ANALYTICS_SCHEMA}.rejected_rows (table_name, rejected_columns, raw_row)
+        SELECT '{table_name}', rejected_columns, to_jsonb(raw) FROM {stage}
+        WHERE cardinality(rejected_columns) > 0
+        """)
+    if table_name in SAMPLE_BUCKET_SOURCES:
+        statements.append(f"CREATE INDEX {index_name(table_name, [SAMPLE_BUCKET_COLUMN])} "
+                          f"ON {table} ({SAMPLE_BUCKET_COLUMN})")
+    return statements + duplicate_key_statements(table_name)
+
+def duplicate_key_statements(table_name):
+    """Statements moving rows with a duplicate primary key into rejected_rows.
+
+    Run right after a table is loaded and before the keys are added; the
+    first row of each key is kept, by partition and then physical order.
+    Rows are addressed by (tableoid, ctid) since ctid repeats across
+    partitions.
+    """
+    columns, _ = PRIMARY_KEYS[table_name]
+    key_list = ", ".join(columns)
+    key_names = ", ".join(f"'{col}'" for col in columns)
+    return [f"""
+        WITH ranked AS (
+            SELECT tableoid AS row_table, ctid AS row_ctid,
+                ROW_NUMBER() OVER (PARTITION BY {key_list} ORDER BY tableoid, ctid) as rn
+            FROM {ANALYTICS_SCHEMA}.{table_name}
+        ),
+        removed AS (
+            DELETE FROM {ANALYTICS_SCHEMA}.{table_name} t
+            USING ranked
+            WHERE t.tableoid = ranked.row_table AND t.ctid = ranked.row_ctid AND ranked.rn > 1
+            RETURNING t.*
+        )
+        INSERT INTO {ANALYTICS_SCHEMA}.rejected_rows (table_name, rejected_columns, raw_row)
+        SELECT '{table_name}', ARRAY[{key_names}], to_jsonb(removed) FROM removed
+        """]
+
+def orphan_statements():
+    """Statements moving rows whose parent row is missing into rejected_rows.
+
+    Run after every table is loaded and before the keys are added, so the
+    foreign keys in schema_keys.py can always be created. Children of a
+    partitioned parent must also match its purchase timestamp.
+    """
+    statements = []
+    # FOREIGN_KEYS lists parents first, so orphans cascade down the chain
+    for table_name, columns, ref_table, ref_columns in FOREIGN_KEYS:
+        key, ref_key = foreign_key_columns(table_name, columns, ref_table, ref_columns, partitioned=True)
+        join = " AND ".join(f"parent.{rc} = child.{c}" for c, rc in zip(key, ref_key))
+        key_names = ", ".join(f"'{col}'" for col in key)
+        statements.append(f"""
+        WITH removed AS (
+            DELETE FROM {ANALYTICS_SCHEMA}.{table_name} child
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {ANALYTICS_SCHEMA}.{ref_table} parent WHERE {join}
+            )
+            RETURNING child.*
+        )
+        INSERT INTO {ANALYTICS_SCHEMA}.rejected_rows (table_name, rejected_columns, raw_row)
+        SELECT '{table_name}', ARRAY[{key_names}], to_jsonb(removed) FROM removed
+        """)
+    return statements
+
+def build_typed_schema(engine=None, tables=None):
+    """Rebuild the typed analytics tables from the raw tables.
+
+    Returns a DataFrame with loaded/rejected counts per table, or None on error.
+    """
+    try:
+        if engine is None:
+            engine = get_db_connection()
+
+        if engine is None:
+            raise Exception("Failed to establish database connection")
+
+        # Tables copying a column from a rebuilt table are rebuilt with it
+        tables = dependent_tables(tables or list(TYPED_TABLES))
+        with engine.begin() as conn:
+            conn.execute(text(try_cast_functions))
+            conn.execute(text(partition_functions))
+            conn.execute(text(rejected_rows_ddl))
+            conn.execute(
+                text(f"DELETE FROM {ANALYTICS_SCHEMA}.rejected_rows WHERE table_name = ANY(:tables)"),
+                {"tables": tables}
+            )
+            for statement in drop_key_statements(ANALYTICS_SCHEMA):
+                conn.execute(text(statement))
+            for table_name in tables:
+                start = time.perf_counter()
+                for statement in build_table_statements(table_name):
+                    conn.execute(text(statement))
+                logger.info(f"Built {ANALYTICS_SCHEMA}.{table_name} in {time.perf_counter() - start:.2f}s")
+
+            # Keys span tables, so they are re-checked and re-added for all of them
+            start = time.perf_counter()
+            for statement in orphan_statements():
+                conn.execute(text(statement))
+            for statement in create_key_statements(ANALYTICS_SCHEMA, partitioned=True):
+                conn.execute(text(statement))
+            for table_name in TYPED_TABLES:
+                conn.execute(text(f"ANALYZE {ANALYTICS_SCHEMA}.{table_name}"))
+            logger.info(f"Added keys and indexes in {time.perf_counter() - start:.2f}s")
+
+            from categories import TRANSLATION_TABLE, seed_category_translations
+            from payment_facts import build_payment_facts
+            seed_category_translations(conn)
+            build_payment_facts(conn)
+            # Rebuilt tables lose their version trigger (see query_cache.py)
+            track_changes([f"{ANALYTICS_SCHEMA}.{t}" for t in TYPED_TABLES] + [TRANSLATION_TABLE], conn)
+
+        return get_rejection_report(engine, tables)
+    except Exception as e:
+        logger.error(f"Error building typed schema: {str(e)}")
+        return None
+
+def get_rejection_report(engine=None, tables=None):
+    """Loaded and rejected row counts for each typed table"""
+    tables = tables or list(TYPED_TABLES)
+    counts = " UNION ALL ".join(
+        f"SELECT '{t}' as table_name, "
+        f"(SELECT COUNT(*) FROM {ANALYTICS_SCHEMA}.{t}) as loaded_rows, "
+        f"(SELECT COUNT(*) FROM {ANALYTICS_SCHEMA}.rejected_rows WHERE table_name = '{t}') as rejected_rows"
+        for t in tables
+    )
+    return execute_query(counts, engine)
+
+def get_rejected_rows(table_name, limit=20, engine=None):
+    """Sample of rejected rows for one table, with the columns that failed"""
+    query = f"""
+    SELECT rejected_columns, raw_row
+    FROM {ANALYTICS_SCHEMA}.rejected_rows
+    WHERE table_name = '{table_name}'
+    LIMIT {int(limit)}
+    """
+    return execute_query(query, engine)
+
+def print_report(report, engine=None, show_samples=False):
+    """Print the per-table load report"""
+    print(f"\n{'Table':<16}{'Loaded':>12}{'Rejected':>12}")
+    print("-" * 40)
+    for _, row in report.iterrows():
+        print(f"{row['table_name']:<16}{row['loaded_rows']:>12,}{row['rejected_rows']:>12,}")
+        if show_samples and row['rejected_rows'] > 0:
+            samples = get_rejected_rows(row['table_name'], limit=5, engine=engine)
+            if samples is not None:
+                for _, sample in samples.iterrows():
+                    print(f"    {', '.join(sample['rejected_columns'])}: {sample['raw_row']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the typed analytics schema from the raw tables")
+    parser.add_argument("command", choices=["build", "report"],
+                        help="build: rebuild the typed tables; report: show row counts")
+    parser.add_argument("--tables", nargs="+", choices=list(TYPED_TABLES),
+                        help="Only rebuild these tables (default: all)")
+    parser.add_argument("--show-rejected", action="store_true",
+                        help="Print sample rejected rows for each table")
+    args = parser.parse_args()
+
+    engine = get_db_connection()
+    if args.command == "build":
+        report = build_typed_schema(engine, args.tables)
+    else:
+        report = get_rejection_report(engine, args.tables)
+
+    if report is None:
+        raise SystemExit(1)
+    print_report(report, engine, args.show_rejected)
@@ -1,17 +1,38 @@
+import io
 import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import QueuePool
 import logging
+import compact as compact_frames
+import query_cache
+import query_metrics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Rows per chunk when streaming tables with load_table_to_df(..., chunksize=...)
+DEFAULT_CHUNKSIZE = 50000
+
+# Precomputed RFM layer built by `python rfm.py refresh`
+RFM_SEGMENTS_TABLE = "rfm_segments"
+
+_env_loaded = False
+
 def load_env_variables():
     """Load environment variables from .env file"""
+    global _env_loaded
     try:
-        load_dotenv()
+        if not _env_loaded:
+            load_dotenv()
+            _env_loaded = True
         required_vars = ['DB_USER', 'DB_PASSWORD', 'DB_HOST', 'DB_NAME']
         missing_vars = [var for var in required_vars if not os.getenv(var)]
         
@@ -27,30 +48,308 @@ def get_database_url():
     """Construct database URL from environment variables"""
     try:
         port = os.getenv('DB_PORT', '5432')  # Default to 5432 if not specified
-        db_url = f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{port}/{os.getenv('DB_NAME')}"
+        db_url = f"postgresql+psycopg2://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{port}/{os.getenv('DB_NAME')}"
         return db_url
     except Exception as e:
         logger.error(f"Error constructing database URL: {str(e)}")
         return None
 
-def get_db_connection():
-    """Create and return a database connection"""
+class _InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait for a connection"""
+    stats = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.stats is not None:
+                waited = time.perf_counter() - start
+                with self.stats['lock']:
+                    self.stats['checkouts'] += 1
+                    self.stats['total_wait_seconds'] += waited
+                    self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], waited)
+
+    def recreate(self):
+        # dispose() swaps in a fresh pool; keep counting into the same stats
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+# Process-wide engine registry: one pooled engine per database URL
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_pool_settings():
+    """Pool configuration from the environment, with defaults"""
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', '30')),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    }
+
+def _new_pool_stats():
+    return {
+        'lock': threading.Lock(),
+        'connections_created': 0,
+        'checkouts': 0,
+        'total_wait_seconds': 0.0,
+        'max_wait_seconds': 0.0,
+    }
+
+def _create_pooled_engine(db_url):
+    """Create an engine whose pool reports connection and wait statistics"""
+    engine = create_engine(db_url, poolclass=_InstrumentedQueuePool, **get_pool_settings())
+    stats = _new_pool_stats()
+    engine.pool.stats = stats
+
+    @event.listens_for(engine, "connect")
+    def _count_connection(dbapi_connection, connection_record):
+        with stats['lock']:
+            stats['connections_created'] += 1
+
+    return engine
+
+def get_db_connection(db_url=None):
+    """Return the shared pooled engine for this process.
+
+    The engine is created on first use and reused afterwards; pass db_url to
+    use a database other than the one configured in .env.
+    """
     try:
-        if not load_env_variables():
-            raise Exception("Failed to load environment variables")
-            
-        db_url = get_database_url()
-        if not db_url:
-            raise Exception("Failed to construct database URL")
-            
-        engine = create_engine(db_url)
+        if db_url is None:
+            if not load_env_variables():
+                raise Exception("Failed to load environment variables")
+
+            db_url = get_database_url()
+            if not db_url:
+                raise Exception("Failed to construct database URL")
+
+        engine = _engines.get(db_url)
+        if engine is None:
+            with _engines_lock:
+                engine = _engines.get(db_url)
+                if engine is None:
+                    engine = _create_pooled_engine(db_url)
+                    _engines[db_url] = engine
         return engine
     except Exception as e:
         logger.error(f"Error connecting to database: {str(e)}")
         return None
 
-def load_table_to_df(table_name, engine=None):
-    """Load a specific table into a pandas DataFrame"""
+def get_pool_stats(engine=None):
+    """Connection pool statistics for an engine (default: the shared engine)"""
+    if engine is None:
+        engine = get_db_connection()
+    if engine is None:
+        return None
+
+    pool = engine.pool
+    stats = getattr(pool, 'stats', None) or _new_pool_stats()
+    with stats['lock']:
+        checkouts = stats['checkouts']
+        return {
+            'pool_size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'connections_created': stats['connections_created'],
+            'checkouts': checkouts,
+            'total_wait_seconds': stats['total_wait_seconds'],
+            'avg_wait_seconds': stats['total_wait_seconds'] / checkouts if checkouts else 0.0,
+            'max_wait_seconds': stats['max_wait_seconds'],
+        }
+
+def dispose_engines():
+    """Close every pooled connection held by this process"""
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+
+def _reset_engines_after_fork():
+    # A forked worker must not reuse the parent's sockets: drop the inherited
+    # connections without closing them (the parent still owns them)
+    global _engines_lock
+    _engines_lock = threading.Lock()
+    for engine in _engines.values():
+        engine.dispose(close=False)
+        engine.pool.stats = _new_pool_stats()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_engines_after_fork)
+
+def build_select(table_name, columns=None, where=None):
+    """SELECT statement for a table with optional column projection and filter.
+
+    Table and column names must be plain (optionally schema-qualified)
+    identifiers; `where` is raw SQL, so pass values through bind parameters.
+    """
+    identifier = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*)?$')
+    for name in [table_name] + list(columns or []):
+        if not identifier.match(name):
+            raise ValueError(f"Invalid identifier: {name!r}")
+
+    column_list = ", ".join(columns) if columns else "*"
+    query = f"SELECT {column_list} FROM {table_name}"
+    if where:
+        query += f" WHERE {where}"
+    return query
+
+def bind_literals(query, params):
+    """Render :name bind parameters into a query as SQL literals.
+
+    For SQL that is shipped as a plain string (COPY, EXPLAIN, the query
+    cache and metrics), so each parameter set yields its own query text.
+    """
+    from sqlalchemy.dialects import postgresql
+
+    # The named paramstyle leaves % alone; psycopg2's would double it
+    return str(text(query).bindparams(**params).compile(
+        dialect=postgresql.dialect(paramstyle='named'), compile_kwargs={"literal_binds": True}))
+
+def date_range_params(start=None, end=None):
+    """:start/:end parameters for a half-open date range; None leaves that side open"""
+    return {'start': str(start) if start is not None else '-infinity',
+            'end': str(end) if end is not None else 'infinity'}
+
+def iter_table_chunks(table_name, chunksize=DEFAULT_CHUNKSIZE, columns=None, where=None,
+                      params=None, engine=None):
+    """Yield a table as DataFrame chunks read through a server-side cursor.
+
+    Rows are streamed from a named cursor, so at most one chunk is held in
+    memory at a time regardless of table size.
+    """
+    if engine is None:
+        engine = get_db_connection()
+
+    if engine is None:
+        raise Exception("Failed to establish database connection")
+
+    query = build_select(table_name, columns, where)
+    rows = 0
+    try:
+        with engine.connect() as conn:
+            conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+            for chunk in pd.read_sql_query(text(query), conn, params=params, chunksize=chunksize):
+                rows += len(chunk)
+                yield chunk
+        logger.info(f"Streamed {rows:,} rows from table: {table_name}")
+    except Exception as e:
+        logger.error(f"Error streaming table {table_name}: {str(e)}")
+        raise
+
+def _copy_column_types(table_name):
+    """Column types for parsing COPY output: typed tables from typed_schema.py, else text"""
+    from typed_schema import ANALYTICS_SCHEMA, TYPED_TABLES, typed_columns
+
+    schema, _, table = table_name.rpartition('.')
+    if schema == ANALYTICS_SCHEMA and table in TYPED_TABLES:
+        return typed_columns(table)
+    return {}
+
+def copy_table_to_df(table_name, columns=None, where=None, params=None, engine=None):
+    """Load a table with COPY ... TO STDOUT and parse it straight into columns.
+
+    Skips per-row Python objects entirely: the CSV stream is parsed by
+    pyarrow (falling back to pandas' C parser) into typed columns, using the
+    typed_schema.py types for analytics tables. With pyarrow, NULLs and empty
+    strings stay distinct in text columns.
+    """
+    if engine is None:
+        engine = get_db_connection()
+
+    if engine is None:
+        raise Exception("Failed to establish database connection")
+
+    query = build_select(table_name, columns, where)
+    if params:
+        # COPY takes no bind parameters, so render them as SQL literals
+        query = bind_literals(query, params)
+
+    buffer = io.BytesIO()
+    raw_conn = engine.raw_connection()
+    try:
+        cursor = raw_conn.cursor()
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", buffer)
+        cursor.close()
+        raw_conn.commit()
+    finally:
+        raw_conn.close()
+    buffer.seek(0)
+
+    column_types = _copy_column_types(table_name)
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        pa = None
+
+    if pa is not None:
+        arrow_types = {
+            'text': pa.string(),
+            'timestamp': pa.timestamp('us'),
+            'integer': pa.int32(),
+        }
+        read_columns = columns or buffer.readline().decode('utf-8').strip().split(',')
+        buffer.seek(0)
+        convert = pa_csv.ConvertOptions(
+            column_types={
+                col: arrow_types.get(column_types.get(col, 'text'), pa.float64())
+                for col in read_columns
+            },
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,
+        )
+        table = pa_csv.read_csv(buffer, convert_options=convert)
+        return table.to_pandas(types_mapper={pa.int32(): pd.Int32Dtype()}.get)
+
+    dtypes = {}
+    parse_dates = []
+    for col, col_type in column_types.items():
+        if col_type == 'timestamp':
+            parse_dates.append(col)
+        elif col_type == 'integer':
+            dtypes[col] = 'Int32'
+        elif col_type != 'text':
+            dtypes[col] = 'float64'
+    if columns:
+        parse_dates = [col for col in parse_dates if col in columns]
+    return pd.read_csv(buffer, dtype=dtypes or None, parse_dates=parse_dates or False,
+                       keep_default_na=False, na_values=[''])
+
+def load_table_to_df(table_name, engine=None, chunksize=None, columns=None, where=None, params=None,
+                     use_copy=False, compact=None):
+    """Load a specific table into a pandas DataFrame
+
+    With chunksize set, returns an iterator of DataFrame chunks streamed from
+    a server-side cursor instead (see iter_table_chunks). `columns` limits the
+    columns read and `where` adds a filter, e.g.
+    load_table_to_df('analytics.orders', where="order_status = :status",
+                     params={'status': 'delivered'}).
+
+    use_copy=True takes the COPY fast path (see copy_table_to_df), which is
+    several times faster for full-table pulls.
+
+    compact=True (or COMPACT_FRAMES=1 in the environment) returns the table
+    with categorical, Arrow-string and downcast numeric columns (see
+    compact.py); chunked reads are never compacted.
+    """
+    if chunksize:
+        return iter_table_chunks(table_name, chunksize, columns, where, params, engine)
+
+    if compact is None:
+        compact = compact_frames.enabled()
+
+    if use_copy:
+        try:
+            df = copy_table_to_df(table_name, columns, where, params, engine)
+            logger.info(f"Successfully loaded table via COPY: {table_name}")
+            return compact_frames.compact_frame(df) if compact else df
+        except Exception as e:
+            logger.error(f"Error loading table {table_name}: {str(e)}")
+            return None
+
     try:
         if engine is None:
             engine = get_db_connection()
@@ -58,29 +357,244 @@ def load_table_to_df(table_name, engine=None):
         if engine is None:
             raise Exception("Failed to establish database connection")
             
-        query = f"SELECT * FROM {table_name}"
-        df = pd.read_sql_query(text(query), engine)
+        query = build_select(table_name, columns, where)
+        df = pd.read_sql_query(text(query), engine, params=params)
         logger.info(f"Successfully loaded table: {table_name}")
-        return df
+        return compact_frames.compact_frame(df) if compact else df
     except Exception as e:
         logger.error(f"Error loading table {table_name}: {str(e)}")
         return None
 
-def execute_query(query, engine=None):
-    """Execute a custom SQL query and return results as a DataFrame"""
+def _caller_label(caller):
+    """Default query label: the calling module and function"""
+    module = caller.f_globals.get('__name__')
+    if module == '__main__':
+        module = os.path.splitext(os.path.basename(caller.f_globals.get('__file__', module)))[0]
+    return f"{module}.{caller.f_code.co_name}"
+
+@contextmanager
+def _cursor_timer(conn):
+    """Accumulate time spent in cursor.execute on a connection into timer['seconds'].
+
+    Lets execute_query split the database's execution time from the fetch
+    and DataFrame construction that read_sql_query does around it.
+    """
+    timer = {'seconds': 0.0}
+    started = []
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        started.append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        timer['seconds'] += time.perf_counter() - started.pop()
+
+    event.listen(conn, 'before_cursor_execute', before)
+    event.listen(conn, 'after_cursor_execute', after)
     try:
+        yield timer
+    finally:
+        event.remove(conn, 'before_cursor_execute', before)
+        event.remove(conn, 'after_cursor_execute', after)
+
+def execute_query(query, engine=None, cache=None, cache_ttl=None, label=None, compact=None):
+    """Execute a custom SQL query and return results as a DataFrame
+
+    With cache=True (or QUERY_CACHE=1 in the environment) results are served
+    from the on-disk cache in query_cache.py while the tables the query reads
+    are unchanged. Each call is timed and recorded by query_metrics.py under
+    `label` (default: the calling module and function). compact=True (or
+    COMPACT_FRAMES=1) returns compact column types, as in load_table_to_df.
+    """
+    if label is None:
+        label = _caller_label(sys._getframe(1))
+
+    try:
+        start = time.perf_counter()
         if engine is None:
             engine = get_db_connection()
             
         if engine is None:
             raise Exception("Failed to establish database connection")
-            
-        df = pd.read_sql_query(text(query), engine)
-        logger.info("Query executed successfully")
+
+        if cache is None:
+            cache = os.getenv('QUERY_CACHE', '').lower() in ('1', 'true', 'yes')
+        if compact is None:
+            compact = compact_frames.enabled()
+
+        key = None
+        if cache:
+            key = query_cache.cache_key(query, engine)
+            df = query_cache.get(key, ttl=query_cache.DEFAULT_TTL_SECONDS if cache_ttl is None else cache_ttl)
+            if df is not None:
+                if compact:
+                    df = compact_frames.compact_frame(df)
+                query_metrics.record(label, query, time.perf_counter() - start, 0.0, 0.0, df, cached=True)
+                return df
+
+        read_start = time.perf_counter()
+        with engine.connect() as conn:
+            with _cursor_timer(conn) as timer:
+                df = pd.read_sql_query(text(query), conn)
+        if key is not None:
+            query_cache.put(key, df, query)
+        if compact:
+            df = compact_frames.compact_frame(df)
+        end = time.perf_counter()
+
+        db_seconds = timer['seconds']
+        query_metrics.record(label, query, end - start, db_seconds, end - read_start - db_seconds, df,
+                             engine=engine)
+        return df
+    except Exception as e:
+        logger.error(f"Error executing query {label}: {str(e)}")
+        return None
+
+# Async counterparts of execute_query and load_table_to_df, on asyncpg
+# through SQLAlchemy's asyncio extension (requires asyncpg and greenlet).
+# Async engines are pooled like the sync ones, but a pool belongs to the
+# event loop that created it, so one engine is kept per URL and loop.
+_async_engines = {}
+
+def get_query_timeout():
+    """Default per-query timeout in seconds from DB_QUERY_TIMEOUT, or None"""
+    value = os.getenv('DB_QUERY_TIMEOUT')
+    return float(value) if value else None
+
+def get_async_db_connection(db_url=None):
+    """Return the shared async pooled engine for this URL and event loop.
+
+    Takes the same URL and pool settings as get_db_connection; the driver is
+    switched to asyncpg.
+    """
+    try:
+        import asyncio
+        from sqlalchemy.engine import make_url
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        if db_url is None:
+            if not load_env_variables():
+                raise Exception("Failed to load environment variables")
+            db_url = get_database_url()
+            if not db_url:
+                raise Exception("Failed to construct database URL")
+
+        url = make_url(db_url).set(drivername='postgresql+asyncpg')
+        key = url.render_as_string(hide_password=False)
+        loop = asyncio.get_running_loop()
+        engine, engine_loop = _async_engines.get(key, (None, None))
+        if engine is None or engine_loop is not loop:
+            # The previous loop's connections cannot be used (or closed) from this one
+            if engine is not None:
+                engine.sync_engine.dispose(close=False)
+            engine = create_async_engine(url, **get_pool_settings())
+            _async_engines[key] = (engine, loop)
+        return engine
+    except Exception as e:
+        logger.error(f"Error connecting to database: {str(e)}")
+        return None
+
+async def dispose_async_engines():
+    """Close every async pooled connection created on the running loop"""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    for key, (engine, engine_loop) in list(_async_engines.items()):
+        if engine_loop is loop:
+            await engine.dispose()
+            del _async_engines[key]
+
+async def execute_query_async(query, engine=None, params=None, timeout=None, label=None, compact=None):
+    """Async execute_query: run a query without blocking the event loop.
+
+    `timeout` (default DB_QUERY_TIMEOUT) bounds the query both on the server,
+    as a statement_timeout, and on the client. Returns a DataFrame, or None
+    on error or timeout. Cancelling the awaiting task cancels the query.
+    """
+    import asyncio
+
+    if label is None:
+        label = _caller_label(sys._getframe(1))
+    if timeout is None:
+        timeout = get_query_timeout()
+    if compact is None:
+        compact = compact_frames.enabled()
+
+    try:
+        start = time.perf_counter()
+        if engine is None:
+            engine = get_async_db_connection()
+
+        if engine is None:
+            raise Exception("Failed to establish database connection")
+
+        def read(sync_conn):
+            # read_sql_query on the sync facade, so dtypes match execute_query
+            with _cursor_timer(sync_conn) as timer:
+                return pd.read_sql_query(text(query), sync_conn, params=params), timer['seconds']
+
+        async def fetch():
+            async with engine.connect() as conn:
+                if timeout is not None:
+                    await conn.execute(text("SELECT set_config('statement_timeout', :ms, true)"),
+                                       {"ms": str(int(timeout * 1000))})
+                return await conn.run_sync(read)
+
+        read_start = time.perf_counter()
+        df, db_seconds = await asyncio.wait_for(fetch(), timeout)
+        if compact:
+            df = compact_frames.compact_frame(df)
+        end = time.perf_counter()
+
+        query_metrics.record(label, query, end - start, db_seconds, end - read_start - db_seconds, df)
         return df
+    except asyncio.TimeoutError:
+        logger.error(f"Query {label} timed out after {timeout}s")
+        return None
+    except Exception as e:
+        logger.error(f"Error executing query {label}: {str(e)}")
+        return None
+
+async def load_table_to_df_async(table_name, engine=None, columns=None, where=None, params=None,
+                                 timeout=None, compact=None):
+    """Async load_table_to_df (without chunking or COPY)"""
+    try:
+        query = build_select(table_name, columns, where)
     except Exception as e:
-        logger.error(f"Error executing query: {str(e)}")
+        logger.error(f"Error loading table {table_name}: {str(e)}")
+        return None
+    return await execute_query_async(query, engine, params, timeout, label=f"load:{table_name}",
+                                     compact=compact)
+
+async def gather_queries(queries, engine=None, timeout=None, compact=None):
+    """Run labeled queries concurrently; returns {label: DataFrame or None}.
+
+    `queries` maps label to SQL. The queries share the async pool, so at
+    most pool_size + max_overflow run at once; the batch takes about as long
+    as the slowest query.
+    """
+    import asyncio
+
+    if engine is None:
+        engine = get_async_db_connection()
+    labels = list(queries)
+    frames = await asyncio.gather(*(
+        execute_query_async(queries[label], engine, timeout=timeout, label=label, compact=compact)
+        for label in labels
+    ))
+    return dict(zip(labels, frames))
+
+def get_rfm_build_info(engine=None):
+    """Return the most recent RFM build record as a dict, or None if never built"""
+    query = f"""
+    SELECT *
+    FROM {RFM_SEGMENTS_TABLE}_build_log
+    ORDER BY built_at DESC
+    LIMIT 1
+    """
+    df = execute_query(query, engine)
+    if df is None or df.empty:
         return None
+    return df.iloc[0].to_dict()
 
 # Example usage:
 if __name__ == "__main__":
@@ -94,5 +608,6 @@ if __name__ == "__main__":
                 result = conn.execute(query)
                 tables = [row[0] for row in result]
                 logger.info(f"Available tables: {tables}")
+            logger.info(f"Pool stats: {get_pool_stats(engine)}")
         except Exception as e:
             logger.error(f"Error testing connection: {str(e)}")
\ No newline at end of file
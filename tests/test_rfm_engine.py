@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+from rfm_engine import DEFAULT_SEGMENT, compute_rfm_base, ntile, score_rfm, segment_customers
+
+# Expected buckets are PostgreSQL's output for
+# SELECT NTILE(5) OVER (ORDER BY i) FROM generate_series(1, rows) i
+@pytest.mark.parametrize('rows, expected', [
+    (0, []),
+    (1, [1]),
+    (3, [1, 2, 3]),
+    (4, [1, 2, 3, 4]),
+    (5, [1, 2, 3, 4, 5]),
+    (7, [1, 1, 2, 2, 3, 4, 5]),
+    (12, [1, 1, 1, 2, 2, 2, 3, 3, 4, 4, 5, 5]),
+    (13, [1, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 5, 5]),
+])
+def test_ntile_matches_postgres(rows, expected):
+    assert ntile(np.arange(rows)).tolist() == expected
+
+def test_ntile_assigns_buckets_through_sort_order():
+    # Row 2 sorts first, row 0 last
+    assert ntile(np.array([2, 1, 0]), n=2).tolist() == [2, 1, 1]
+
+def _base(values):
+    return pd.DataFrame({
+        'customer_unique_id': list(values),
+        'customer_state': 'SP',
+        'recency': list(values.values()),
+        'frequency': 1,
+        'monetary': 10.0,
+    })
+
+def test_score_rfm_breaks_ties_by_customer():
+    # PostgreSQL: NTILE(5) OVER (ORDER BY recency DESC, customer_unique_id COLLATE "C")
+    base = _base({'a': 10, 'b': 3, 'c': 10, 'd': 1, 'e': 3, 'f': 10, 'g': 7})
+    scores = score_rfm(base)
+    assert dict(zip(scores['customer_unique_id'], scores['r'])) == {
+        'a': 1, 'b': 3, 'c': 1, 'd': 5, 'e': 4, 'f': 2, 'g': 2,
+    }
+    # Every frequency and monetary value ties, so customer order alone decides
+    assert scores['f'].tolist() == [1, 1, 2, 2, 3, 4, 5]
+    assert scores['m'].tolist() == [1, 1, 2, 2, 3, 4, 5]
+
+def test_score_rfm_breaks_ties_by_state_within_customer():
+    base = pd.DataFrame({
+        'customer_unique_id': ['x', 'x'],
+        'customer_state': ['SP', 'RJ'],
+        'recency': [5, 5],
+        'frequency': [1, 1],
+        'monetary': [1.0, 1.0],
+    })
+    scores = score_rfm(base, n=2)
+    assert dict(zip(scores['customer_state'], scores['f'])) == {'RJ': 1, 'SP': 2}
+
+@pytest.mark.parametrize('r, f, m, segment', [
+    (5, 5, 5, 'Champions'),
+    (4, 4, 4, 'Champions'),
+    (4, 4, 3, 'Loyal Customers'),
+    (3, 3, 3, 'Loyal Customers'),
+    (3, 5, 2, 'Others'),
+    (2, 3, 3, 'At Risk'),
+    (1, 5, 5, 'At Risk'),
+    (2, 2, 2, 'Lost'),
+    (1, 1, 1, 'Lost'),
+    (1, 2, 3, 'Others'),
+    (2, 3, 2, 'Others'),
+])
+def test_segment_rules_match_sql_case(r, f, m, segment):
+    scores = pd.DataFrame({'r': [r], 'f': [f], 'm': [m]})
+    assert segment_customers(scores).tolist() == [segment]
+
+def test_segment_rules_first_match_wins():
+    rules = [
+        ('Top', {'R': (5, None)}),
+        ('Recent', {'R': (4, None)}),
+    ]
+    scores = pd.DataFrame({'r': [5, 4, 3], 'f': [1, 1, 1], 'm': [1, 1, 1]})
+    assert segment_customers(scores, rules).tolist() == ['Top', 'Recent', DEFAULT_SEGMENT]
+
+def test_compute_rfm_base_counts_delivered_orders_only():
+    ts = pd.Timestamp
+    items = pd.DataFrame([
+        # customer, state, order, status, purchased, price, freight
+        ('u1', 'SP', 'o1', 'delivered', ts('2018-01-01 10:00'), 10.0, 1.0),
+        ('u1', 'SP', 'o1', 'delivered', ts('2018-01-01 10:00'), 5.0, 1.0),
+        ('u1', 'SP', 'o2', 'delivered', ts('2018-01-20 09:00'), 20.0, 2.5),
+        ('u1', 'SP', 'o3', 'canceled', ts('2018-02-01 00:00'), 99.0, 9.0),
+        ('u2', 'RJ', 'o4', 'delivered', ts('2018-01-30 23:00'), 7.5, 0.0),
+    ], columns=['customer_unique_id', 'customer_state', 'order_id', 'order_status',
+                'order_purchase_timestamp', 'price', 'freight_value'])
+
+    base = compute_rfm_base(items).set_index('customer_unique_id')
+    # Anchored on the latest purchase of any status, like the SQL
+    assert base.loc['u1', 'recency'] == 11
+    assert base.loc['u2', 'recency'] == 1
+    assert base.loc['u1', 'frequency'] == 2
+    assert base.loc['u1', 'monetary'] == pytest.approx(39.5)
+    assert base.loc['u2', 'monetary'] == pytest.approx(7.5)